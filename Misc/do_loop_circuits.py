@@ -3,64 +3,136 @@
 # Step 1: Glob the intf_all
 # Step 2: Form as many loops as possible
 # Step 3: Make images of all the possible loops. 
+# Step 4: Count the loops that don't close at each pixel, which can be used as an unwrapping-error mask.
 
 import numpy as np
 import matplotlib.pyplot as plt
 import glob
 import os
+import argparse
+import multiprocessing as mp
 from Tectonic_Utils.read_write import netcdf_read_write
 
-# BROKE AT LOOP # 120 OR # 121. NOT SURE WHY.
-from Tectonic_Utils.read_write.netcdf_read_write import read_netcdf3
+CLOSURE_TILE_BYTES = 256 * 2 ** 20   # memory for one tile: its slice of the grid caches, plus closure temporaries
+TEMPORARIES_PER_LOOP = 10   # float32 (rows, cols) arrays that closure_phase needs for each loop
 
 
 def identify_all_loops():
     # This function takes the glob intf_all directories and then makes all possible triangles.
     # It populates a list of loops, each containing three images.
-    loops, edges, nodes = [], [], []
     directories = glob.glob("intf_all/???????_???????")
-    for item in directories:
-        edgepair = item.split('/')[-1]
-        edges.append(edgepair)
-        nodes.append(edgepair.split('_')[0])
-        nodes.append(edgepair.split('_')[1])
-    nodes = list(set(nodes))
-
-    # Making a graph of nodes and edges
-    startnode = []
-    endnode = []
-    for i in range(len(nodes)):
-        startnode.append(nodes[i])
-        thisend = []
-        for j in range(len(nodes)):
-            if nodes[i] + '_' + nodes[j] in edges or nodes[j] + '_' + nodes[i] in edges:
-                thisend.append(nodes[j])
-        endnode.append(thisend)
-
-    graph = dict([(startnode[i], endnode[i]) for i in range(len(startnode))])
-
-    # Now we find loops.
-    # Start in chronological order. Step through the main loop.
-    # Within, have a loop of connectors, and another loop of connectors. If the innermost
-    # layer comes back to the starter, then you have a loop of 3.
-    for node0 in startnode:
-        for node1 in graph[node0]:
-            possible_list = graph[node1]
-            for node2 in possible_list:
-                if node2 == node0:
-                    continue
-                elif node0 in graph[node2]:
-                    loop_try = [node0, node1, node2]
-                    loop_try = sorted(loop_try)
-                    if loop_try not in loops:
-                        loops.append(loop_try)
-
-    print("Number of Images (nodes): % s" % (len(startnode)))
+    edges = [item.split('/')[-1] for item in directories]
+    loops, nodes = get_triangles(edges)
+    print("Number of Images (nodes): % s" % (len(nodes)))
     print("Number of Loops (circuits): % s" % (len(loops)))
     return loops
 
 
-def compute_loops(all_loops, loops_dir, loops_guide, rowref, colref):
+def get_triangles(edges):
+    """
+    Enumerate every loop of 3 interferograms, working on integer date indices.
+    Each date gets an adjacency set; a triangle i < j < k is any k that's adjacent to both i and j.
+    Returns sorted list of loops (each a sorted list of three datestrs), and the sorted list of datestrs.
+    """
+    nodes = sorted(set([x.split('_')[0] for x in edges] + [x.split('_')[1] for x in edges]))
+    node_index = {node: i for i, node in enumerate(nodes)}
+    adjacency = [set() for _ in nodes]
+    for edge in edges:
+        a, b = node_index[edge.split('_')[0]], node_index[edge.split('_')[1]]
+        adjacency[a].add(b)
+        adjacency[b].add(a)
+    loops = []
+    for i in range(len(nodes)):
+        for j in sorted(x for x in adjacency[i] if x > i):
+            for k in sorted(x for x in adjacency[i] & adjacency[j] if x > j):
+                loops.append([nodes[i], nodes[j], nodes[k]])
+    return loops, nodes
+
+
+def get_loop_edges(all_loops):
+    """ Unique edges used by the loops, and an (n_loops, 3) integer array of edge indices: a_b, b_c, a_c. """
+    edges, loop_edges = [], []
+    edge_index = {}
+    for loop in all_loops:
+        this_loop = []
+        for edge in [loop[0] + '_' + loop[1], loop[1] + '_' + loop[2], loop[0] + '_' + loop[2]]:
+            if edge not in edge_index:
+                edge_index[edge] = len(edges)
+                edges.append(edge)
+            this_loop.append(edge_index[edge])
+        loop_edges.append(this_loop)
+    return edges, np.array(loop_edges, dtype=int)
+
+
+def cache_grids(edges, gridname, cache_file):
+    """ Read each interferogram's grid exactly once into a float32 memory-mapped cube on disk. """
+    xdata, ydata, zdata = netcdf_read_write.read_any_grd(os.path.join('intf_all', edges[0], gridname))
+    cube = np.lib.format.open_memmap(cache_file, mode='w+', dtype=np.float32, shape=(len(edges),) + np.shape(zdata))
+    for i, edge in enumerate(edges):
+        cube[i] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge, gridname))[2]
+    cube.flush()
+    return xdata, ydata, cube
+
+
+def closure_phase(z1, z2, z3, wr1, wr2, wr3, z_ref, wr_ref):
+    """
+    Whole-array closure phase for stacks of loops. Inputs are (n_loops, rows, cols); z_ref and wr_ref are
+    (n_loops, 3) values at the reference pixel. Using equation from Heresh Fattahi's PhD thesis to isolate
+    unwrapping errors.  Returns the raw and reference-corrected closures, in the precision of the inputs.
+    """
+    wrapped_closure_fix = (wr1 + wr2 - wr3) - (wr_ref[:, 0] + wr_ref[:, 1] - wr_ref[:, 2])[:, None, None]
+    offset_before_unwrapping = np.mod(wrapped_closure_fix, 2 * np.pi)
+    offset_before_unwrapping[offset_before_unwrapping > np.pi] -= 2 * np.pi  # send it to the -pi to pi realm.
+    unwrapped_closure_raw = z1 + z2 - z3
+    unwrapped_closure_fix = unwrapped_closure_raw - (z_ref[:, 0] + z_ref[:, 1] - z_ref[:, 2])[:, None, None]
+    znew_raw = unwrapped_closure_raw - offset_before_unwrapping
+    znew_fix = unwrapped_closure_fix - offset_before_unwrapping
+    return znew_raw, znew_fix
+
+
+def get_tile_sizes(n_edges, n_loops, nx, max_bytes=CLOSURE_TILE_BYTES):
+    """
+    Rows per tile and loops per chunk, so that one tile stays within max_bytes however many loops there are.
+    Half of the budget holds the tile's slice of the two float32 grid caches, half the temporaries of a chunk of loops.
+    """
+    tile_rows = max(1, int((max_bytes // 2) // (2 * 4 * n_edges * nx)))
+    loop_chunk = max(1, min(n_loops, int((max_bytes // 2) // (TEMPORARIES_PER_LOOP * 4 * tile_rows * nx))))
+    return tile_rows, loop_chunk
+
+
+def compute_closure_tile(tile_args):
+    """
+    Closure for all loops over one tile of rows, a chunk of loops at a time, written into the memory-mapped
+    output cubes. Everything stays float32, like the caches.
+    """
+    r0, r1, loop_edges, z_ref, wr_ref, cache_files, loop_chunk = tile_args
+    unw = np.load(cache_files["unwrapped"], mmap_mode='r')
+    wr = np.load(cache_files["wrapped"], mmap_mode='r')
+    out_raw = np.load(cache_files["closure_raw"], mmap_mode='r+')
+    out_fix = np.load(cache_files["closure_fix"], mmap_mode='r+')
+    unw_tile, wr_tile = np.asarray(unw[:, r0:r1, :]), np.asarray(wr[:, r0:r1, :])   # each grid paged in once
+    number_of_errors = np.zeros(np.shape(unw_tile)[1:], dtype=int)
+    for c0 in range(0, len(loop_edges), loop_chunk):
+        chunk = slice(c0, c0 + loop_chunk)
+        e1, e2, e3 = loop_edges[chunk, 0], loop_edges[chunk, 1], loop_edges[chunk, 2]
+        znew_raw, znew_fix = closure_phase(unw_tile[e1], unw_tile[e2], unw_tile[e3], wr_tile[e1], wr_tile[e2],
+                                           wr_tile[e3], z_ref[chunk], wr_ref[chunk])
+        out_raw[chunk, r0:r1, :] = znew_raw
+        out_fix[chunk, r0:r1, :] = znew_fix
+        with np.errstate(invalid='ignore'):
+            number_of_errors += np.sum(np.abs(znew_fix) > 0.5, axis=0)   # loops that don't close, at each pixel
+    out_raw.flush()
+    out_fix.flush()
+    return r0, r1, number_of_errors
+
+
+def compute_loops(all_loops, loops_dir, loops_guide, rowref, colref, n_workers=1, max_bytes=CLOSURE_TILE_BYTES):
+    """
+    Closure phase of every loop, computed as whole-array operations over tiles of rows (in parallel if
+    n_workers > 1). Every grid is read once, into memory-mapped caches in loops_dir.
+    Tiles are sized so that each worker needs about max_bytes (see get_tile_sizes).
+    Returns the number of non-closing loops at each pixel, which works as an unwrapping-error mask.
+    """
     os.makedirs(loops_dir, exist_ok=True)
     ofile = open(loops_dir + loops_guide, 'w')
     for i in range(len(all_loops)):
@@ -69,69 +141,48 @@ def compute_loops(all_loops, loops_dir, loops_guide, rowref, colref):
 
     unwrapped = 'unwrap.grd'
     wrapped = 'phasefilt.grd'
-    filename = os.path.join('intf_all', all_loops[0][0] + '_' + all_loops[0][1], unwrapped)
-    z1_sample = read_netcdf3(filename)[2]
-    number_of_errors = np.zeros(np.shape(z1_sample))
-
+    edges, loop_edges = get_loop_edges(all_loops)
+    cache_files = {key: os.path.join(loops_dir, key + '_cube.npy') for key in
+                   ["unwrapped", "wrapped", "closure_raw", "closure_fix"]}
+    xdata, ydata, unw = cache_grids(edges, unwrapped, cache_files["unwrapped"])
+    _, _, wr = cache_grids(edges, wrapped, cache_files["wrapped"])
+    for key in ["closure_raw", "closure_fix"]:
+        np.lib.format.open_memmap(cache_files[key], mode='w+', dtype=np.float32,
+                                  shape=(len(all_loops),) + np.shape(unw)[1:]).flush()
+    z_ref = np.asarray(unw[:, rowref, colref], dtype=np.float32)[loop_edges]   # (n_loops, 3)
+    wr_ref = np.asarray(wr[:, rowref, colref], dtype=np.float32)[loop_edges]
+    del unw, wr
+
+    ny = len(ydata)
+    tile_rows, loop_chunk = get_tile_sizes(len(edges), len(all_loops), len(xdata), max_bytes)
+    tiles = [(r0, min(r0 + tile_rows, ny), loop_edges, z_ref, wr_ref, cache_files, loop_chunk)
+             for r0 in range(0, ny, tile_rows)]
+    number_of_errors = np.zeros((ny, len(xdata)))
+    if n_workers > 1:
+        with mp.Pool(n_workers) as pool:
+            results = pool.imap_unordered(compute_closure_tile, tiles)
+            for r0, r1, tile_errors in results:
+                number_of_errors[r0:r1, :] = tile_errors
+    else:
+        for r0, r1, tile_errors in map(compute_closure_tile, tiles):
+            number_of_errors[r0:r1, :] = tile_errors
+
+    closure_raw = np.load(cache_files["closure_raw"], mmap_mode='r')
+    closure_fix = np.load(cache_files["closure_fix"], mmap_mode='r')
     for i in range(0, len(all_loops)):
-        edge1 = all_loops[i][0] + '_' + all_loops[i][1]
-        edge2 = all_loops[i][1] + '_' + all_loops[i][2]
-        edge3 = all_loops[i][0] + '_' + all_loops[i][2]
-        [_, _, z1] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge1, unwrapped))
-        [_, _, z2] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge2, unwrapped))
-        [_, _, z3] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge3, unwrapped))
-
-        [xdata, ydata, wr_z1] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge1, wrapped))
-        [_, _, wr_z2] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge2, wrapped))
-        [_, _, wr_z3] = netcdf_read_write.read_any_grd(os.path.join('intf_all', edge3, wrapped))
-
         print("Loop " + str(i) + ":")
-
-        rowdim, coldim = np.shape(z1)
-
-        histdata_raw, histdata_fix = [], []
-        znew_raw = np.zeros(np.shape(z1))
-        znew_fix = np.zeros(np.shape(z1))
-        errorcount = 0
-
-        for j in range(rowdim):
-            for k in range(coldim):
-
-                wr1 = wr_z1[j][k] - wr_z1[rowref, colref]
-                z1_adj = z1[j][k] - z1[rowref, colref]
-                wr2 = wr_z2[j][k] - wr_z2[rowref, colref]
-                z2_adj = z2[j][k] - z2[rowref, colref]
-                wr3 = wr_z3[j][k] - wr_z3[rowref, colref]
-                z3_adj = z3[j][k] - z3[rowref, colref]
-
-                # Using equation from Heresh Fattahi's PhD thesis to isolate unwrapping errors.
-                wrapped_closure_raw = wr_z1[j][k] + wr_z2[j][k] - wr_z3[j][k]
-                wrapped_closure_fix = wr1 + wr2 - wr3
-                offset_before_unwrapping = np.mod(wrapped_closure_fix, 2 * np.pi)
-                if offset_before_unwrapping > np.pi:
-                    offset_before_unwrapping = offset_before_unwrapping - 2 * np.pi  # send it to the -pi to pi realm.
-
-                unwrapped_closure_raw = z1[j][k] + z2[j][k] - z3[j][k]
-                unwrapped_closure_fix = z1_adj + z2_adj - z3_adj
-
-                znew_raw[j][k] = unwrapped_closure_raw - offset_before_unwrapping
-                znew_fix[j][k] = unwrapped_closure_fix - offset_before_unwrapping
-
-                if ~np.isnan(znew_raw[j][k]):
-                    histdata_raw.append(znew_raw[j][k] / np.pi)
-                if ~np.isnan(znew_fix[j][k]):
-                    histdata_fix.append(znew_fix[j][k] / np.pi)
-                if abs(znew_fix[j][k]) > 0.5:  # if this pixel has
-                    errorcount = errorcount + 1
-                    number_of_errors[j][k] = number_of_errors[j][k] + 1
-
-        errorpixels = round(100 * float(errorcount) / len(histdata_fix), 2)
+        znew_raw, znew_fix = np.asarray(closure_raw[i]), np.asarray(closure_fix[i])
+        histdata_raw = znew_raw[~np.isnan(znew_raw)] / np.pi
+        histdata_fix = znew_fix[~np.isnan(znew_fix)] / np.pi
+        errorpixels = round(100 * float(np.sum(np.abs(histdata_fix * np.pi) > 0.5)) / len(histdata_fix), 2)
         print("Most common raw loop sum: ")
         print(np.median(histdata_raw))
         print("Most common fix loop sum: ")
         print(np.median(histdata_fix))
         print("\n")
 
+        netcdf_read_write.produce_output_netcdf(xdata, ydata, znew_fix, 'radians',
+                                                loops_dir + 'phase_closure_' + str(i) + '.grd')
         make_plot(xdata, ydata, znew_fix, loops_dir + 'phase_closure_' + str(i) + '.eps', errorpixels)
         make_histogram(histdata_fix, loops_dir + 'histogram_' + str(i) + '.eps')
 
@@ -167,6 +218,9 @@ def make_histogram(histdata, plotname):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Phase closure of every loop of 3 interferograms in intf_all/')
+    parser.add_argument('--workers', type=int, default=1, help='processes that compute tiles of rows in parallel')
+    args = parser.parse_args()
     loops_dir = "Phase_Circuits/"
     loops_guide = "loops.txt"
     rowref = 237  # doing correction for phase ambiguity
@@ -174,7 +228,7 @@ if __name__ == "__main__":
     # reference_pixel = []  # not doing any correction for phase ambiguity
 
     all_loops = identify_all_loops()
-    [xdata, ydata, number_of_errors] = compute_loops(all_loops, loops_dir, loops_guide, rowref, colref)
+    [xdata, ydata, number_of_errors] = compute_loops(all_loops, loops_dir, loops_guide, rowref, colref, args.workers)
 
     # Print how often phase unwrapping errors affect different pixels.
     outfile = loops_dir + "how_many_errors.grd"
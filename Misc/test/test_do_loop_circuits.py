@@ -0,0 +1,70 @@
+# Does the tiled loop closure agree with the original per-loop, per-pixel arithmetic?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+from .. import do_loop_circuits
+
+
+def closure_per_pixel(z1, z2, z3, wr_z1, wr_z2, wr_z3, rowref, colref):
+    """ The original loop of do_loop_circuits.compute_loops, for one loop """
+    znew_fix = np.zeros(np.shape(z1))
+    for j in range(np.shape(z1)[0]):
+        for k in range(np.shape(z1)[1]):
+            wr1 = wr_z1[j][k] - wr_z1[rowref, colref]
+            wr2 = wr_z2[j][k] - wr_z2[rowref, colref]
+            wr3 = wr_z3[j][k] - wr_z3[rowref, colref]
+            offset_before_unwrapping = np.mod(wr1 + wr2 - wr3, 2 * np.pi)
+            if offset_before_unwrapping > np.pi:
+                offset_before_unwrapping = offset_before_unwrapping - 2 * np.pi
+            unwrapped_closure_fix = (z1[j][k] - z1[rowref, colref]) + (z2[j][k] - z2[rowref, colref]) - \
+                                    (z3[j][k] - z3[rowref, colref])
+            znew_fix[j][k] = unwrapped_closure_fix - offset_before_unwrapping
+    return znew_fix
+
+
+class LoopCircuitTests(unittest.TestCase):
+
+    def test_tiled_closure_matches_per_pixel(self):
+        rng = np.random.default_rng(0)
+        edges = ['2015001_2015013', '2015013_2015025', '2015001_2015025', '2015025_2015037', '2015013_2015037',
+                 '2015001_2015037']
+        loops, _ = do_loop_circuits.get_triangles(edges)
+        edges, loop_edges = do_loop_circuits.get_loop_edges(loops)   # the order of the grid caches
+        ny, nx, rowref, colref = 11, 7, 3, 2
+        dates = sorted(set([x.split('_')[0] for x in edges] + [x.split('_')[1] for x in edges]))
+        phase = {date: rng.normal(scale=3, size=(ny, nx)) for date in dates}   # a consistent network
+        unw = np.array([phase[x.split('_')[1]] - phase[x.split('_')[0]] for x in edges], dtype=np.float32)
+        unw += rng.normal(scale=0.05, size=np.shape(unw)).astype(np.float32)
+        unw[edges.index('2015001_2015025'), 5, 4] += 2 * np.pi   # an unwrapping error
+        wr = np.mod(unw, 2 * np.pi).astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_files = {key: os.path.join(tmpdir, key + '_cube.npy') for key in
+                           ["unwrapped", "wrapped", "closure_raw", "closure_fix"]}
+            np.save(cache_files["unwrapped"], unw)
+            np.save(cache_files["wrapped"], wr)
+            for key in ["closure_raw", "closure_fix"]:
+                np.save(cache_files[key], np.zeros((len(loops), ny, nx), dtype=np.float32))
+            z_ref, wr_ref = unw[:, rowref, colref][loop_edges], wr[:, rowref, colref][loop_edges]
+            tile_rows, loop_chunk = do_loop_circuits.get_tile_sizes(len(edges), len(loops), nx,
+                                                                    max_bytes=2 * (2 * 4 * 6) * 3 * nx)
+            self.assertEqual((tile_rows, loop_chunk), (3, 1))
+            number_of_errors = np.zeros((ny, nx))
+            for r0 in range(0, ny, tile_rows):
+                _, r1, tile_errors = do_loop_circuits.compute_closure_tile((r0, min(r0 + tile_rows, ny), loop_edges,
+                                                                            z_ref, wr_ref, cache_files, loop_chunk))
+                number_of_errors[r0:r1] = tile_errors
+            closure_fix = np.load(cache_files["closure_fix"])
+        self.assertEqual(len(loops), 4)
+        for i in range(len(loops)):
+            e1, e2, e3 = loop_edges[i]
+            expected = closure_per_pixel(unw[e1], unw[e2], unw[e3], wr[e1], wr[e2], wr[e3], rowref, colref)
+            np.testing.assert_allclose(closure_fix[i], expected, atol=1e-4)
+        self.assertEqual(closure_fix.dtype, np.float32)
+        np.testing.assert_array_equal(number_of_errors, np.sum(np.abs(closure_fix) > 0.5, axis=0))
+        self.assertEqual(number_of_errors[5, 4], 2)   # the bad interferogram is in two loops
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 from subprocess import call
 import glob
 import sys
-from copy import deepcopy
+import multiprocessing as mp
 import datetime as dt
 from intf_generating import sentinel_utilities
 from Tectonic_Utils.read_write import netcdf_read_write
@@ -90,7 +90,7 @@ def inputs(file_names, start_time, end_time, run_type):
                 dates.append(dt.datetime.strftime(image1_dt, "%Y%j"))
                 dates.append(dt.datetime.strftime(image2_dt, "%Y%j"))
 
-    data_all = np.array(data_all)  # this allows easy indexing later on.
+    data_all = np.array(data_all, dtype=np.float32)  # this allows easy indexing later on.
     dates = list(set(dates))
     dates = sorted(dates)
     print(date_pairs)
@@ -101,59 +101,41 @@ def inputs(file_names, start_time, end_time, run_type):
 
 # ----------- COMPUTE ------------- #
 
-def form_APS_pairs(date_pairs, mydate, width_of_stencil):
-    # Date pairs: a global list of available interferograms (in order).
-    # containing: a small list of interferograms that contain the image of interest
-    # width_of_stencil: the number of days we tolerate in stencils
+def build_incidence_table(dates, date_pairs):
+    """
+    Which interferograms touch each date, computed once instead of parsing strings for every date.
+    Returns a dict with arrays "first" and "second" (date indices of each interferogram), and "touching",
+    a list over dates of the indices of interferograms that start or end on that date.
+    """
+    date_index = {date: i for i, date in enumerate(dates)}
+    first = np.array([date_index[item.split('_')[0]] for item in date_pairs], dtype=int)
+    second = np.array([date_index[item.split('_')[1]] for item in date_pairs], dtype=int)
+    touching = [np.where((first == i) | (second == i))[0] for i in range(len(dates))]
+    return {"first": first, "second": second, "touching": touching}
+
 
+def form_APS_pairs(date_pairs, dates, incidence, given_date_index, width_of_stencil):
+    # Date pairs: a global list of available interferograms (in order).
+    # For the image of interest, find each interferogram that ends on it with a span of less than
+    # width_of_stencil days, and the interferogram of the same span that starts on it.
+    # Returns a list of [index1, index2] of the paired interferograms used for APS construction.
+    mydate = dates[given_date_index]
     print("Calculating APS stencil on " + mydate + ":")
+    dates_dt = [dt.datetime.strptime(x, "%Y%j") for x in dates]
+    ending_here = np.where(incidence["second"] == given_date_index)[0]
+    starting_here = {dates[incidence["second"][k]]: k for k in np.where(incidence["first"] == given_date_index)[0]}
 
     pairlist = []
-    containing = [item for item in date_pairs if
-                  mydate in item]  # which interferograms contain the image of interest?
-
-    for item in containing:  # for each interferogram containing the main image...
-        image1 = item.split('_')[0]
-        image2 = item.split('_')[1]
-        if image1 == mydate:
-            continue
-        dt1 = dt.datetime.strptime(image1, "%Y%j")
-        dt2 = dt.datetime.strptime(image2, "%Y%j")
-        imwidth = (dt2 - dt1).days
-        if abs(imwidth) < width_of_stencil:  # for each valid interferogram that lands on the master image
-            # See if there is a pair in the stack. Does it exist?
-
-            item_potential_match = dt.datetime.strftime(dt2 + dt.timedelta(days=abs(imwidth)), "%Y%j")
-            item_potential_pair = image2 + '_' + item_potential_match
-
-            if item_potential_pair in containing:
-                pair1 = item
-                pair2 = item_potential_pair
-                # print("%s found matching %s" % (item_potential_pair, item))
-                index1 = date_pairs.index(pair1)
-                index2 = date_pairs.index(pair2)
-                pairlist.append([index1, index2])
-
-    # Debugging statements
-    for i in range(len(pairlist)):
-        index1 = pairlist[i][0]
-        intf1 = date_pairs[index1]
-        d1 = dt.datetime.strptime(intf1.split('_')[0], '%Y%j')
-        d2 = dt.datetime.strptime(intf1.split('_')[1], '%Y%j')
-        daydiff = abs(d1 - d2).days
-        print("---->" + intf1 + "      [%d days]" % daydiff)
-    for i in range(len(pairlist)):
-        index2 = pairlist[i][1]
-        intf2 = date_pairs[index2]
-        d1 = dt.datetime.strptime(intf2.split('_')[0], '%Y%j')
-        d2 = dt.datetime.strptime(intf2.split('_')[1], '%Y%j')
-        daydiff = abs(d1 - d2).days
-        print("     " + intf2 + "<---- [%d days]" % daydiff)
-
-    # print(pairlist)
-    # Example of pairlist: [[63,65],[62,66]],
-    # where numbers are indeces of paired interferograms used for APS construction
-
+    for index1 in ending_here:
+        imwidth = (dates_dt[given_date_index] - dates_dt[incidence["first"][index1]]).days
+        if abs(imwidth) < width_of_stencil:
+            item_potential_match = dt.datetime.strftime(dates_dt[given_date_index] + dt.timedelta(days=abs(imwidth)),
+                                                        "%Y%j")
+            if item_potential_match in starting_here:
+                pairlist.append([index1, starting_here[item_potential_match]])
+
+    for index1, index2 in pairlist:   # Debugging statements
+        print("---->" + date_pairs[index1] + "   " + date_pairs[index2] + "<----")
     return pairlist
 
 
@@ -161,22 +143,27 @@ def remove_aps(data_all, APS, date_pairs, dates):
     # In this function, you start with a set of interferograms (3D array), and correct it for a stack of APS.
     # data_all: 3D array [n_intfs, xpix, ypix]
     # APS : 3D array     [n_images, xpix, ypix]
-    # Return the updated interferograms.
+    # Return the updated interferograms, as a new float32 array.
 
     print("Correcting intf stack for APS")
-    zdim, rowdim, coldim = np.shape(data_all)
-    corrected_intfs = deepcopy(data_all)
-
-    # For each interferogram.
+    incidence = build_incidence_table(dates, date_pairs)
+    corrected_intfs = np.empty(np.shape(data_all), dtype=np.float32)
     for k in range(len(date_pairs)):
-        dates_in_intf = date_pairs[k].split('_')
-        ind1 = dates.index(dates_in_intf[0])
-        ind2 = dates.index(dates_in_intf[1])
-        dphi = APS[ind2][:][:] - APS[ind1][:][:]
+        dphi = APS[incidence["second"][k]] - APS[incidence["first"][k]]
+        np.subtract(data_all[k], dphi, out=corrected_intfs[k], casting='unsafe')
+    return corrected_intfs
 
-        corrected_intfs[k][:][:] = np.subtract(data_all[k][:][:], dphi)
 
-    return corrected_intfs
+def update_aps_in_place(corrected_intfs, data_all, APS_array, incidence, date_index, new_aps):
+    """
+    Change one date's APS, and re-correct only the interferograms touching that date, in place.
+    They are recomputed from the original data (not incremented) so nans and rounding don't accumulate.
+    """
+    APS_array[date_index] = new_aps
+    for k in incidence["touching"][date_index]:
+        dphi = APS_array[incidence["second"][k]] - APS_array[incidence["first"][k]]
+        np.subtract(data_all[k], dphi, out=corrected_intfs[k], casting='unsafe')
+    return
 
 
 def remove_reference_pixel(data_all, rowref, colref):
@@ -189,20 +176,8 @@ def compute_ANC(APS_array):
     # APS_array = 3D array of numeric values
     # A scaled RMS of the atmospheric phase screen.
     print("Computing ANC from APS_array.")
-    ANC_array = []
     nsar = np.shape(APS_array)[0]
-    for i in range(nsar):
-        myaps1d = []
-        myaps = APS_array[i][:][:]
-        for j in range(np.shape(myaps)[0]):
-            for k in range(np.shape(myaps)[1]):
-                if ~np.isnan(myaps[j][k]):
-                    myaps1d.append(myaps[j][k])
-        abar = np.mean(myaps1d)
-        res_sq_array = [(a - abar) * (a - abar) for a in myaps1d]
-        M = len(myaps1d)
-        ANC = np.sqrt((1.0 / M) * np.sum(res_sq_array))
-        ANC_array.append(ANC)
+    ANC_array = np.nanstd(np.reshape(APS_array, (nsar, -1)), axis=1)
     maxANC = np.max(ANC_array)
     ANC_array = [10 * (1.0 / maxANC) * i for i in ANC_array]  # a normalization factor.
     return ANC_array
@@ -223,68 +198,64 @@ def get_initial_ANC(dates, date_pairs, data_all, width_of_stencil):
     return ANC_array
 
 
-def calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array):
+def calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array, n_workers=1, tile_rows=256):
+    """
+    One pass of common scene stacking through the dates, in order of decreasing ANC.
+    Each pixel's APS is independent of the others, so the frame can be split into tiles of rows
+    and processed in parallel if n_workers > 1.
+    """
     zdim, rowdim, coldim = np.shape(data_all)
-    APS_array = np.zeros((len(dates), rowdim, coldim))
-
-    ordered_ANCs = [x for x, _ in sorted(zip(ANC_array, dates), reverse=True)]
-    ordered_dates = [x for _, x in sorted(zip(ANC_array, dates), reverse=True)]
-
-    # EACH DAY IN ORDERED ANC.  This loop is "Calculate_aps_linear.m"
+    incidence = build_incidence_table(dates, date_pairs)
+    ordered = sorted(zip(ANC_array, dates), reverse=True)
+    ordered_dates = [x for _, x in ordered]
+    pairlists = []
     for j in range(len(ordered_dates)):
-
-        given_date = ordered_dates[j]  # THIS IS THE KEY
-        print("Solving APS for day %s with ANC %f " % (given_date, ordered_ANCs[j]))
-        given_date_index = dates.index(given_date)
-        print("Given date index: %d" % given_date_index)
-
+        given_date_index = dates.index(ordered_dates[j])
+        print("Solving APS for day %s with ANC %f " % (ordered_dates[j], ordered[j][0]))
         # A list of valid interferogram pairs by index in the stack, which we use for making APS
-        pairlist = form_APS_pairs(date_pairs, given_date, width_of_stencil)
+        pairlist = form_APS_pairs(date_pairs, dates, incidence, given_date_index, width_of_stencil)
         if len(pairlist) == 0:
-            print("ERROR! No valid APS stencils were detected in the stack for image %s" % given_date)
-            continue
+            print("ERROR! No valid APS stencils were detected in the stack for image %s" % ordered_dates[j])
+        pairlists.append((given_date_index, pairlist))
+
+    tiles = [(data_all[:, r0:min(r0 + tile_rows, rowdim), :], incidence, pairlists, len(dates))
+             for r0 in range(0, rowdim, tile_rows)]
+    if n_workers > 1:
+        with mp.Pool(n_workers) as pool:
+            APS_tiles = pool.map(calculate_aps_tile, tiles)
+    else:
+        APS_tiles = [calculate_aps_tile(tile) for tile in tiles]
+    return np.concatenate(APS_tiles, axis=1)
 
-        # Set the current day's APS to zero, because we're going to solve for it.
-        APS_array[given_date_index][:][:] = np.zeros((rowdim, coldim))
 
-        # Fix interferograms
-        los_out_new = remove_aps(data_all, APS_array, date_pairs, dates)
+def calculate_aps_tile(tile_args):
+    """
+    APS for one block of pixels. Keeps one float32 working copy of the interferograms, consistent with the
+    current APS, and updates only the interferograms that touch each date as that date's APS changes.
+    """
+    data_tile, incidence, pairlists, n_dates = tile_args
+    corrected_intfs = np.array(data_tile, dtype=np.float32)
+    APS_array = np.zeros((n_dates,) + np.shape(data_tile)[1:], dtype=np.float32)
 
-        # Compute the APS for given date date
+    # EACH DAY IN ORDERED ANC.  This loop is "Calculate_aps_linear.m"
+    for given_date_index, pairlist in pairlists:
+        if len(pairlist) == 0:
+            continue
+        # Set the current day's APS to zero, because we're going to solve for it, and fix interferograms
+        update_aps_in_place(corrected_intfs, data_tile, APS_array, incidence, given_date_index, 0)
+
+        # Implement the APS Equation in Tymofyeyeva and Fialko, 2015, using the updated interferograms
         indx1 = np.array([i[0] for i in pairlist])
         indx2 = np.array([i[1] for i in pairlist])
-        nforward = len(indx1)
-        nbackward = len(indx2)
-
-        los_backward = los_out_new[indx1][:][:]
-        los_forward = -los_out_new[indx2][:][:]  # Use the updated interferograms
-        los_backward_total = np.zeros((rowdim, coldim))
-        los_forward_total = np.zeros((rowdim, coldim))
-        for i in range(nforward):
-            los_forward_total = np.add(los_forward_total, los_forward[i][:][:])
-        for i in range(nbackward):
-            los_backward_total = np.add(los_backward_total, los_backward[i][:][:])
-
-        # Implement the APS Equation in Tymofyeyeva and Fialko, 2015.
-        my_aps = np.zeros((rowdim, coldim))
-        if (nforward + nbackward) > 0:
-            my_aps = np.add(los_backward_total, los_forward_total)
-            my_aps = np.divide(my_aps, (nbackward + nforward))
-        # Looks like the issue is between line 292 and here.
-        else:
-            my_aps = np.zeros((rowdim, coldim))
+        my_aps = (np.sum(corrected_intfs[indx1], axis=0) - np.sum(corrected_intfs[indx2], axis=0))
+        my_aps = my_aps / (len(indx1) + len(indx2))
 
         # Update the APS array.
-        APS_array[given_date_index][:][:] = deepcopy(my_aps)
-
-    # print(given_date)
-    # print(np.nanmin(APS_array[given_date_index][:][:]))
-    # print(np.nanmax(APS_array[given_date_index][:][:]))
-
+        update_aps_in_place(corrected_intfs, data_tile, APS_array, incidence, given_date_index, my_aps)
     return APS_array
 
 
-def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter, rowref, colref):
+def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter, rowref, colref, n_workers=1):
     # Automated selection of dates and interferograms for APS construction. Pseudocode:
     # Produce ANCs from the original data, without altering the interferograms.
     # Iterate several complete times throughout the stack of APS
@@ -300,7 +271,7 @@ def compute(xdata, ydata, data_all, dates, date_pairs, width_of_stencil, n_iter,
     for i in range(1, n_iter + 1):
         print("######## Beginning iteration %d #########" % i)
 
-        APS_array = calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array)
+        APS_array = calculate_aps_linear(data_all, dates, date_pairs, width_of_stencil, ANC_array, n_workers)
         ANC_array = compute_ANC(APS_array)  # compute ANCs with the updated APS stack.
 
         make_APS_plot(APS_array, dates, 'pythonIT' + str(i))
@@ -20,15 +20,26 @@ from . import unwrapping_isce_custom
 
 # ------------ UTILITY FUNCTIONS -------------- #
 
-def cut_resampled_grid(outdir, filename, variable, config_params):
+def cut_resampled_grid(outdir, filename, variable, config_params, region=None):
     # This is for metadata like lon, lat, and lookvector
     # Given an isce file and a set of bounds to cut the file,
     # Produce the isce data and gmtsar netcdf that match each pixel.
+    # With an area of interest (a region from stacking_tools/aoi.py, in rows and cols of the cut interferograms),
+    # the cut grid is cropped to its window, and is nan outside its mask, to match a time series made on the area
+    # of interest.
     _, _, temp = isce_read_write.read_scalar_data(os.path.join(outdir, filename))
     print("Shape of the " + variable + " file: ", np.shape(temp))
     xbounds = [float(config_params.xbounds.split(',')[0]), float(config_params.xbounds.split(',')[1])]
     ybounds = [float(config_params.ybounds.split(',')[0]), float(config_params.ybounds.split(',')[1])]
     cut_grid = unwrapping_isce_custom.cut_grid(temp, xbounds, ybounds, fractional=True, buffer_rows=3)
+    if region is not None:
+        (r0, r1), (c0, c1) = region.rows, region.cols
+        if r1 > np.shape(cut_grid)[0] or c1 > np.shape(cut_grid)[1]:
+            raise ValueError("Area of interest (rows %d-%d, cols %d-%d) is outside the cut %s grid of shape %s" %
+                             (r0, r1, c0, c1, variable, str(np.shape(cut_grid))))
+        cut_grid = cut_grid[r0:r1, c0:c1]
+        if region.mask is not None:
+            cut_grid = np.where(region.mask, cut_grid, np.nan)
     print("Shape of the cut lon file: ", np.shape(cut_grid))
     nx = np.shape(cut_grid)[1]
     ny = np.shape(cut_grid)[0]
@@ -63,10 +74,10 @@ def gmtsar_nc_stack_2_isce_stack(ts_file, output_dir, bands=2):
     return
 
 
-def geocode_UAVSAR_stack(config_params, geocoded_folder):
+def geocode_UAVSAR_stack(config_params, geocoded_folder, region=None):
     # The goals here for UAVSAR:
     # Load lon/lat grids and look vector grids
-    # Resample and cut the grids appropriately
+    # Resample and cut the grids appropriately (to the area of interest, if there is a region)
     # Write pixel-wise metadata out in the output folder
     # All these grids have only single band.
     os.makedirs(geocoded_folder, exist_ok=True)
@@ -137,10 +148,10 @@ def geocode_UAVSAR_stack(config_params, geocoded_folder):
 
     # Cut the data, and quality check.
     # Writing the cut lon/lat into new files.
-    cut_resampled_grid(geocoded_folder, "lon_igram_res.tif", "lon", config_params)
-    cut_resampled_grid(geocoded_folder, "lat_igram_res.tif", "lat", config_params)
-    cut_resampled_grid(geocoded_folder, "incidence_igram_res.tif", "incidence", config_params)
-    cut_resampled_grid(geocoded_folder, "azimuth_igram_res.tif", "azimuth", config_params)
+    cut_resampled_grid(geocoded_folder, "lon_igram_res.tif", "lon", config_params, region)
+    cut_resampled_grid(geocoded_folder, "lat_igram_res.tif", "lat", config_params, region)
+    cut_resampled_grid(geocoded_folder, "incidence_igram_res.tif", "incidence", config_params, region)
+    cut_resampled_grid(geocoded_folder, "azimuth_igram_res.tif", "azimuth", config_params, region)
 
     isce_read_write.plot_scalar_data(os.path.join(geocoded_folder, 'cut_lat.gdal'),
                                      colormap='rainbow', aspect=1 / 4,
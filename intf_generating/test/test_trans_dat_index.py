@@ -0,0 +1,49 @@
+# Does the in-memory trans.dat index map coordinates back and forth?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+from .. import trans_dat_index
+
+
+def write_synthetic_trans_dat(filename):
+    """A tilted linear mapping between a range/azimuth grid and lon/lat."""
+    ra, az = np.meshgrid(np.arange(0, 2000, 20.0), np.arange(0, 1000, 10.0))
+    lon = -117.0 + 1e-4 * ra + 2e-5 * az
+    lat = 35.0 - 1e-5 * ra + 1e-4 * az
+    table = np.column_stack((ra.ravel(), az.ravel(), np.zeros(ra.size), lon.ravel(), lat.ravel()))
+    table.astype(np.float64).tofile(filename)
+    return
+
+
+class TransDatIndexTests(unittest.TestCase):
+
+    def test_round_trip_and_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trans_dat = os.path.join(tmpdir, "trans.dat")
+            write_synthetic_trans_dat(trans_dat)
+            index = trans_dat_index.load_index(trans_dat)
+            self.assertTrue(os.path.isfile(trans_dat_index.get_cache_file(trans_dat)))
+            cached_index = trans_dat_index.load_index(trans_dat)
+            np.testing.assert_array_equal(cached_index.lon, index.lon)
+
+        ra, az = np.array([500.0, 1234.5, 1800.0]), np.array([200.0, 555.5, 900.0])
+        lon, lat = trans_dat_index.ra_to_ll(index, ra, az)
+        np.testing.assert_allclose(lon, -117.0 + 1e-4 * ra + 2e-5 * az, atol=1e-6)
+        ra1, az1 = trans_dat_index.ll_to_ra(index, lon, lat)
+        np.testing.assert_allclose(ra1, ra, atol=1.0)
+        np.testing.assert_allclose(az1, az, atol=1.0)
+
+        ra_far, _ = trans_dat_index.ll_to_ra(index, [-110.0], [40.0])
+        self.assertTrue(np.isnan(ra_far[0]))
+
+    def test_row_col(self):
+        rows, cols = trans_dat_index.ra_to_row_col(np.arange(0, 100, 10.0), np.arange(0, 50, 5.0),
+                                                   [21.0, 500.0, np.nan], [12.0, 3.0, 3.0])
+        np.testing.assert_array_equal(rows, [2, -1, -1])
+        np.testing.assert_array_equal(cols, [2, -1, -1])
+
+
+if __name__ == "__main__":
+    unittest.main()
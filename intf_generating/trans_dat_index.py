@@ -0,0 +1,158 @@
+"""
+An in-memory geocoding index built from GMTSAR's trans.dat.
+trans.dat is a binary table of doubles with five columns: range, azimuth, topo, lon, lat.
+We read it once, build KD-trees in both directions, and answer batches of queries
+lon/lat -> range/azimuth (-> row/col of a radar-coordinate grid) and range/azimuth -> lon/lat
+without calling GMT. The arrays can be cached as an .npz file next to trans.dat.
+"""
+
+import numpy as np
+import collections
+import os
+from scipy.spatial import cKDTree
+from Tectonic_Utils.read_write import netcdf_read_write
+
+trans_index = collections.namedtuple('trans_index', ['ra', 'az', 'lon', 'lat', 'll_tree', 'ra_tree', 'lon_scale',
+                                                     'll_spacing', 'ra_spacing'])
+
+
+# ------------ BUILDING THE INDEX ------------ #
+
+def read_trans_dat(trans_dat):
+    """ Read GMTSAR trans.dat (binary, 5 doubles per row). Returns ra, az, lon, lat as 1D arrays. """
+    table = np.fromfile(trans_dat, dtype=np.float64).reshape(-1, 5)
+    good = np.all(np.isfinite(table), axis=1)
+    return table[good, 0], table[good, 1], table[good, 3], table[good, 4]
+
+
+def get_cache_file(trans_dat):
+    return trans_dat + '.index.npz'
+
+
+def write_index_cache(cache_file, ra, az, lon, lat):
+    print("Writing geocoding index cache %s " % cache_file)
+    np.savez(cache_file, ra=ra, az=az, lon=lon, lat=lat)
+    return
+
+
+def read_index_cache(cache_file):
+    with np.load(cache_file) as arrays:
+        return arrays['ra'], arrays['az'], arrays['lon'], arrays['lat']
+
+
+def build_index(ra, az, lon, lat):
+    """
+    Build the KD-trees. Longitudes are scaled by cos(mean lat) so distances in the lon/lat tree are ~isotropic.
+    The median nearest-neighbor spacing in each tree is kept for deciding when a query is off the edge of the data.
+    """
+    lon_scale = np.cos(np.radians(np.nanmean(lat)))
+    ll_tree = cKDTree(np.column_stack((lon * lon_scale, lat)), balanced_tree=False)
+    ra_tree = cKDTree(np.column_stack((ra, az)), balanced_tree=False)
+    ll_spacing = get_median_spacing(ll_tree)
+    ra_spacing = get_median_spacing(ra_tree)
+    return trans_index(ra=ra, az=az, lon=lon, lat=lat, ll_tree=ll_tree, ra_tree=ra_tree, lon_scale=lon_scale,
+                       ll_spacing=ll_spacing, ra_spacing=ra_spacing)
+
+
+def get_median_spacing(tree, n_samples=1000):
+    """ Median distance between neighboring points, from a sample of the points in the tree. """
+    sample = tree.data[np.linspace(0, tree.n - 1, min(n_samples, tree.n)).astype(int)]
+    distances, _ = tree.query(sample, k=2)
+    return np.median(distances[:, 1])
+
+
+def load_index(trans_dat, use_cache=True):
+    """
+    Read the geocoding index for a trans.dat file.
+    If use_cache, the arrays are read from (or written to) an .npz file next to trans.dat.
+    The cache is ignored if trans.dat has changed since it was written.
+    """
+    cache_file = get_cache_file(trans_dat)
+    if use_cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(trans_dat):
+        print("Reading geocoding index cache %s " % cache_file)
+        ra, az, lon, lat = read_index_cache(cache_file)
+    else:
+        print("Reading %s into geocoding index " % trans_dat)
+        ra, az, lon, lat = read_trans_dat(trans_dat)
+        if use_cache:
+            write_index_cache(cache_file, ra, az, lon, lat)
+    return build_index(ra, az, lon, lat)
+
+
+# ------------ QUERIES ------------ #
+
+def interpolate_from_tree(tree, query_points, values, max_distance, k=6):
+    """
+    Fit a local plane to the k nearest neighbors of each query point and evaluate it there.
+    Where the neighbors can't support a plane (e.g., all in a line), fall back to inverse-distance weighting.
+    values: list of 1D arrays, one per output quantity.
+    Points further than max_distance from the data come back as nan.
+    Returns a list of 1D arrays, one per output quantity.
+    """
+    query_points = np.asarray(query_points, dtype=float)
+    n, k = len(query_points), min(k, tree.n)
+    distances, idx = tree.query(query_points, k=k)
+    distances, idx = np.reshape(distances, (n, k)), np.reshape(idx, (n, k))
+    outside = ~(distances[:, 0] <= max_distance)
+    idx[outside] = 0
+
+    # Local plane value = a + b*dx + c*dy, with dx, dy relative to the query point, so the answer is a.
+    offsets = tree.data[idx] - query_points[:, None, :]   # (n, k, 2)
+    offsets[outside] = 0
+    design = np.concatenate((np.ones((n, k, 1)), offsets / max(max_distance, 1e-12)), axis=2)
+    normal_matrix = np.einsum('nki,nkj->nij', design, design)
+    planar = (k >= 3) & (np.abs(np.linalg.det(normal_matrix)) > 1e-9)
+
+    weights = 1 / np.maximum(distances, 1e-12)
+    weights = weights / np.sum(weights, axis=1)[:, None]
+    results = []
+    for value in values:
+        result = np.sum(weights * value[idx], axis=1)
+        if np.any(planar):
+            rhs = np.einsum('nki,nk->ni', design[planar], value[idx[planar]])
+            result[planar] = np.linalg.solve(normal_matrix[planar], rhs[..., None])[:, 0, 0]
+        result[outside] = np.nan
+        results.append(result)
+    return results
+
+
+def ll_to_ra(index, lon, lat, max_spacings=3):
+    """ Batched lon/lat -> range/azimuth. Returns arrays; nan for points outside of trans.dat coverage. """
+    lon, lat = np.atleast_1d(lon).astype(float), np.atleast_1d(lat).astype(float)
+    query = np.column_stack((lon * index.lon_scale, lat))
+    ra, az = interpolate_from_tree(index.ll_tree, query, [index.ra, index.az], max_spacings * index.ll_spacing)
+    return ra, az
+
+
+def ra_to_ll(index, ra, az, max_spacings=3):
+    """ Batched range/azimuth -> lon/lat. Returns arrays; nan for points outside of trans.dat coverage. """
+    ra, az = np.atleast_1d(ra).astype(float), np.atleast_1d(az).astype(float)
+    query = np.column_stack((ra, az))
+    lon, lat = interpolate_from_tree(index.ra_tree, query, [index.lon, index.lat], max_spacings * index.ra_spacing)
+    return lon, lat
+
+
+def ra_to_row_col(xdata, ydata, ra, az):
+    """
+    Nearest row and col of a radar-coordinate grid (xdata is range, ydata is azimuth) for arrays of ra/az.
+    Points off the grid, or nan, get row = col = -1.
+    """
+    ra, az = np.atleast_1d(ra), np.atleast_1d(az)
+    xdata, ydata = np.asarray(xdata), np.asarray(ydata)
+    rows, cols = -1 * np.ones(len(ra), dtype=int), -1 * np.ones(len(ra), dtype=int)
+    inside = (np.nanmin(xdata) <= ra) & (ra <= np.nanmax(xdata)) & (np.nanmin(ydata) <= az) & (az <= np.nanmax(ydata))
+    cols[inside] = np.abs(xdata[None, :] - ra[inside][:, None]).argmin(axis=1)  # xdata is columns
+    rows[inside] = np.abs(ydata[None, :] - az[inside][:, None]).argmin(axis=1)  # ydata is rows
+    return rows, cols
+
+
+def ll_to_ra_row_col(index, example_grd, lon, lat):
+    """
+    Batched lon/lat -> (ra, az, row, col) in the radar-coordinate grid example_grd.
+    Points outside of the grid's range/azimuth box have ra = az = nan and row = col = -1.
+    """
+    [xdata, ydata] = netcdf_read_write.read_netcdf4(example_grd)[0:2]
+    ra, az = ll_to_ra(index, lon, lat)
+    rows, cols = ra_to_row_col(xdata, ydata, ra, az)
+    ra[rows == -1], az[rows == -1] = np.nan, np.nan
+    return ra, az, rows, cols
@@ -4,7 +4,6 @@ A set of functions that read and write vrt gdal grid files compatible with ISCE.
 
 import numpy as np
 import matplotlib.pyplot as plt
-import struct
 
 
 # ----------- READING FUNCTIONS ------------- #
@@ -37,23 +36,30 @@ def read_complex_data(GDALfilename):
     return slc
 
 
-def read_scalar_data(GDALfilename, band=1, flush_zeros=True):
+def read_scalar_data(GDALfilename, band=1, flush_zeros=True, window=None):
     """
     Read an isce data file.
     band = 1 for most scalar fields, like coherence.
     band = 2 for some unwrapped phase files.
+    window = ((row_start, row_end), (col_start, col_end)) reads only that part of the raster from disk.
     """
     from osgeo import gdal  # GDAL support for reading virtual files
     print("Reading file %s " % GDALfilename)
     if ".unw" in GDALfilename and ".unw." not in GDALfilename and band == 1:
         print("WARNING: We usually read band=2 for snaphu unwrapped files. Are you sure you want band 1 ????")
     ds = gdal.Open(GDALfilename, gdal.GA_ReadOnly)
-    data = ds.GetRasterBand(band).ReadAsArray()
+    if window is None:
+        data = ds.GetRasterBand(band).ReadAsArray()
+    else:
+        (r0, r1), (c0, c1) = window
+        data = ds.GetRasterBand(band).ReadAsArray(c0, r0, c1 - c0, r1 - r0)
     transform = ds.GetGeoTransform()
     ds = None
 
     _xmin, _xmax, _ymin, _ymax = get_xmin_xmax_xinc_from_geotransform(transform, data)
     xarray, yarray = read_isce_1d_arrays(GDALfilename)
+    if window is not None:
+        xarray, yarray = xarray[c0:c1], yarray[r0:r1]
 
     # put all zero values to nan
     if flush_zeros:
@@ -83,31 +89,58 @@ def read_amplitude_data(GDALfilename):
     return amparray
 
 
-def read_scalar_data_no_isce(filename, nx, ny):
-    """ Take float32 numbers from binary file into 2d array """
-    final_shape = (ny, nx)
-    num_data = nx * ny
+def get_interleaved_shape(nx, ny, n_bands, scheme):
+    """ Shape of a raw raster on disk: BSQ is band-row-col, BIL is row-band-col, BIP is row-col-band. """
+    shapes = {'BSQ': (n_bands, ny, nx), 'BIL': (ny, n_bands, nx), 'BIP': (ny, nx, n_bands)}
+    if scheme.upper() not in shapes.keys():
+        raise ValueError("Unknown interleaving scheme %s; expected BSQ, BIL, or BIP" % scheme)
+    return shapes[scheme.upper()]
+
+
+def to_band_first(raster, scheme):
+    """ Strided view of an interleaved raster with shape (n_bands, ny, nx). No data is copied. """
+    axes = {'BSQ': (0, 1, 2), 'BIL': (1, 0, 2), 'BIP': (2, 0, 1)}
+    return np.transpose(raster, axes[scheme.upper()])
+
+
+def read_binary_raster(filename, nx, ny, n_bands=1, scheme='BSQ', dtype=np.float32, rows=None):
+    """
+    Memory-map a raw binary raster (no header), such as ISCE or ROI_PAC images.
+    Use dtype=np.complex64 for complex files; the real/imag parts are then .real and .imag views.
+
+    :param rows: optional (r0, r1) window of rows; only those rows are paged in from disk.
+    :returns: read-only view with shape (n_bands, nrows, nx). Take np.array() of it for an in-memory copy.
+    """
+    shape = get_interleaved_shape(nx, ny, n_bands, scheme)
+    raster = to_band_first(np.memmap(filename, dtype=dtype, mode='r', shape=shape), scheme)
+    if rows is not None:
+        raster = raster[:, rows[0]:rows[1], :]
+    return raster
+
+
+def write_binary_raster(filename, bands, scheme='BSQ', dtype=np.float32):
+    """
+    Write a list of 2D bands of the same shape into a raw binary raster with the given interleaving.
+    Vectorized replacement for packing values one at a time.
+    """
+    stack = np.asarray(bands, dtype=dtype)   # (n_bands, ny, nx)
+    axes = {'BSQ': (0, 1, 2), 'BIL': (1, 0, 2), 'BIP': (1, 2, 0)}
+    np.ascontiguousarray(np.transpose(stack, axes[scheme.upper()])).tofile(filename)
+    return
+
+
+def read_scalar_data_no_isce(filename, nx, ny, rows=None):
+    """ Take float32 numbers from binary file into 2d array. rows=(r0, r1) reads only a window of rows. """
     print("Reading file %s into %d x %d array" % (filename, ny, nx))
-    f = open(filename, 'rb')
-    rawnum = f.read()
-    f.close()
-    floats = np.array(struct.unpack('f' * num_data, rawnum))
-    scalar_field = floats.reshape(final_shape)
+    scalar_field = np.array(read_binary_raster(filename, nx, ny, rows=rows)[0])
     return scalar_field
 
 
-def read_phase_data_no_isce(filename, nx, ny):
-    final_shape = (ny, nx)
-    num_data = nx * ny * 2
+def read_phase_data_no_isce(filename, nx, ny, rows=None):
+    """ Phase of a complex64 binary file, as a 2d array. rows=(r0, r1) reads only a window of rows. """
     print("Reading file %s into %d x %d array" % (filename, ny, nx))
-    f = open(filename, 'rb')
-    rawnum = f.read()
-    floats = np.array(struct.unpack('f' * num_data, rawnum))
-    f.close()
-    real = floats[::2]
-    imag = floats[1::2]
-    phase = np.arctan2(imag, real)
-    phase = phase.reshape(final_shape)
+    slc = read_binary_raster(filename, nx, ny, dtype=np.complex64, rows=rows)[0]
+    phase = np.arctan2(slc.imag, slc.real)
     return phase
 
 
@@ -117,8 +150,7 @@ def read_isce_unw_geo(filename):
     Return x and y axes too, in lon/lat
     """
     firstLon, firstLat, dE, dN, _, _, nlon, nlat = get_xmin_xmax_xinc_from_xml(filename+'.xml')
-    twox_data = read_scalar_data_no_isce(filename, nlon, nlat*2)   # separate the unw phase layer
-    unw_data = twox_data[nlat:, :]   # unw_phase is the second layer
+    unw_data = np.array(read_binary_raster(filename, nlon, nlat, n_bands=2, scheme='BSQ')[1])  # unw_phase layer
     (y, x) = np.shape(unw_data)
     xarray, yarray = get_xarray_yarray_from_shape(firstLon, firstLat, dE, dN, x, y)
     return xarray, yarray, unw_data
@@ -144,9 +176,7 @@ def read_isce_unw_geo_alternative(filename):
     Return x and y axes too, in lon/lat
     """
     firstLon, firstLat, dE, dN, _, _, nlon, nlat = get_xmin_xmax_xinc_from_xml(filename+'.xml')
-    twox_data = read_scalar_data_no_isce(filename, nlon*2, nlat)   # separate the unw phase layer
-    unw_data = twox_data[:, 0:nlon]   # unw_phase is the second layer
-    unw_data = twox_data[:, nlon:]   # unw_phase is the second layer
+    unw_data = np.array(read_binary_raster(filename, nlon, nlat, n_bands=2, scheme='BIL')[1])  # unw_phase layer
 
     (y, x) = np.shape(unw_data)
     xarray, yarray = get_xarray_yarray_from_shape(firstLon, firstLat, dE, dN, x, y)
@@ -223,10 +253,7 @@ def write_isce_unw(data1, data2, nx, ny, dtype, filename,
 
 
 def data_to_file_2_bands(data1, data2, filename):
-    data1 = np.float32(data1)  # we should be consistent about float types here.
-    data2 = np.float32(data2)
-    data = np.hstack((data1, data2))  # establishing two bands
-    data.tofile(filename)
+    write_binary_raster(filename, [data1, data2], scheme='BIL')  # establishing two bands, float32
     return
 
 
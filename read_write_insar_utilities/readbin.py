@@ -1,49 +1,38 @@
 #!usr/bin/env python
 
 import numpy as np
+import os
 import matplotlib.pyplot as plt
-import math
-import struct
 from ..math_tools import phase_math
+from . import isce_read_write
 from Tectonic_Utils.read_write.netcdf_read_write import read_any_grd
 
 
-def read_binary_roipac_real_imag(filename):
+def read_binary_roipac_real_imag(filename, width=None, rows=None):
     """
     Reads a binary file that expects two fields (such as real and imaginary)
-    Returns one-dimensional arrays.
+    Returns one-dimensional arrays (float32 views of the complex64 data).
+    With width and rows=(r0, r1), only that window of rows is read.
     """
-    with open(filename, mode='rb') as file:  # b is important -> binary
-        fileContent = file.read()
-    data = struct.unpack("f" * (len(fileContent) // 4), fileContent)
-    print(type(fileContent))
-    print("data has %d floats" % (len(data) / 2))
-
-    real, imag = [], []
-    for x in range(len(data)):
-        if np.mod(x, 2) == 0:
-            real.append(data[x])
-        else:
-            imag.append(data[x])
-    return [real, imag]
-
-
-def read_binary_topo(filename, width):
+    if rows is None:
+        data = np.fromfile(filename, dtype=np.complex64)
+    else:
+        length = os.path.getsize(filename) // (8 * width)
+        data = np.array(isce_read_write.read_binary_raster(filename, width, length, dtype=np.complex64,
+                                                           rows=rows)).ravel()
+    print("data has %d floats" % len(data))
+    return [data.real, data.imag]
+
+
+def read_binary_topo(filename, width, rows=None):
     """
     Reads a topo file and returns 1d arrays for topography and some other quantity.
+    The two quantities are interleaved by line (BIL). With rows=(r0, r1), only that window of rows is read.
     """
-    with open(filename, mode='rb') as file:  # b is important -> binary
-        fileContent = file.read()
-    data = struct.unpack("f" * (len(fileContent) // 4), fileContent)
-    num_per_array = int(len(data) / 2)
-    print("data has %d floats" % num_per_array)
-
-    topo1, topo2 = [], []
-    for x in range(len(data)):
-        if np.mod(x, 2 * width) < width:  # topography is organized a different way.
-            topo1.append(data[x])
-        else:
-            topo2.append(data[x])
+    length = os.path.getsize(filename) // (4 * 2 * width)
+    bands = np.array(isce_read_write.read_binary_raster(filename, width, length, n_bands=2, scheme='BIL', rows=rows))
+    topo1, topo2 = bands[0].ravel(), bands[1].ravel()
+    print("data has %d floats" % len(topo1))
 
     print("max of topo1 is %d" % (np.nanmax(topo1)))
     print("min of topo1 is %d" % (np.nanmin(topo1)))
@@ -52,40 +41,22 @@ def read_binary_topo(filename, width):
     return [topo1, topo2]
 
 
-# Functions I will write tomorrow. 
 def write_binary_roipac_real_imag(filename, real, imag):
     # Takes 1D arrays and writes the 1D binary file.
-    total_struct = []
-    for i in range(len(real)):
-        if not math.isnan(real[i]):  # Removing bad nans from the stack.
-            total_struct.append(real[i])
-        else:
-            total_struct.append(0.0)
-        if not math.isnan(imag[i]):
-            total_struct.append(imag[i])
-        else:
-            total_struct.append(0.0)
-    data = struct.pack("f" * len(real) * 2, *total_struct)
-    print("Packing %d real and imaginary numbers into binary file %s " % (len(total_struct) / 2, filename))
-    with open(filename, mode='wb') as file:
-        file.write(data)
+    data = np.empty(len(real), dtype=np.complex64)
+    data.real = np.nan_to_num(np.asarray(real, dtype=np.float32), nan=0.0)  # Removing bad nans from the stack.
+    data.imag = np.nan_to_num(np.asarray(imag, dtype=np.float32), nan=0.0)
+    print("Packing %d real and imaginary numbers into binary file %s " % (len(data), filename))
+    data.tofile(filename)
     return
 
 
 def write_binary_topo(filename, topo1, topo2, width):
     # Takes 1D array and writes the 1D binary file.
-    total_struct = []
-    for i in range(len(topo1)):
-        if np.mod(i, width) == 0:
-            for j in range(i, i + width):
-                total_struct.append(topo1[j])
-            for j in range(i, i + width):
-                total_struct.append(topo2[j])
-
-    data = struct.pack("f" * len(topo2) * 2, *total_struct)
-    print("Packing %d topo numbers into binary file %s " % (len(total_struct) / 2, filename))
-    with open(filename, mode='wb') as file:
-        file.write(data)
+    topo1 = np.reshape(topo1, (-1, width))
+    topo2 = np.reshape(topo2, (-1, width))
+    print("Packing %d topo numbers into binary file %s " % (np.size(topo1), filename))
+    isce_read_write.write_binary_raster(filename, [topo1, topo2], scheme='BIL')
     return
 
 
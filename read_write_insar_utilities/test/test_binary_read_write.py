@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+# Do the raw binary readers and writers give back the same data, for each interleaving scheme?
+
+from .. import isce_read_write, readbin
+
+
+class BinaryRasterTests(unittest.TestCase):
+
+    def test_interleaving_round_trip(self):
+        bands = np.arange(2 * 5 * 4, dtype=np.float32).reshape(2, 5, 4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'raster.bin')
+            for scheme in ['BSQ', 'BIL', 'BIP']:
+                isce_read_write.write_binary_raster(filename, bands, scheme=scheme)
+                raster = isce_read_write.read_binary_raster(filename, 4, 5, n_bands=2, scheme=scheme)
+                np.testing.assert_array_equal(raster, bands)
+                window = isce_read_write.read_binary_raster(filename, 4, 5, n_bands=2, scheme=scheme, rows=(1, 3))
+                np.testing.assert_array_equal(window, bands[:, 1:3, :])
+                del raster, window
+            # BIL with two bands is the same as two grids side by side
+            isce_read_write.data_to_file_2_bands(bands[0], bands[1], filename)
+            np.testing.assert_array_equal(np.fromfile(filename, dtype=np.float32).reshape(5, 8),
+                                          np.hstack((bands[0], bands[1])))
+
+    def test_roipac_real_imag_and_topo(self):
+        real = np.array([1.0, np.nan, 3.0, 4.0, 5.0, 6.0])
+        imag = np.array([0.5, 2.0, -1.0, np.nan, 0.0, 1.5])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'out.int')
+            readbin.write_binary_roipac_real_imag(filename, real, imag)
+            np.testing.assert_array_equal(np.fromfile(filename, dtype=np.float32),
+                                          [1.0, 0.5, 0.0, 2.0, 3.0, -1.0, 4.0, 0.0, 5.0, 0.0, 6.0, 1.5])
+            [real1, imag1] = readbin.read_binary_roipac_real_imag(filename)
+            np.testing.assert_array_equal(real1, np.nan_to_num(real))
+            [real2, _] = readbin.read_binary_roipac_real_imag(filename, width=2, rows=(1, 3))
+            np.testing.assert_array_equal(real2, [3.0, 4.0, 5.0, 6.0])
+            phase = isce_read_write.read_phase_data_no_isce(filename, 2, 3)
+            np.testing.assert_allclose(phase.ravel(), np.arctan2(np.nan_to_num(imag), np.nan_to_num(real)), atol=1e-6)
+
+            filename = os.path.join(tmpdir, 'topo.hgt')
+            topo1, topo2 = np.arange(6.0), 10 + np.arange(6.0)
+            readbin.write_binary_topo(filename, topo1, topo2, 3)
+            np.testing.assert_array_equal(np.fromfile(filename, dtype=np.float32), [0, 1, 2, 10, 11, 12,
+                                                                                    3, 4, 5, 13, 14, 15])
+            [topo1_read, topo2_read] = readbin.read_binary_topo(filename, 3)
+            np.testing.assert_array_equal(topo1_read, topo1)
+            np.testing.assert_array_equal(topo2_read, topo2)
+            [topo1_read, _] = readbin.read_binary_topo(filename, 3, rows=(1, 2))
+            np.testing.assert_array_equal(topo1_read, [3, 4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,13 +2,15 @@ import numpy as np
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from . import readmytupledata as rmd
-from . import stacking_utilities
+from . import stacking_utilities, aoi
 
 
-def drive_velocity_simple_stack(config_params, intf_files):
-    param_dict = get_simple_stack_params(config_params)
-    [_, _, signal_spread_data] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    intf_tuple = param_dict["reader"](intf_files)
+def drive_velocity_simple_stack(config_params, intf_files, region=None):
+    """ With a region (see aoi.py), only the area of interest is read and stacked """
+    param_dict = get_simple_stack_params(config_params, region)
+    intf_tuple = param_dict["reader"](intf_files, cube_file=rmd.get_cube_file(param_dict["cube_dir"], 'intf'),
+                                      region=region)
+    signal_spread_data = stacking_utilities.read_signal_spread(param_dict["signal_spread_filename"], intf_tuple)
     velocities, x, y = velocity_simple_stack(intf_tuple, param_dict["wavelength"], param_dict["rowref"],
                                              param_dict["colref"], signal_spread_data, 25)
     # last argument is signal threshold (< 100%).  lower signal threshold allows for more data into the stack.
@@ -17,10 +19,11 @@ def drive_velocity_simple_stack(config_params, intf_files):
     return
 
 
-def get_simple_stack_params(config_params):
-    """ repacking the parameter dictionary"""
+def get_simple_stack_params(config_params, region=None):
+    """ repacking the parameter dictionary. The reference pixel is moved into the area of interest, if any. """
     rowref = int(config_params.ref_idx.split('/')[0])
     colref = int(config_params.ref_idx.split('/')[1])
+    rowref, colref = aoi.shift_to_region(rowref, colref, region)
     if config_params.file_format == 'isce':  # Working with the file formats
         my_reader_function = rmd.reader_isce
     else:
@@ -28,47 +31,31 @@ def get_simple_stack_params(config_params):
     param_dictionary = {"wavelength": config_params.wavelength,
                         "rowref": rowref, "colref": colref, "outdir": str(config_params.ts_output_dir),
                         "signal_spread_filename": config_params.ts_output_dir+'/'+config_params.signal_spread_filename,
-                        "reader": my_reader_function}
+                        "reader": my_reader_function,
+                        "cube_dir": config_params.ts_output_dir if config_params.memmap_cube else None}
     return param_dictionary
 
 
-def pixel_velocity_by_stacking(phase_values, time_intervals, wavelength):
-    """The math behind the simple stack method. """
-    phase_count = 0
-    time_count = 0.0001  # we put a small number here to avoid div-by-zero during debugging.
-    for i in range(len(phase_values)):
-        if not np.isnan(phase_values[i]):
-            phase_count = phase_count + phase_values[i]
-            time_count = time_count + time_intervals[i]
-    velocity = (wavelength / (4 * np.pi)) * (phase_count / time_count)
-    return velocity
-
-
 def velocity_simple_stack(mytuple, wavelength, rowref, colref, signal_spread_data, signal_threshold):
     """This function takes in a list of files that contain arrays of phases and times. 
     It will compute the velocity of each pixel using the satellite's  wavelength. It will return 2D array of velocities.
     The final argument should be a number between 0 and 100 inclusive that tells the function which pixels
-    to exclude based on this signal percentage."""
+    to exclude based on this signal percentage.
+    Works through the cube in tiles of rows, so a memory-mapped cube is never loaded all at once."""
     print('Number of files being stacked: ' + str(len(mytuple.zvalues)))
     velocities = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)))
-    ref_pixel_values = mytuple.zvalues[:, rowref, colref]
+    ref_pixel_values = np.asarray(mytuple.zvalues[:, rowref, colref])
     stacking_utilities.check_clean_computation(rowref, colref, mytuple, signal_spread_data)
-    c = 0
+    time_intervals = np.asarray(mytuple.date_deltas)[:, None, None]
 
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F')  # iterate through the 3D array of data
-    while not it.finished:
-        i = it.multi_index[0]
-        j = it.multi_index[1]
-        signal_spread = signal_spread_data[i, j]
-        if signal_spread > signal_threshold:  # if we want a calculation for that day...
-            pixel_value = np.subtract(mytuple.zvalues[:, i, j], ref_pixel_values)
-            velocities[i, j] = pixel_velocity_by_stacking(pixel_value, mytuple.date_deltas, wavelength)
-        else:
-            velocities[i, j] = np.nan
-        c = c + 1
-        if np.mod(c, 10000) == 0:
-            print('Done with ' + str(c) + ' out of ' + str(len(mytuple.xvalues) * len(mytuple.yvalues)) + ' pixels')
-        it.iternext()
+    for r0, r1, block in rmd.cube_row_blocks(mytuple.zvalues):
+        phase_values = np.subtract(block, ref_pixel_values[:, None, None])
+        phase_count = np.nansum(phase_values, axis=0)
+        time_count = 0.0001 + np.sum(np.where(np.isnan(phase_values), 0, time_intervals), axis=0)  # avoid div-by-0
+        block_velocities = (wavelength / (4 * np.pi)) * (phase_count / time_count)
+        block_velocities[~(signal_spread_data[r0:r1, :] > signal_threshold)] = np.nan   # nan signal spread too
+        velocities[r0:r1, :] = block_velocities
+        print('Done with rows %d to %d out of %d' % (r0, r1, len(mytuple.yvalues)))
     return velocities, mytuple.xvalues, mytuple.yvalues
 
 
@@ -0,0 +1,206 @@
+"""
+Area-of-interest (AOI) subsetting for stacking.
+A region is a window of rows and columns of the full interferogram frame, and optionally a mask: the polygon,
+and the lon/lat box of aoi_bounds, which isn't a rectangle of rows and columns in radar coordinates.
+The readers only read the window of each grid, and put nan outside the mask, so every stage after reading
+(signal spread, reference pixel, inversions, outputs) works on the cropped grids and the subset axes.
+Rows and columns of a region are in the full frame, end-exclusive, like python slices.
+"""
+
+import numpy as np
+import collections
+import logging
+from netCDF4 import Dataset
+from s1_batches.intf_generating import get_ra_rc_from_ll, trans_dat_index
+from Tectonic_Utils.read_write import netcdf_read_write as rwr
+
+# rows: (r0, r1), cols: (c0, c1), mask: boolean (r1-r0, c1-c0) array, True inside the area, or None for the window
+region = collections.namedtuple('region', ['rows', 'cols', 'mask'])
+logger = logging.getLogger(__name__)
+
+
+def parse_aoi_window(aoi_window):
+    """ 'r0/r1/c0/c1' into ((r0, r1), (c0, c1)) """
+    r0, r1, c0, c1 = [int(x) for x in aoi_window.split('/')]
+    if r1 <= r0 or c1 <= c0:
+        raise ValueError("aoi_window %s is empty. Format: row_start/row_end/col_start/col_end" % aoi_window)
+    return (r0, r1), (c0, c1)
+
+
+def parse_aoi_bounds(aoi_bounds):
+    """ 'lonmin/lonmax/latmin/latmax' into the four corners of the box, as (lons, lats) """
+    lonmin, lonmax, latmin, latmax = [float(x) for x in aoi_bounds.split('/')]
+    return np.array([lonmin, lonmax, lonmax, lonmin]), np.array([latmin, latmin, latmax, latmax])
+
+
+def read_polygon_file(polygon_file):
+    """ A polygon as a text file of vertices, 'lon lat' on each line. Comments start with '#'. """
+    lons, lats = [], []
+    for line in open(polygon_file):
+        line = line.split('#')[0].split()
+        if len(line) >= 2:
+            lons.append(float(line[0]))
+            lats.append(float(line[1]))
+    if len(lons) < 3:
+        raise ValueError("Polygon file %s needs at least three vertices" % polygon_file)
+    return np.array(lons), np.array(lats)
+
+
+def get_grid_shape(example_file, file_format):
+    """ (ny, nx) of the full frame """
+    if file_format == 'isce':
+        from osgeo import gdal
+        ds = gdal.Open(example_file, gdal.GA_ReadOnly)
+        return ds.RasterYSize, ds.RasterXSize
+    xdata, ydata = read_grd_axes(example_file)
+    return len(ydata), len(xdata)
+
+
+def read_grd_axes(filename):
+    """ The x and y axes of a netcdf grid, without reading its data """
+    with Dataset(filename, 'r') as rootgrp:
+        if len(rootgrp.variables.keys()) != 3:   # gdal-style layout, with the axes as ranges
+            return rwr.read_netcdf4(filename)[0:2]
+        [xkey, ykey, _] = rwr.properly_parse_three_variables(*rootgrp.variables.keys())
+        return np.array(rootgrp.variables[xkey][:]), np.array(rootgrp.variables[ykey][:])
+
+
+def lonlat_to_row_col(lons, lats, example_file, geocoded_flag, file_format):
+    """
+    The nearest rows and cols of many points, looked up at once: on the axes of a geocoded grid,
+    or in the trans.dat index for radar coordinates. Points that can't be found are -1.
+    """
+    if file_format == 'isce':
+        raise ValueError("Lon/lat areas of interest need GMTSAR grids. For ISCE, use aoi_window with rows/cols.")
+    if geocoded_flag:
+        xdata, ydata = read_grd_axes(example_file)
+        xdata = np.where(xdata > 180, xdata - 360, xdata)   # -180 to 180, like the reference pixel
+        cols = np.argmin(np.abs(xdata[None, :] - np.asarray(lons)[:, None]), axis=1)
+        rows = np.argmin(np.abs(ydata[None, :] - np.asarray(lats)[:, None]), axis=1)
+        return rows, cols
+    index = get_ra_rc_from_ll.get_trans_index("merged/trans.dat")
+    _, _, rows, cols = trans_dat_index.ll_to_ra_row_col(index, example_file, np.asarray(lons), np.asarray(lats))
+    return np.asarray(rows), np.asarray(cols)
+
+
+def points_in_polygon(rows, cols, poly_rows, poly_cols):
+    """
+    Even-odd ray casting, vectorized over the points: True where (rows, cols) is inside the polygon.
+    Loops over the edges of the polygon only, so it's fast for millions of pixels.
+    """
+    rows, cols = np.asarray(rows, dtype=float), np.asarray(cols, dtype=float)
+    inside = np.zeros(np.shape(rows), dtype=bool)
+    n = len(poly_rows)
+    for i in range(n):
+        r_a, c_a = poly_rows[i], poly_cols[i]
+        r_b, c_b = poly_rows[(i + 1) % n], poly_cols[(i + 1) % n]
+        if r_a == r_b:
+            continue   # horizontal edges never cross a horizontal ray
+        crosses = (r_a > rows) != (r_b > rows)
+        c_cross = c_a + (rows - r_a) * (c_b - c_a) / (r_b - r_a)
+        inside ^= crosses & (cols < c_cross)
+    return inside
+
+
+def get_polygon_mask(rows, cols, poly_rows, poly_cols):
+    """ The mask of a window ((r0, r1), (c0, c1)) of pixels, for a polygon in full-frame rows and cols """
+    yy, xx = np.meshgrid(np.arange(rows[0], rows[1]), np.arange(cols[0], cols[1]), indexing='ij')
+    return points_in_polygon(yy, xx, poly_rows, poly_cols)
+
+
+def pad_box_corners(vertex_rows, vertex_cols):
+    """
+    Move the corners of a box half a pixel away from its middle. The corners are rounded to the nearest pixel, so
+    this keeps the pixels along the edges of the box (a rectangle of rows and columns on geocoded grids) inside it.
+    """
+    vertex_rows, vertex_cols = np.asarray(vertex_rows, dtype=float), np.asarray(vertex_cols, dtype=float)
+    return (vertex_rows + 0.5 * np.sign(vertex_rows - np.mean(vertex_rows)),
+            vertex_cols + 0.5 * np.sign(vertex_cols - np.mean(vertex_cols)))
+
+
+def get_region(aoi_window, aoi_bounds, aoi_polygon, example_file, geocoded_flag, file_format):
+    """
+    The region from the aoi config options, or None if they are all empty.
+    The window is the intersection of aoi_window, the box of aoi_bounds, and the bounding box of aoi_polygon,
+    clipped to the full frame of example_file. The mask is the intersection of the aoi_bounds box and the polygon,
+    or None if the window is all inside them.
+    """
+    if aoi_window == '' and aoi_bounds == '' and aoi_polygon == '':
+        return None
+    ny, nx = get_grid_shape(example_file, file_format)
+    rows, cols = (0, ny), (0, nx)
+    shapes = []   # (rows, cols) of the vertices of the areas to mask with
+    if aoi_window != '':
+        rows, cols = parse_aoi_window(aoi_window)
+    for (lons, lats), is_box in ([(parse_aoi_bounds(aoi_bounds), True)] if aoi_bounds != '' else []) + \
+                                ([(read_polygon_file(aoi_polygon), False)] if aoi_polygon != '' else []):
+        vertex_rows, vertex_cols = lonlat_to_row_col(lons, lats, example_file, geocoded_flag, file_format)
+        if np.any(vertex_rows < 0) or np.any(vertex_cols < 0):
+            raise ValueError("Part of the area of interest is outside the interferograms (%s)" % example_file)
+        rows = (max(rows[0], int(np.min(vertex_rows))), min(rows[1], int(np.max(vertex_rows)) + 1))
+        cols = (max(cols[0], int(np.min(vertex_cols))), min(cols[1], int(np.max(vertex_cols)) + 1))
+        shapes.append(pad_box_corners(vertex_rows, vertex_cols) if is_box else (vertex_rows, vertex_cols))
+    rows, cols = (max(rows[0], 0), min(rows[1], ny)), (max(cols[0], 0), min(cols[1], nx))
+    if rows[1] <= rows[0] or cols[1] <= cols[0]:
+        raise ValueError("The area of interest doesn't overlap the interferograms (%s)" % example_file)
+    mask = None
+    for poly_rows, poly_cols in shapes:
+        shape_mask = get_polygon_mask(rows, cols, poly_rows, poly_cols)
+        mask = shape_mask if mask is None else mask & shape_mask
+    if mask is not None and np.all(mask):
+        mask = None   # nothing to mask inside the window
+    logger.info("Area of interest: rows %d-%d, cols %d-%d of %d x %d%s" % (rows[0], rows[1], cols[0], cols[1], ny, nx,
+                                                                           ", masked to %d pixels" % np.sum(mask)
+                                                                           if mask is not None else ""))
+    return region(rows=rows, cols=cols, mask=mask)
+
+
+def get_region_from_config(config_params, example_file):
+    return get_region(config_params.aoi_window, config_params.aoi_bounds, config_params.aoi_polygon, example_file,
+                      config_params.geocoded_intfs, config_params.file_format)
+
+
+def apply_mask(zdata, my_region):
+    """ nan outside the mask of the region. zdata is one grid on the region's window. """
+    if my_region is None or my_region.mask is None:
+        return zdata
+    zdata = np.array(zdata, dtype=float)
+    zdata[~my_region.mask] = np.nan
+    return zdata
+
+
+def crop_grid(zdata, my_region):
+    """ The window of a full-frame grid, masked outside the area of interest """
+    if my_region is None:
+        return zdata
+    return apply_mask(zdata[my_region.rows[0]:my_region.rows[1], my_region.cols[0]:my_region.cols[1]], my_region)
+
+
+def crop_grid_to_axes(xdata, ydata, zdata, xvalues, yvalues):
+    """
+    The part of a grid (like the signal spread) on the axes of the data cube, matched by coordinate.
+    A grid already on the same axes comes back as it is, so full-frame and subset grids both work.
+    """
+    xdata, ydata = np.asarray(xdata, dtype=float), np.asarray(ydata, dtype=float)
+    c0 = int(np.argmin(np.abs(xdata - xvalues[0])))
+    r0 = int(np.argmin(np.abs(ydata - yvalues[0])))
+    c1, r1 = c0 + len(xvalues), r0 + len(yvalues)
+    if c1 > len(xdata) or r1 > len(ydata) or not np.allclose(xdata[c0:c1], xvalues) or \
+            not np.allclose(ydata[r0:r1], yvalues):
+        raise ValueError("Grid doesn't cover the area of interest of the interferograms. Was it made on a "
+                         "different area? Try making it again (make_signal_spread = 1).")
+    return np.asarray(zdata)[r0:r1, c0:c1]
+
+
+def shift_to_region(row, col, my_region):
+    """ A full-frame row and col into the rows and cols of the region. Raises if it's outside the region. """
+    if my_region is None:
+        return row, col
+    if not (my_region.rows[0] <= row < my_region.rows[1] and my_region.cols[0] <= col < my_region.cols[1]):
+        raise ValueError("Pixel %d/%d is outside the area of interest (rows %d-%d, cols %d-%d)" %
+                         (row, col, my_region.rows[0], my_region.rows[1], my_region.cols[0], my_region.cols[1]))
+    row, col = row - my_region.rows[0], col - my_region.cols[0]
+    if my_region.mask is not None and not my_region.mask[row, col]:
+        raise ValueError("Pixel %d/%d is outside the mask of the area of interest" % (row + my_region.rows[0],
+                                                                                     col + my_region.cols[0]))
+    return row, col
@@ -0,0 +1,168 @@
+"""
+Timing and memory benchmarks for the hot paths of the stacking code, on synthetic stacks of several sizes.
+Results are written as JSON, so runs can be compared across commits.
+"""
+
+import numpy as np
+import datetime as dt
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from . import readmytupledata as rmd
+from . import Super_Simple_Stack as sss
+from . import synthetic_stack, stack_corr, coseismic_stack, nsbas, nsbas_batched
+
+# (ny, nx, n_dates) of the synthetic stacks
+BENCHMARK_SIZES = {"small": (40, 40, 12), "medium": (120, 120, 24), "large": (300, 300, 40)}
+
+
+def get_param_dict(ts_type='NSBAS'):
+    return {"nsbas_good_perc": 50, "sbas_smoothing": 0, "wavelength": 56, "rowref": 0, "colref": 0,
+            "dem_error": 0, "ts_type": ts_type, "signal_coh_cutoff": 0.1, "start_index": 0, "end_index": None}
+
+
+def get_benchmarks():
+    """ name -> function(stack, intf_tuple, coh_tuple, workdir) running one hot path. """
+    signal_spread = lambda tup: 100 * np.ones(np.shape(tup.zvalues[0]))
+
+    def read_gmtsar(stack, _intf_tuple, _coh_tuple, workdir):
+        intf_files, _ = synthetic_stack.write_gmtsar_stack(stack, workdir)
+        start = time.perf_counter()
+        rmd.reader(intf_files)
+        return time.perf_counter() - start   # only the reading counts
+
+    return {"readmytupledata.reader": read_gmtsar,
+            "stack_corr": lambda s, i, c, w: stack_corr.stack_corr(c, 0.1),
+            "Super_Simple_Stack.velocity_simple_stack":
+                lambda s, i, c, w: sss.velocity_simple_stack(i, 56, 0, 0, signal_spread(i), 25),
+            "coseismic_stack.get_avg_coseismic": lambda s, i, c, w: coseismic_stack.get_avg_coseismic(i, 0, 0, 56),
+            "nsbas.Velocities": lambda s, i, c, w: nsbas.Velocities(get_param_dict(), i, signal_spread(i), None, None),
+            "nsbas.Full_TS": lambda s, i, c, w: nsbas.Full_TS(get_param_dict(), i, signal_spread(i), None, None),
+            "nsbas_batched.Velocities":
+                lambda s, i, c, w: nsbas_batched.Velocities(get_param_dict(), i, signal_spread(i), None, None),
+            "nsbas_batched.Full_TS":
+                lambda s, i, c, w: nsbas_batched.Full_TS(get_param_dict(), i, signal_spread(i), None, None)}
+
+
+def time_one(function, *args):
+    """ Wall time, CPU time, and peak traced memory of one call. A function may return its own timing. """
+    tracemalloc.start()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    returned = function(*args)
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(returned, float):
+        wall = returned
+    return {"wall_s": wall, "cpu_s": cpu, "peak_mb": peak / 1e6}
+
+
+def run_benchmarks(sizes=("small", "medium"), names=None, repeats=1):
+    """
+    Run each benchmark on each size of synthetic stack. The best of several repeats is kept.
+    :returns: list of dicts with name, size, shape, timing, memory, and pixels per second (or an error)
+    """
+    benchmarks = get_benchmarks()
+    names = names if names is not None else list(benchmarks.keys())
+    results = []
+    for size in sizes:
+        ny, nx, n_dates = BENCHMARK_SIZES[size]
+        stack = synthetic_stack.make_synthetic_stack(ny=ny, nx=nx, n_dates=n_dates)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        coh_tuple = synthetic_stack.to_intf_tuple(stack, coherence=True)
+        for name in names:
+            print("Benchmarking %s on %s stack (%d x %d, %d dates)" % (name, size, ny, nx, n_dates))
+            result = {"name": name, "size": size, "ny": ny, "nx": nx, "n_dates": n_dates,
+                      "n_intfs": len(stack.pairs)}
+            try:
+                trials = []
+                for _ in range(repeats):
+                    with tempfile.TemporaryDirectory() as workdir:
+                        trials.append(time_one(benchmarks[name], stack, intf_tuple, coh_tuple, workdir))
+                result.update(min(trials, key=lambda x: x["wall_s"]))
+                result["pixels_per_s"] = ny * nx / result["wall_s"]
+            except Exception as e:   # e.g., GMT isn't installed for the grd readers
+                result["error"] = repr(e)
+            results.append(result)
+    return results
+
+
+def run_solver_crossover(n_dates_list=(50, 100, 200, 400), group_sizes=(1, 100), max_neighbors=5, repeats=3):
+    """
+    Dense (one pseudo-inverse per group) vs. sparse (LSMR per pixel) NSBAS solves, on networks of growing size.
+    The dense solve is shared by every pixel of a group, so the crossover depends on the group size too.
+    Each trial is the whole group loop (nsbas_batched.group_iterator: selection, G build, solve, metrics),
+    on one row of n_pixels pixels that all share the full network.
+    :returns: list of dicts with solver, n_dates, n_intfs, n_pixels, and the best wall time of the repeats
+    """
+    results = []
+    for n_dates in n_dates_list:
+        for n_pixels in group_sizes:
+            stack = synthetic_stack.make_synthetic_stack(ny=1, nx=n_pixels, n_dates=n_dates, nan_fraction=0,
+                                                         max_neighbors=max_neighbors)
+            intf_tuple = synthetic_stack.to_intf_tuple(stack)
+            for solver in ['dense', 'sparse']:
+                print("Timing %s group loop: %d dates, %d intfs, %d pixels" % (solver, n_dates, len(stack.pairs),
+                                                                              n_pixels))
+                param_dict = get_param_dict()
+                param_dict["nsbas_solver"] = solver
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    nsbas_batched.group_iterator(param_dict, intf_tuple, 100 * np.ones((1, n_pixels)), None, None,
+                                                 lambda *args: None, per_pixel_networks=False)
+                    times.append(time.perf_counter() - start)
+                results.append({"name": "solver_crossover", "solver": solver, "n_dates": n_dates,
+                                "n_intfs": len(stack.pairs), "n_pixels": n_pixels, "wall_s": min(times),
+                                "pixels_per_s": n_pixels / min(times)})
+    return results
+
+
+def print_solver_crossover(results):
+    """ For each group size, the wall times of both solvers, and the smallest network where sparse is faster. """
+    print("%8s %8s %8s %12s %12s" % ("pixels", "dates", "intfs", "dense (s)", "sparse (s)"))
+    for n_pixels in sorted(set(x["n_pixels"] for x in results)):
+        crossover = None
+        for n_dates in sorted(set(x["n_dates"] for x in results)):
+            wall = {x["solver"]: x for x in results if x["n_pixels"] == n_pixels and x["n_dates"] == n_dates}
+            print("%8d %8d %8d %12.4f %12.4f" % (n_pixels, n_dates, wall["dense"]["n_intfs"], wall["dense"]["wall_s"],
+                                                 wall["sparse"]["wall_s"]))
+            if crossover is None and wall["sparse"]["wall_s"] < wall["dense"]["wall_s"]:
+                crossover = n_dates
+        if crossover is None:
+            print("Groups of %d pixels: dense is faster for every network size" % n_pixels)
+        else:
+            print("Groups of %d pixels: sparse is faster from %d dates" % (n_pixels, crossover))
+    return
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def write_results(results, outfile):
+    report = {"commit": get_git_commit(), "date": dt.datetime.now().isoformat(), "results": results}
+    with open(outfile, 'w') as ofile:
+        json.dump(report, ofile, indent=2)
+    print("Writing benchmark results to %s " % outfile)
+    return report
+
+
+def compare_results(old_file, new_file):
+    """ Print the ratio of new to old wall time for each benchmark found in both files. """
+    old, new = json.load(open(old_file)), json.load(open(new_file))
+    old_times = {(x["name"], x["size"]): x["wall_s"] for x in old["results"] if "wall_s" in x}
+    print("%-45s %-8s %10s %10s %8s" % ("benchmark", "size", "old (s)", "new (s)", "ratio"))
+    for item in new["results"]:
+        key = (item["name"], item["size"])
+        if key in old_times and "wall_s" in item:
+            print("%-45s %-8s %10.4f %10.4f %8.2f" % (key[0], key[1], old_times[key], item["wall_s"],
+                                                      item["wall_s"] / old_times[key]))
+    return
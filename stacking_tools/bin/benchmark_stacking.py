@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Time the stacking hot paths on synthetic stacks and write the results as JSON.
+Usage:
+    benchmark_stacking.py out.json [small,medium,large] [repeats]
+    benchmark_stacking.py --compare old.json new.json
+    benchmark_stacking.py --solvers out.json [n_dates,n_dates,...]   (dense vs. sparse NSBAS solver crossover)
+"""
+
+import sys
+from s1_batches.stacking_tools import benchmark_stacking
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(0)
+    if sys.argv[1] == '--compare':
+        benchmark_stacking.compare_results(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    if sys.argv[1] == '--solvers':
+        n_dates_list = [int(x) for x in sys.argv[3].split(',')] if len(sys.argv) > 3 else (50, 100, 200, 400)
+        results = benchmark_stacking.run_solver_crossover(n_dates_list)
+        benchmark_stacking.print_solver_crossover(results)
+        benchmark_stacking.write_results(results, sys.argv[2])
+        sys.exit(0)
+    sizes = sys.argv[2].split(',') if len(sys.argv) > 2 else ["small", "medium"]
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    results = benchmark_stacking.run_benchmarks(sizes, repeats=repeats)
+    benchmark_stacking.write_results(results, sys.argv[1])
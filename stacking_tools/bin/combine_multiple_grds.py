@@ -3,6 +3,8 @@
 """
 This is for when you've run a large SBAS in chunks of several million pixels each
 Because it saves time to run in parallel.
+No longer needed for new runs: set nsbas_workers in the stacking config, and nsbas_tiles will run
+the chunks in parallel and write a single set of grids.
 """
 
 import numpy as np
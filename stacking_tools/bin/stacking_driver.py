@@ -3,10 +3,11 @@
 specific driver for stacking, velocities, and time series
 """
 
-from s1_batches.stacking_tools import stacking_configparser, stacking_functions
+from s1_batches.stacking_tools import stacking_configparser, stacking_functions, diagnostics, run_report
 
 if __name__ == "__main__":
     conf, config_params = stacking_configparser.parse_cmd_and_config()
+    diagnostics.configure_logging(config_params.log_level)
 
     # Step 0: set up output directories
     stacking_functions.set_up_output_directories(config_params)
@@ -22,3 +23,7 @@ if __name__ == "__main__":
 
     # Step 4: geocoding
     stacking_functions.geocode_vels(config_params)
+
+    # What happened to the pixels, and where did the time go?
+    diagnostics.log_summary()
+    run_report.write_report(config_params.ts_output_dir)
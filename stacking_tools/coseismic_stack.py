@@ -7,12 +7,15 @@ Can be used with gmtsar or isce
 import numpy as np
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from . import readmytupledata as rmd
+from . import aoi
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
 
 
-def drive_coseismic_stack(config_params, intf_files):
-    param_dict = get_coseismic_params(config_params)
-    intf_tuple = param_dict["reader"](intf_files)
+def drive_coseismic_stack(config_params, intf_files, region=None):
+    """ With a region (see aoi.py), only the area of interest is read and averaged """
+    param_dict = get_coseismic_params(config_params, region)
+    intf_tuple = param_dict["reader"](intf_files, cube_file=rmd.get_cube_file(param_dict["cube_dir"], 'intf'),
+                                      region=region)
     average_coseismic = get_avg_coseismic(intf_tuple, param_dict["rowref"], param_dict["colref"],
                                           param_dict["wavelength"])
     output_manager_coseismic(intf_tuple.xvalues, intf_tuple.yvalues, average_coseismic, param_dict["outdir"])
@@ -23,17 +26,18 @@ def get_avg_coseismic(intf_tuple, rowref, colref, wavelength):
     """I could send this into the iterator_func in NSBAS if I wanted to.
     Negative sign matches the NSBAS code """
     disp = np.zeros(np.shape(intf_tuple.zvalues[0, :, :]))
-    for i in range(len(intf_tuple.yvalues)):
-        for j in range(len(intf_tuple.xvalues)):
-            pixel_value = np.subtract(intf_tuple.zvalues[:, i, j], intf_tuple.zvalues[:, rowref, colref])
-            disp[i][j] = np.nanmean(pixel_value) * -wavelength / (4 * np.pi)
+    ref_pixel_values = np.asarray(intf_tuple.zvalues[:, rowref, colref])
+    for r0, r1, block in rmd.cube_row_blocks(intf_tuple.zvalues):
+        pixel_values = np.subtract(block, ref_pixel_values[:, None, None])
+        disp[r0:r1, :] = np.nanmean(pixel_values, axis=0) * -wavelength / (4 * np.pi)
     return disp
 
 
-def get_coseismic_params(config_params):
-    """Unpack the parameter object into a new parameter dictionary"""
+def get_coseismic_params(config_params, region=None):
+    """Unpack the parameter object into a new parameter dictionary, with the reference pixel in the region, if any"""
     rowref = int(config_params.ref_idx.split('/')[0])
     colref = int(config_params.ref_idx.split('/')[1])
+    rowref, colref = aoi.shift_to_region(rowref, colref, region)
     if config_params.file_format == 'isce':  # Working with the file formats
         my_reader_function = rmd.reader_isce
     else:
@@ -41,7 +45,8 @@ def get_coseismic_params(config_params):
     param_dictionary = {"wavelength": config_params.wavelength,
                         "rowref": rowref, "colref": colref, "outdir": str(config_params.ts_output_dir),
                         "signal_spread_filename": config_params.ts_output_dir+'/'+config_params.signal_spread_filename,
-                        "reader": my_reader_function}
+                        "reader": my_reader_function,
+                        "cube_dir": config_params.ts_output_dir if config_params.memmap_cube else None}
     return param_dictionary
 
 
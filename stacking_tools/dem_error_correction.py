@@ -8,6 +8,7 @@ It operates on unsmoothed time series, but smoothing can be added in later.
 """
 
 import numpy as np
+import functools
 
 
 def driver(ts_vector, datestrs, baseline_tuple):
@@ -18,38 +19,62 @@ def driver(ts_vector, datestrs, baseline_tuple):
     datestrs format: '2015134' (str, used for shape and consistency with data vector)
     ts_vector: usually mm, but we convert to meters for consistency with baselines
     """
-
     if np.sum(np.isnan(ts_vector)) == len(ts_vector):
         return ts_vector, np.nan
+    corrected_ts, K_z_error = driver_block(np.reshape(ts_vector, (-1, 1)), datestrs, baseline_tuple)
+    return corrected_ts[:, 0], K_z_error[0]
 
-    ts_vector = np.multiply(ts_vector, 0.001)   # convert to meters
 
+def driver_block(ts_block, datestrs, baseline_tuple):
+    """
+    The DEM error correction for many pixels that share the same dates.
+    The design matrix only depends on the dates and baselines, so it is inverted once for the whole block.
+    ts_block: (n_dates, n_pixels) array of time series in mm
+    :returns: corrected (n_dates, n_pixels) array in mm, and K_z_error (n_pixels) array. All-nan columns give nan.
+    """
     # if the igrams use the date, then calculate
-    baselines = [x[0] for x in baseline_tuple if x[2] in datestrs]
-    dtarray = [x[1] for x in baseline_tuple if x[2] in datestrs]
-
+    baselines, dtarray = get_epoch_baselines(baseline_tuple, datestrs)
     if len(datestrs) != len(baselines):
         print("Error! Wrong number of baselines (%d) and dates in your intfs (%d)" % (len(baselines), len(datestrs)))
+    K_operator, baseline_offsets = get_dem_error_operator(tuple(baselines), tuple(dtarray))
+
+    # velocity history: v(i) = phi(t_i)-phi(t_i-1)  / (t_i-t_i-1), i=[1-N], in meters per day
+    day_deltas = np.diff([(x - dtarray[0]).days for x in dtarray])
+    v = np.diff(np.multiply(ts_block, 0.001), axis=0) / day_deltas[:, None]
+    K_z_error = np.dot(K_operator, v)   # constant time z_error, for every pixel at once
+
+    topo_phase = np.outer(baseline_offsets, K_z_error)
+    corrected_ts_block = np.subtract(np.multiply(ts_block, 0.001), topo_phase)
+    corrected_ts_block = np.multiply(corrected_ts_block, 1000)   # convert to mm
+    return corrected_ts_block, K_z_error
+
 
-    # design matrix: phase(t) = v(t-t0) + other terms + .... (4pi/lamda B(ti)/rsin(theta) z_error)
-    # Baseline history: Bdot(i) = B(t_i)-B(t_i-t_i-1) / (t_i-t_i-1), i=[1-N]
-    # velocity history: v(i) = phi(t_i)-phi(t_i-1)  / (t_i-t_i-1), i=[1-N]
-    # The model we're solving for is [velocity, (z_error/rsin(theta))]. since data is already converted to mm
-    # The units of everything seem to be in movement per day, not movement per year (this matters)
-    # I call that constant K_z_error. If we want DEM error, we multiply by an estimate of rsintheta
-    G = np.ones((len(datestrs)-1, 2))
-    v = np.zeros((len(datestrs)-1))
-    Bdot = np.zeros((len(datestrs)-1))
-    for i in range(0, len(datestrs)-1):
-        v[i] = (ts_vector[i+1] - ts_vector[i]) / (dtarray[i+1]-dtarray[i]).days
-        Bdot[i] = (baselines[i+1] - baselines[i]) / (dtarray[i+1]-dtarray[i]).days
-        G[i, 1] = Bdot[i]
-
-    model = np.linalg.lstsq(G, v, rcond=0.1)  # rcond helps the solution converge
-    K_z_error = model[0][1]  # constant time z_error
-
-    topo_phase = [K_z_error * (x-baselines[0]) for x in baselines]
-
-    corrected_ts_vector = np.subtract(ts_vector, topo_phase)
-    corrected_ts_vector = np.multiply(corrected_ts_vector, 1000)   # convert to mm
-    return corrected_ts_vector, K_z_error
+@functools.lru_cache(maxsize=64)
+def get_dem_error_operator(baselines, dtarray):
+    """
+    design matrix: phase(t) = v(t-t0) + other terms + .... (4pi/lamda B(ti)/rsin(theta) z_error)
+    Baseline history: Bdot(i) = B(t_i)-B(t_i-t_i-1) / (t_i-t_i-1), i=[1-N]
+    The model we're solving for is [velocity, (z_error/rsin(theta))]. since data is already converted to mm
+    The units of everything seem to be in movement per day, not movement per year (this matters)
+    I call that constant K_z_error. If we want DEM error, we multiply by an estimate of rsintheta
+    :param baselines: tuple of baselines (m) for each date. dtarray: tuple of datetimes.
+    :returns: the row of the pseudo-inverse that gives K_z_error from the velocity history,
+    and each date's baseline relative to the first date
+    """
+    day_deltas = np.diff([(x - dtarray[0]).days for x in dtarray])
+    G = np.ones((len(baselines) - 1, 2))
+    G[:, 1] = np.diff(baselines) / day_deltas   # Bdot
+    G_pinv = np.linalg.pinv(G, rcond=0.1)  # rcond helps the solution converge (same cutoff as lstsq)
+    K_operator, baseline_offsets = G_pinv[1], np.subtract(baselines, baselines[0])
+    K_operator.flags.writeable, baseline_offsets.flags.writeable = False, False   # shared between calls
+    return K_operator, baseline_offsets
+
+
+def get_epoch_baselines(baseline_tuple, datestrs):
+    """
+    The baselines and datetimes of the acquisitions used in the time series, in chronological order.
+    One set lookup per acquisition, instead of searching the list of datestrs for each one.
+    """
+    datestr_set = set(datestrs)
+    selected = [x for x in baseline_tuple if x[2] in datestr_set]
+    return [x[0] for x in selected], [x[1] for x in selected]
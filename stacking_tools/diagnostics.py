@@ -0,0 +1,106 @@
+"""
+Diagnostics for NSBAS runs, through the logging module.
+Events that can happen for millions of pixels (singular networks, skipped pixels, ...) are not printed one at a time.
+Instead they add to counters, which are summarized in a table at the end of the run. Like the phase totals
+in run_report, counters live in each process, and worker processes hand theirs to the parent (pop_counts,
+merge_counts). Progress goes through a rate-limited reporter with pixels/s and an ETA.
+Everything is logged under the 's1_batches.stacking_tools' loggers, so a run can be silenced with the log level.
+"""
+
+import collections
+import datetime as dt
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+PROGRESS_INTERVAL_S = 10.0   # at most one progress message this often
+
+# Counters that the NSBAS engines know about, in the order of the summary table. All of them count pixels.
+COUNTER_DESCRIPTIONS = collections.OrderedDict([
+    ("low_signal_spread", "skipped: signal spread at or below nsbas_good_perc (nsbas_min_intfs in the config)"),
+    ("too_many_nans", "skipped: half or more of the interferograms are nan"),
+    ("reference_nan", "skipped: half or more of the interferograms are nan at the reference pixel"),
+    ("disconnected", "skipped: network has 4 or fewer dates, or (time series) doesn't connect every date"),
+    ("graph_reduction", "network reduced to its largest connected component"),
+    ("small_network", "network of 4 or fewer dates, returned nans"),
+    ("singular_network", "network doesn't connect every date, returned nans"),
+    ("nan_only", "inverted, but the time series is all nans (including small and singular networks)"),
+    ("inverted", "passed the checks and went to the solver"),
+])
+
+_counts = collections.Counter()
+progress_reporter = collections.namedtuple('progress_reporter', ['update', 'finish'])
+
+
+def configure_logging(level='INFO'):
+    """ For the command-line drivers: messages go to the terminal, without decoration, at the given level """
+    logging.basicConfig(level=getattr(logging, str(level).upper()), format='%(message)s')
+    return
+
+
+# ------------ COUNTERS ------------ #
+
+def count(name, n=1):
+    if n > 0:
+        _counts[name] += int(n)
+    return
+
+
+def get_counts():
+    return dict(_counts)
+
+
+def pop_counts():
+    """ Hand back the counters and reset them. Used to pass counts from worker processes to the parent. """
+    counts = dict(_counts)
+    _counts.clear()
+    return counts
+
+
+def merge_counts(counts):
+    _counts.update(counts)
+    return
+
+
+def log_summary(counts=None):
+    """ A table of every counter that was used, known ones first """
+    counts = get_counts() if counts is None else counts
+    names = [x for x in COUNTER_DESCRIPTIONS.keys() if counts.get(x)] + \
+            sorted([x for x in counts.keys() if x not in COUNTER_DESCRIPTIONS])
+    if not names:
+        return
+    logger.info("NSBAS diagnostics (pixels):")
+    for name in names:
+        logger.info("  %-18s %12d  %s" % (name, counts[name], COUNTER_DESCRIPTIONS.get(name, '')))
+    return
+
+
+# ------------ PROGRESS ------------ #
+
+def make_progress(n_total, label='pixels', interval_s=PROGRESS_INTERVAL_S, level=logging.INFO):
+    """
+    A progress_reporter for n_total items. update(n) adds n finished items, and logs the count, the rate, and an ETA
+    if interval_s has passed since the last message. finish() logs the total time.
+    """
+    state = {"done": 0, "start": time.perf_counter()}
+    state["last"] = state["start"]
+
+    def update(n=1):
+        state["done"] += n
+        now = time.perf_counter()
+        if now - state["last"] >= interval_s and logger.isEnabledFor(level):
+            state["last"] = now
+            rate = state["done"] / (now - state["start"])
+            eta = dt.timedelta(seconds=int((n_total - state["done"]) / rate)) if rate > 0 else '?'
+            logger.log(level, "Done with %d of %d %s (%.0f %s/s, ETA %s)" % (state["done"], n_total, label, rate,
+                                                                            label, eta))
+        return
+
+    def finish():
+        seconds = time.perf_counter() - state["start"]
+        logger.log(level, "Done with %d %s in %.1f s (%.0f %s/s)" % (state["done"], label, seconds,
+                                                                   state["done"] / seconds if seconds > 0 else 0,
+                                                                   label))
+        return
+
+    return progress_reporter(update=update, finish=finish)
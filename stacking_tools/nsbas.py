@@ -1,11 +1,23 @@
 
 import numpy as np
+import scipy.linalg
 import matplotlib.pyplot as plt
 import sys
 import math
+import collections
+import functools
 import datetime as dt
+import logging
+import time
 from . import stacking_utilities
+from . import diagnostics
 from . import dem_error_correction
+from . import ts_velocity
+from . import run_report
+
+DESIGN_CACHE_SIZE = 4096   # number of distinct interferogram networks whose G we keep
+_correction_times = collections.defaultdict(lambda: [0.0, 0])   # phase -> [seconds, pixels] since the last flush
+logger = logging.getLogger(__name__)
 
 # ------------ UTILITY FUNCTIONS ------------ #
 
@@ -16,24 +28,23 @@ def select_datestrs_for_pixel(i, j, param_dict, intf_tuple, signal_spread_tuple,
     This reduces the likelihood of encountering a singular matrix during time series SBAS inversion.
     Update the datestrs and x_axis_days
     It guarantees that the pixel's network will fall within a single connected component for SBAS inversion.
+    The graph search uses the integer epoch table of intf_tuple, so no date strings are parsed here.
     """
-    valid_date_julstrings, select_datestrs, select_x_axis_days = [], [], []
     ss, pixel_value, coh_value = pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple)
+    epochs = stacking_utilities.get_epoch_table(intf_tuple)
 
     # Filter the interferograms for ones that contain real data.
-    for i in range(len(pixel_value)):
-        if coh_value:   # if we are using coherence
-            if coh_value[i] > param_dict["signal_coh_cutoff"]:
-                if not math.isnan(pixel_value[i]):
-                    valid_date_julstrings.append(intf_tuple.date_pairs_julian[i])
-        else:
-            if not math.isnan(pixel_value[i]):
-                valid_date_julstrings.append(intf_tuple.date_pairs_julian[i])
+    valid = ~np.isnan(pixel_value)
+    if coh_value is not None:   # if we are using coherence
+        valid &= coh_value > param_dict["signal_coh_cutoff"]
 
     # Here we filter interferograms again based on the largest connected component of the graph:
-    valid_date_julstrings, _ = stacking_utilities.reduce_graph_to_largest_cc(valid_date_julstrings, datestrs)
+    _, used_epochs = stacking_utilities.reduce_pairs_to_largest_cc(epochs, valid)
+    if len(used_epochs) < len(epochs.datestrs):
+        diagnostics.count("graph_reduction")
 
-    select_datestrs, _, select_x_axis_days = stacking_utilities.get_TS_dates(valid_date_julstrings)
+    select_datestrs = list(epochs.datestrs[used_epochs])
+    select_x_axis_days = list(epochs.days[used_epochs] - epochs.days[used_epochs[0]]) if len(used_epochs) else []
     return select_datestrs, select_x_axis_days
 
 
@@ -69,6 +80,7 @@ def Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_
     regions with bad coherence.
     """
     initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    intf_tuple = intf_tuple._replace(epochs=stacking_utilities.get_epoch_table(intf_tuple))
     retval_main = np.zeros([len(intf_tuple.yvalues), len(intf_tuple.xvalues)])
     retval_metrics = [[{} for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
     datestrs, x_dts, x_axis_days = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
@@ -85,6 +97,7 @@ def Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_
 def Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple):
     """ This is how you access Time Series solutions from NSBAS"""
     initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    intf_tuple = intf_tuple._replace(epochs=stacking_utilities.get_epoch_table(intf_tuple))
     datestrs, x_dts, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
     # Establishing the return array
     empty_vector = [np.empty(np.shape(datestrs))]
@@ -96,36 +109,30 @@ def Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tup
         return compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, datestrs)
 
     retval_main, retval_metrics = iterator_func(intf_tuple, packager_function, retval_main, retval_metrics,
-                                                param_dict["start_index"], param_dict["end_index"])
+                                                param_dict.get("start_index", 0), param_dict.get("end_index"))
     return retval_main, retval_metrics
 
 
 def Velocities_from_TS(ts_tuple):
     """
     The easy function to take a timeseries saved on disk and construct velocities
-    This one doesn't have a memory leak.
+    This one doesn't have a memory leak. All pixels are fit at once (ts_velocity.fit_ts_cube).
     """
-    retval_main = np.zeros([len(ts_tuple.yvalues), len(ts_tuple.xvalues)])
-    retval_metrics = [[{} for _i in range(len(ts_tuple.xvalues))] for _j in range(len(ts_tuple.yvalues))]
-    x_axis_days = [(i - ts_tuple.ts_dates[0]).days for i in ts_tuple.ts_dates]
-
-    def packager_function(i, j, ts_tuple):
-        return compute_velocity_from_ts(i, j, ts_tuple, x_axis_days)
-
-    retval_main, retval_metrics = iterator_func(ts_tuple, packager_function, retval_main, retval_metrics)
-    return retval_main
+    return ts_velocity.fit_ts_cube(ts_tuple, max_nans=30).velocity
 
 
 def iterator_func(intf_tuple, func, retval, retval_metrics, start_index=0, end_index=None):
-    """ This iterator performs a for loop. It assumes the return value can be stored in an array of ixj"""
-    print("Performing iteration on %d files" % (len(intf_tuple.zvalues)))
-    print("Started at: ")
-    print(dt.datetime.now())
-    previous_time = dt.datetime.now()
+    """
+    This iterator performs a for loop. It assumes the return value can be stored in an array of ixj.
+    Progress (pixels/s and ETA) and what happened to the pixels go to the log (see diagnostics).
+    """
+    logger.info("Performing iteration on %d files" % (len(intf_tuple.zvalues)))
+    logger.info("Started at: %s" % dt.datetime.now())
+    stats_before = get_design_cache_stats()
     c = 0
-    true_count = 1
     if end_index is None:
         end_index = len(intf_tuple.yvalues) * len(intf_tuple.xvalues)
+    progress = diagnostics.make_progress(end_index - start_index)
     # iterate through the 3D array of data
     it = np.nditer(intf_tuple.zvalues[0, :, :], flags=['multi_index'], order='F')
     while not it.finished:
@@ -135,23 +142,17 @@ def iterator_func(intf_tuple, func, retval, retval_metrics, start_index=0, end_i
             if c == end_index:
                 break
             retval[i][j], nanflag, retval_metrics[i][j] = func(i, j, intf_tuple)
-            if np.mod(c, 10000) == 0:
-                print('Done with ' + str(c) + ' out of ' + str(
-                    len(intf_tuple.xvalues) * len(intf_tuple.yvalues)) + ' pixels')
-                print("  working on pixel %d %d " % (i, j))
-            if not nanflag:
-                true_count = true_count + 1  # how many pixels were actually inverted?
-            if np.mod(true_count, 10000) == 0:
-                current_time = dt.datetime.now()
-                delta = current_time - previous_time
-                print("--> 10K inversions took: %.2f s" % delta.total_seconds())
-                previous_time = current_time
-        # if c==60000:
-        # 	break
+            progress.update()
         c = c + 1
         it.iternext()
-    print("Finished at: ")
-    print(dt.datetime.now())
+    flush_correction_times()
+    progress.finish()
+    logger.info("Finished at: %s" % dt.datetime.now())
+    stats = get_design_cache_stats()
+    hits, misses = stats["hits"] - stats_before["hits"], stats["misses"] - stats_before["misses"]
+    if hits + misses > 0:
+        logger.info("Design matrix cache: %d hits, %d misses (hit rate %.3f), %d networks cached" % (
+            hits, misses, hits / (hits + misses), stats["networks"]))
     return retval, retval_metrics
 
 
@@ -168,6 +169,7 @@ def compute_vel(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tupl
     # for each pixel, update datestrs based on pixel_value and intf_tuple.
     ss, pixel_value, coh_value = pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple)
     if ss < param_dict["nsbas_good_perc"]:
+        diagnostics.count("low_signal_spread")
         return np.nan, True, {}    # avoid the nan pixels
 
     updated_datestrs, updated_x_axis_days = select_datestrs_for_pixel(i, j, param_dict, intf_tuple,
@@ -205,21 +207,29 @@ def compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple
 
         # Produce an uncorrected time series
         ts_vector = do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, param_dict["wavelength"], datestrs,
-                                   coh_value)
+                                   coh_value, stacking_utilities.get_epoch_table(intf_tuple))
 
         # Applying corrections
+        # Timed into running totals, which the loop over pixels hands to run_report (flush_correction_times)
         if param_dict["dem_error"]:  # If we are implementing a DEM error correction.
+            start = time.perf_counter()
             ts_vector, Kz_error = dem_error_correction.driver(ts_vector, datestrs, baseline_tuple)
+            add_correction_time("DEM correction", start)
             output_metrics_dict["Kz_error"] = Kz_error
         if param_dict["sbas_smoothing"] > 0:  # Smoothing after the time series has been created
+            start = time.perf_counter()
             ts_vector = temporal_smoothing_ts(ts_vector, param_dict["sbas_smoothing"])
+            add_correction_time("smoothing", start)
 
         TS = [ts_vector]
+        diagnostics.count("inverted")
         if np.sum(np.isnan(TS[0])) == len(TS[0]):
             nanflag = True
+            diagnostics.count("nan_only")
         else:
             nanflag = False
     else:
+        diagnostics.count("low_signal_spread" if ss <= param_dict["nsbas_good_perc"] else "too_many_nans")
         TS = [empty_vector]
         nanflag = True
         if param_dict["dem_error"]:
@@ -228,6 +238,21 @@ def compute_TS(i, j, param_dict, intf_tuple, signal_spread_tuple, baseline_tuple
     return TS, nanflag, output_metrics_dict
 
 
+def add_correction_time(name, start):
+    totals = _correction_times[name]
+    totals[0] += time.perf_counter() - start
+    totals[1] += 1
+    return
+
+
+def flush_correction_times():
+    """ Add the per-pixel correction times to the run_report phases, once per tile or loop instead of per pixel """
+    for name, (seconds, n_pixels) in _correction_times.items():
+        run_report.add_phase_time(name, seconds, n_pixels)
+    _correction_times.clear()
+    return
+
+
 # Functions at or near the lowest level
 def pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple):
     """ Extract a pixel from several 2D arrays, referencing it to the reference pixel """
@@ -242,7 +267,7 @@ def pixel_extractor(i, j, param_dict, intf_tuple, signal_spread_tuple, coh_tuple
     return [ss, pixel_value, coh_value]
 
 
-def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None):
+def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None, epochs=None):
     """"
     pixel_value: if we have 62 intf, this is a (62,) array of the phase values in each interferogram
     date_pairs: if we have 62 intf, this is a (62) list with the image pairs used in each image,
@@ -251,97 +276,112 @@ def do_nsbas_pixel(pixel_value, date_pairs, wavelength, datestrs, coh_value=None
     This solves Gm = d for the movement of the pixel with smoothing.
     If coh_value is an array, we do weighted least squares
     This function expects the values in the preferred reference system (i.e. reference pixel already implemented).
+    Most pixels share a handful of networks, so G and its pseudo-inverse come from a cache (get_design_entry).
+    epochs: optional epoch_table of date_pairs (see stacking_utilities.make_epoch_table). Without it, the dates
+    are parsed here.
     """
-    d = np.array([])
-    diagonals = []
-    date_pairs_used = []
-
-    for i in range(len(pixel_value)):
-        if date_pairs[i][0:7] in datestrs:   # if the interferogram falls within the desired connected component
-            if not math.isnan(pixel_value[i]):
-                d = np.append(d, pixel_value[i])  # removes the nans from the computation.
-                date_pairs_used.append(date_pairs[i])
-                # might be a slightly shorter array of which interferograms actually got used.
-                if coh_value is not None:
-                    diagonals.append(np.power(coh_value[i], 2))  # using coherence squared as the weighting.
-                else:
-                    diagonals.append(1)
-
-    model_num = len(datestrs) - 1
-    # The weighting vector
-    W = np.diag(diagonals)
-
-    # print('d:', len(d), d)    # testing code
-    # print('date_pairs_used:', len(date_pairs_used))   # testing code
+    epochs = stacking_utilities.make_epoch_table(date_pairs) if epochs is None else \
+        stacking_utilities.register_epoch_table(epochs)
+    # the interferograms that fall within the desired connected component and contain real data
+    epoch_used = np.searchsorted(epochs.datestrs, datestrs).astype(np.int32)
+    in_datestrs = np.zeros(len(epochs.datestrs), dtype=bool)
+    in_datestrs[epoch_used] = True
+    in_component = in_datestrs[epochs.pair_index[:, 0]] & in_datestrs[epochs.pair_index[:, 1]]
+    used = np.flatnonzero(~np.isnan(pixel_value) & in_component).astype(np.int32)
+    d = np.asarray(pixel_value, dtype=float)[used]
+    entry = get_design_entry(epochs.network_id, used.tobytes(), epoch_used.tobytes())
 
     # More defensive programming for degenerate cases like disconnected networks
-    cc_num, num_elements, _ = stacking_utilities.connected_components_search(date_pairs_used, datestrs)
-    if num_elements <= 4:
-        print("VERY SMALL DATA MATRIX ENCOUNTERED. RETURNING VECTOR OF NANS.")
-        empty_vector = np.empty(np.shape(datestrs))  # Length of the TS model
-        empty_vector[:] = np.nan
-        return empty_vector
-    if num_elements != len(datestrs):
-        print("SINGULAR MATRIX ENCOUNTERED. RETURNING VECTOR OF NANS.")
-        empty_vector = np.empty(np.shape(datestrs))  # Length of the TS model
-        empty_vector[:] = np.nan
-        return empty_vector
-
-    # building G matrix line by line.
-    G = np.zeros([len(date_pairs_used), model_num])
-    for i in range(len(d)):
-        ith_intf = date_pairs_used[i]
-        first_image = ith_intf.split('_')[0]  # in format '2017082'
-        second_image = ith_intf.split('_')[1]  # in format '2017094'
-        first_index = datestrs.index(first_image)
-        second_index = datestrs.index(second_image)
-        for j in range(second_index - first_index):
-            G[i][first_index + j] = 1
+    if entry.status is not None:
+        diagnostics.count(entry.status)
+        return np.full(np.shape(datestrs), np.nan)
 
     # solving the SBAS linear least squares equation for displacement between each epoch.
     if coh_value is not None:
-        GTWG = np.dot(np.transpose(G), np.dot(W, G))
-        GTWd = np.dot(np.transpose(G), np.dot(W, d))
+        w = np.square(np.asarray(coh_value, dtype=float)[used])  # using coherence squared as the weighting.
+        GTWG = np.dot(entry.G.T * w, entry.G)
+        GTWd = np.dot(entry.G.T, w * d)
         m = np.dot(np.linalg.inv(GTWG), GTWd)
     else:
-        m = np.linalg.lstsq(G, d, rcond=None)[0]  # rcond=None comes from futurewarning
+        m = np.dot(entry.G_pinv, d)
 
-    # Adding up all the displacement.
-    m_cumulative = [0]
-    for i in range(1, len(m) + 1):
-        m_cumulative.append(np.sum(m[0:i]))  # The cumulative phase from start to finish!
+    # Adding up all the displacement: the cumulative phase from start to finish, in mm.
+    # Convert from range change to subsidence (negative means moving away) set beginning to zero
+    m_cumulative = np.concatenate(([0], np.cumsum(m)))
+    disp_ts = m_cumulative * -wavelength / (4 * np.pi)
+    return list(disp_ts - disp_ts[0])
 
-    # Conversion from radians to mm
-    disp_ts = [i * wavelength / (4 * np.pi) for i in m_cumulative]
 
-    # Convert from range change to subsidence (negative means moving away) set beginning to zero
-    disp_ts = [i * -1 for i in disp_ts]
-    disp_ts = [i-disp_ts[0] for i in disp_ts]
+design_entry = collections.namedtuple('design_entry', ['G', 'G_pinv', 'epoch_index', 'status'])
+
+
+@functools.lru_cache(maxsize=DESIGN_CACHE_SIZE)
+def get_design_entry(network_id, used_bytes, epoch_bytes):
+    """
+    The SBAS design matrix for one network of interferograms, and its pseudo-inverse, built once per network.
+    network_id: of the epoch table (stacking_utilities.make_epoch_table) of all the interferograms.
+    used_bytes: int32 indices of the interferograms used, and epoch_bytes: int32 epoch indices of the dates to
+    invert on, both into that table, as bytes so they can be hashed.
+    epoch_index is the epoch of each date. status is None, or the diagnostics counter for a network that
+    can't be inverted.
+    """
+    pair_index = stacking_utilities.get_registered_epoch_table(network_id).pair_index
+    epoch_index = np.frombuffer(epoch_bytes, dtype=np.int32)
+    local_pairs = np.searchsorted(epoch_index, pair_index[np.frombuffer(used_bytes, dtype=np.int32)])
+    num_elements = stacking_utilities.get_largest_component_mask(local_pairs, len(epoch_index))[1] \
+        if len(epoch_index) > 0 else 0
+    if num_elements <= 4:
+        return design_entry(None, None, None, "small_network")
+    if num_elements != len(epoch_index):
+        return design_entry(None, None, None, "singular_network")
 
-    return disp_ts
+    # building G matrix: each interferogram spans the epochs between its first and second image.
+    first_index, second_index = local_pairs[:, 0], local_pairs[:, 1]
+    columns = np.arange(len(epoch_index) - 1)
+    G = ((columns >= first_index[:, None]) & (columns < second_index[:, None])).astype(float)
+    G_pinv = np.linalg.pinv(G)
+    G.flags.writeable, G_pinv.flags.writeable = False, False   # shared between pixels
+    return design_entry(G, G_pinv, epoch_index, None)
+
+
+def get_design_cache_stats():
+    """ Hits, misses, and hit rate of the design-matrix cache so far """
+    info = get_design_entry.cache_info()
+    total = info.hits + info.misses
+    return {"hits": info.hits, "misses": info.misses, "networks": info.currsize,
+            "hit_rate": info.hits / total if total > 0 else np.nan}
 
 
 def temporal_smoothing_ts(LOS_phase, smoothing):
     """Implementing temporal smoothing after uncorrected timeseries formation.
     I'm doing this as an overconstrained linear inverse problem
-    This is similar to a Gaussian smoothing."""
-    n_TS = len(LOS_phase)
-    G_top = np.eye(n_TS)  # Constructing the G matrix
-    alpha_array = np.full((n_TS - 1,), smoothing)
-    G_positive_alpha = np.diag(alpha_array)
-    G_negative_alpha = np.diag(-alpha_array[0:-1], 1)
-    G_bottom = np.add(G_positive_alpha, G_negative_alpha)
-    G_last_column = np.zeros((n_TS - 1, 1))
-    G_last_column[-1] = -smoothing
-    G_bottom = np.hstack((G_bottom, G_last_column))
-    G = np.vstack((G_top, G_bottom))
-
-    # Constructing the data vector
-    d = np.hstack((LOS_phase, np.zeros(n_TS - 1, )))
-
-    # Implementing the smoothing
-    smoothed_los = np.dot(np.dot(np.linalg.inv(np.dot(G.T, G)), G.T), d)
-    return smoothed_los
+    This is similar to a Gaussian smoothing.
+    G = [I; smoothing * D] with D the first difference, and d = [LOS_phase; 0], so the normal equations are
+    (I + smoothing^2 D^T D) m = LOS_phase. That matrix is tridiagonal, and is factored once (get_smoothing_factor)."""
+    return smooth_ts_block(np.asarray(LOS_phase, dtype=float), smoothing)
+
+
+def smooth_ts_block(ts_block, smoothing):
+    """
+    Temporal smoothing of many time series at once.
+    ts_block: (n_dates,) or (n_dates, n_pixels) array. Columns with any nan come back as all nans.
+    """
+    factor = get_smoothing_factor(np.shape(ts_block)[0], float(smoothing))
+    return scipy.linalg.cho_solve_banded((factor, False), ts_block, check_finite=False)
+
+
+@functools.lru_cache(maxsize=64)
+def get_smoothing_factor(n_TS, smoothing):
+    """ Banded (upper) Cholesky factor of I + smoothing^2 D^T D for a time series of n_TS dates """
+    first_difference_counts = np.zeros(n_TS)
+    first_difference_counts[1:] += 1
+    first_difference_counts[:-1] += 1
+    banded = np.zeros((2, n_TS))
+    banded[1, :] = 1 + smoothing ** 2 * first_difference_counts   # diagonal
+    banded[0, 1:] = -smoothing ** 2   # super-diagonal
+    factor = scipy.linalg.cholesky_banded(banded)
+    factor.flags.writeable = False
+    return factor
 
 
 # ------------ OUTPUTS ------------ #
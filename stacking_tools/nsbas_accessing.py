@@ -1,11 +1,16 @@
 import numpy as np
 import os
+import datetime as dt
+import logging
 from s1_batches.read_write_insar_utilities import netcdf_plots
 from s1_batches.intf_generating import sentinel_utilities
-from . import stacking_utilities, nsbas, velo_uncertainties
+from . import stacking_utilities, nsbas, nsbas_metrics, nsbas_parametric, nsbas_tiles, ts_output, ts_velocity
+from . import nsbas_incremental, nsbas_checkpoint, run_report, aoi
 from . import readmytupledata as rmd
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
 
+logger = logging.getLogger(__name__)
+
 """
 Note: intf_tuple is a named tuple:
 (  
@@ -21,25 +26,31 @@ Note: intf_tuple is a named tuple:
 """
 
 
-def reader_function_gmtsar(intf_files, coh_files, baseline_file, ts_type, dem_error):
-    """A massive reader function for SBAS analysis"""
+def reader_function_gmtsar(intf_files, coh_files, baseline_file, ts_type, dem_error, cube_dir=None, region=None):
+    """
+    A massive reader function for SBAS analysis. With a cube_dir, the data cubes are memory-mapped there.
+    With a region (see aoi.py), only the area of interest of each grid is read.
+    """
     if ts_type == 'WNSBAS':
-        coh_tuple = rmd.reader(coh_files)
+        coh_tuple = rmd.reader(coh_files, rmd.get_cube_file(cube_dir, 'coh'), region)
     else:
         coh_tuple = None
     if dem_error:
         baseline_tuple = sentinel_utilities.read_baseline_table(baseline_file)
     else:
         baseline_tuple = None
-    intf_tuple = rmd.reader(intf_files)
+    intf_tuple = rmd.reader(intf_files, rmd.get_cube_file(cube_dir, 'intf'), region)
     return intf_tuple, coh_tuple, baseline_tuple
 
 
-def reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_error):
-    """A massive reader function for SBAS analysis """
-    intf_tuple = rmd.reader_isce(intf_files)
+def reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_error, cube_dir=None, region=None):
+    """
+    A massive reader function for SBAS analysis. With a cube_dir, the data cubes are memory-mapped there.
+    With a region (see aoi.py), only the area of interest of each grid is read.
+    """
+    intf_tuple = rmd.reader_isce(intf_files, cube_file=rmd.get_cube_file(cube_dir, 'intf'), region=region)
     if ts_type == 'WNSBAS':
-        coh_tuple = rmd.reader_isce(coh_files)
+        coh_tuple = rmd.reader_isce(coh_files, cube_file=rmd.get_cube_file(cube_dir, 'coh'), region=region)
     else:
         coh_tuple = None
     if dem_error:
@@ -49,10 +60,14 @@ def reader_function_isce(intf_files, coh_files, baseline_file, ts_type, dem_erro
     return intf_tuple, coh_tuple, baseline_tuple
 
 
-def repack_param_dictionary(config_params):
-    """Repacking param dictionary for NSBAS and imposing basic defensive programming. """
+def repack_param_dictionary(config_params, region=None):
+    """
+    Repacking param dictionary for NSBAS and imposing basic defensive programming.
+    With a region (see aoi.py), the reference pixel is moved into the rows and cols of the area of interest.
+    """
     rowref = int(config_params.ref_idx.split('/')[0])
     colref = int(config_params.ref_idx.split('/')[1])
+    rowref, colref = aoi.shift_to_region(rowref, colref, region)
     if config_params.file_format == 'isce':  # Working with the file formats
         my_reader_function = reader_function_isce
     else:
@@ -63,31 +78,89 @@ def repack_param_dictionary(config_params):
                         "signal_spread_filename": os.path.join(config_params.ts_output_dir,
                                                                config_params.signal_spread_filename),
                         "dem_error": config_params.dem_error, "ts_type": config_params.ts_type,
-                        "reader": my_reader_function,
-                        "baseline_file": config_params.baseline_file, "geocoded_flag": config_params.geocoded_intfs}
+                        "signal_coh_cutoff": config_params.signal_coh_cutoff,
+                        "reader": my_reader_function, "nsbas_engine": config_params.nsbas_engine,
+                        "nsbas_solver": config_params.nsbas_solver,
+                        "n_workers": config_params.nsbas_workers,
+                        "cube_dir": config_params.ts_output_dir if config_params.memmap_cube else None,
+                        "baseline_file": config_params.baseline_file, "geocoded_flag": config_params.geocoded_intfs,
+                        "start_time": config_params.start_time, "end_time": config_params.end_time,
+                        "ts_sink": config_params.ts_sink, "ts_legacy_grids": config_params.ts_legacy_grids,
+                        "step_dates": config_params.step_dates, "checkpoint": config_params.nsbas_checkpoint,
+                        "resume": config_params.resume,
+                        "region": region, "aoi_polygon": config_params.aoi_polygon,
+                        "make_signal_spread": config_params.make_signal_spread}
     return param_dictionary
 
 
-def write_output_metrics(param_dict, intf_tuple, metrics):
-    """Unpack the dictionary that contains output metrics (if any), write into files. """
+def open_run_checkpoint(param_dict, intf_tuple, coh_tuple, input_files, ts_format):
+    """
+    The checkpoint of a tiled run, in ts_output_dir/checkpoint_<ts_format>, or None unless the config asks for one
+    (nsbas_checkpoint) or we're resuming. With --resume, the finished tiles of an interrupted run are picked up,
+    unless the config or the input files have changed.
+    A signal spread made by this run (make_signal_spread = 1) is rewritten every time, so it isn't one of the hashed
+    files; it comes from the coherence files and signal_coh_cutoff, which are.
+    """
+    if not param_dict.get("checkpoint") and not param_dict.get("resume"):
+        return None
+    input_files = list(input_files) + [param_dict["baseline_file"], param_dict.get("aoi_polygon")]
+    if not param_dict.get("make_signal_spread"):
+        input_files.append(param_dict["signal_spread_filename"])
+    run_hash = nsbas_checkpoint.get_run_hash(param_dict, input_files, ts_format)
+    tiles = nsbas_tiles.get_row_tiles(len(intf_tuple.yvalues), param_dict["n_workers"],
+                                      nsbas_tiles.CHECKPOINT_TILES_PER_WORKER,
+                                      nsbas_tiles.get_tile_bytes_per_row(intf_tuple, coh_tuple))
+    return nsbas_checkpoint.open_checkpoint(os.path.join(param_dict["ts_output_dir"], 'checkpoint_' + ts_format),
+                                            run_hash, tiles, param_dict.get("resume", False))
+
+
+def read_inputs(param_dict, intf_files, coh_files):
+    """
+    The data cubes and baselines, on the area of interest if there is one (param_dict["region"]),
+    and the signal spread on the same axes.
+    """
+    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
+                                                                 param_dict["ts_type"], param_dict["dem_error"],
+                                                                 param_dict["cube_dir"], param_dict.get("region"))
+    signal_spread_tuple = stacking_utilities.read_signal_spread(param_dict["signal_spread_filename"], intf_tuple)
+    return intf_tuple, coh_tuple, baseline_tuple, signal_spread_tuple
+
+
+def write_output_metrics(param_dict, intf_tuple, outputs):
+    """
+    Write the metric layers of an NSBAS run: all of them in nsbas_metrics.nc, and Kz_error also as a grid.
+    The eligibility codes go in nsbas_metrics.nc too: 0 inverted, 1 low signal spread, 2 too few interferograms,
+    3 disconnected network, 4 too few interferograms because of the reference pixel, -1 not visited.
+    """
+    store = {x.name: outputs[x.name] for x in nsbas_metrics.get_active_metrics(param_dict)}
+    store["eligibility"] = outputs["eligibility"]
+    nsbas_metrics.write_metrics(store, intf_tuple.xvalues, intf_tuple.yvalues,
+                                os.path.join(param_dict["ts_output_dir"], 'nsbas_metrics.nc'))
     if param_dict["dem_error"]:
-        gridshape = np.shape(metrics)
-        Kz_grid = np.zeros(gridshape)
-        for i in range(gridshape[0]):
-            for j in range(gridshape[1]):
-                if "Kz_error" in metrics[i][j].keys():
-                    Kz_grid[i][j] = metrics[i][j]["Kz_error"]
-        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, Kz_grid, 'm',
-                                  os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'))
-        netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'),
-                                         'DEM Error', os.path.join(param_dict["ts_output_dir"], 'kz_error.png'),
-                                         'DEM Error (m)')
+        write_kz_grid(param_dict, intf_tuple, outputs["Kz_error"])
+    return
+
+
+def write_kz_grid(param_dict, intf_tuple, Kz_grid):
+    rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, Kz_grid, 'm',
+                              os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'))
+    netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'kz_error.grd'),
+                                     'DEM Error', os.path.join(param_dict["ts_output_dir"], 'kz_error.png'),
+                                     'DEM Error (m)')
     return
 
 
-def nsbas_ts_format_selector(config_params, intf_files, corr_files):
-    """This is the function called from the top level coordinator """
-    param_dictionary = repack_param_dictionary(config_params)
+def write_ts_cube_grids(xvalues, yvalues, ts_cube, ts_dates, zunits, outdir):
+    """Write one grid per date from a (n_dates, ny, nx) array (or cube file variable), named like 20150601.grd"""
+    for i in range(len(ts_dates)):
+        filename = os.path.join(outdir, dt.datetime.strftime(ts_dates[i], "%Y%m%d") + ".grd")
+        rwr.produce_output_netcdf(xvalues, yvalues, ts_cube[i], zunits, filename)
+    return
+
+
+def nsbas_ts_format_selector(config_params, intf_files, corr_files, region=None):
+    """This is the function called from the top level coordinator. region: area of interest from aoi.py, or None """
+    param_dictionary = repack_param_dictionary(config_params, region)
     if config_params.ts_format == 'velocity':
         drive_velocity(param_dictionary, intf_files, corr_files)
     elif config_params.ts_format == 'points':
@@ -96,36 +169,122 @@ def nsbas_ts_format_selector(config_params, intf_files, corr_files):
         drive_full_TS(param_dictionary, intf_files, corr_files)
     elif config_params.ts_format == 'velocities_from_timeseries':
         make_vels_from_ts_grids(param_dictionary, intf_files)
+    elif config_params.ts_format == 'parametric':
+        drive_parametric_model(param_dictionary, intf_files, corr_files)
+    elif config_params.ts_format == 'incremental':
+        drive_incremental_TS(param_dictionary, intf_files, config_params.file_format)
     else:
-        print("Error!")
+        logger.error("Error! Unknown ts_format %s" % config_params.ts_format)
     return
 
 
 # LET'S GET A VELOCITY FIELD FROM INTFS
 def drive_velocity(param_dict, intf_files, coh_files):
-    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
-    [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    velocities, metrics = nsbas.Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple)
-    rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, velocities, 'mm/yr',
-                              os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'))
-    netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'),
-                                     'LOS Velocity', os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.png'),
-                                     'velocity (mm/yr)')
+    with run_report.phase("read"):
+        intf_tuple, coh_tuple, baseline_tuple, signal_spread_tuple = read_inputs(param_dict, intf_files, coh_files)
+    checkpoint = open_run_checkpoint(param_dict, intf_tuple, coh_tuple, list(intf_files) + list(coh_files or []),
+                                     'velocity')
+    outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                                          'velocity', checkpoint=checkpoint)
+    with run_report.phase("write"):
+        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, outputs["velocity"], 'mm/yr',
+                                  os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'))
+        netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'),
+                                         'LOS Velocity', os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.png'),
+                                         'velocity (mm/yr)')
+        write_output_metrics(param_dict, intf_tuple, outputs)
+    nsbas_checkpoint.remove_checkpoint(checkpoint)
+    return
+
+
+# LET'S GET VELOCITY, SEASONAL TERMS, AND STEPS STRAIGHT FROM INTFS
+def drive_parametric_model(param_dict, intf_files, coh_files):
+    """
+    One grid per model parameter and one for its sigma, named like model_velocity.grd, model_velocity_sigma.grd.
+    Inverted in tiles of rows, like the velocities and time series.
+    """
+    with run_report.phase("read"):
+        intf_tuple, coh_tuple, baseline_tuple, signal_spread_tuple = read_inputs(param_dict, intf_files, coh_files)
+    checkpoint = open_run_checkpoint(param_dict, intf_tuple, coh_tuple, list(intf_files) + list(coh_files or []),
+                                     'parametric')
+    grids = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple,
+                                        'parametric', checkpoint=checkpoint)
+    parameters = nsbas_parametric.get_model_parameters(param_dict["step_dates"], param_dict["dem_error"])
+    with run_report.phase("write"):
+        for x in parameters:
+            for name in [x.name, x.name + '_sigma']:
+                rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, grids[name], x.units,
+                                          os.path.join(param_dict["ts_output_dir"], 'model_' + name + '.grd'))
+        netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'model_velocity.grd'),
+                                         'LOS Velocity', os.path.join(param_dict["ts_output_dir"],
+                                                                      'model_velocity.png'), 'velocity (mm/yr)')
+    nsbas_checkpoint.remove_checkpoint(checkpoint)
     return
 
 
 # LET'S GET THE FULL TS FOR EVERY PIXEL
 def drive_full_TS(param_dict, intf_files, coh_files):
-    param_dict["start_index"] = 0
-    param_dict["end_index"] = 11000000
-    intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
-    [_, _, signal_spread_tuple] = rwr.read_any_grd(param_dict["signal_spread_filename"])
-    TS, metrics = nsbas.Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple)
-    rwr.produce_output_TS_grids(intf_tuple.xvalues, intf_tuple.yvalues, TS, intf_tuple.ts_dates, 'mm',
-                                param_dict["ts_output_dir"])
-    write_output_metrics(param_dict, intf_tuple, metrics)
+    """
+    The whole frame is split into tiles of rows, so there's no need to run chunks by hand.
+    Finished tiles go to the ts_sink from the config (a netcdf cube by default), so memory stays bounded.
+    """
+    with run_report.phase("read"):
+        intf_tuple, coh_tuple, baseline_tuple, signal_spread_tuple = read_inputs(param_dict, intf_files, coh_files)
+    checkpoint = open_run_checkpoint(param_dict, intf_tuple, coh_tuple, list(intf_files) + list(coh_files or []),
+                                     'timeseries')
+    ts_sink = ts_output.make_ts_sink(param_dict, intf_tuple)
+    try:
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple,
+                                              coh_tuple, 'timeseries', ts_sink, checkpoint)
+    finally:
+        ts_cube = ts_sink.close()   # also on errors, so the cube file isn't left open
+    with run_report.phase("write"):
+        if param_dict["ts_legacy_grids"]:
+            with ts_output.open_ts_cube(ts_cube) as cube:
+                write_ts_cube_grids(intf_tuple.xvalues, intf_tuple.yvalues, cube, intf_tuple.ts_dates, 'mm',
+                                    param_dict["ts_output_dir"])
+        write_output_metrics(param_dict, intf_tuple, outputs)
+    nsbas_checkpoint.remove_checkpoint(checkpoint)
+    return
+
+
+# LET'S UPDATE THE TS WITH ONLY THE NEW INTFS
+def drive_incremental_TS(param_dict, intf_files, file_format):
+    """
+    Read only the interferograms that aren't in ts_output_dir/nsbas_state.nc yet, add them to the stored normal
+    equations, solve the pixels whose networks changed, and update the time series cube (nsbas_ts_cube.nc) in place,
+    and the velocities. See nsbas_incremental for what is kept.
+    With ts_legacy_grids, the grid of every date is written again too (old dates change), which costs a pass over
+    the whole cube.
+    The first run (without a state file) ingests every interferogram.
+    """
+    if param_dict["ts_type"] == 'WNSBAS':
+        raise ValueError("Incremental time series are unweighted only (ts_type = NSBAS)")
+    state_file = os.path.join(param_dict["ts_output_dir"], 'nsbas_state.nc')
+    state = nsbas_incremental.read_state(state_file)
+    date_pair_function = rmd.get_isce_date_pair if file_format == 'isce' else rmd.get_gmtsar_date_pair
+    new_files = nsbas_incremental.get_new_intf_files(state, intf_files, date_pair_function)
+    if len(new_files) == 0:
+        logger.info("No new interferograms since the last run. Nothing to update.")
+        return
+    with run_report.phase("read"):
+        intf_tuple, _, baseline_tuple, signal_spread_tuple = read_inputs(param_dict, new_files, [])
+    if state is None:
+        state = nsbas_incremental.create_state(state_file, intf_tuple, param_dict)
+    state, changed = nsbas_incremental.ingest(state, intf_tuple, param_dict)
+    cube_file = os.path.join(param_dict["ts_output_dir"], 'nsbas_ts_cube.nc')
+    nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread_tuple, cube_file, baseline_tuple)
+    with run_report.phase("write"):
+        if param_dict["ts_legacy_grids"]:
+            with ts_output.open_ts_cube(cube_file) as cube:
+                write_ts_cube_grids(state.xvalues, state.yvalues, cube, ts_output.get_cube_dates(cube_file), 'mm',
+                                    param_dict["ts_output_dir"])
+        rwr.produce_output_netcdf(state.xvalues, state.yvalues, nsbas_incremental.read_velocity(state), 'mm/yr',
+                                  os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'))
+        netcdf_plots.produce_output_plot(os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.grd'),
+                                         'LOS Velocity', os.path.join(param_dict["ts_output_dir"], 'velo_nsbas.png'),
+                                         'velocity (mm/yr)')
+    nsbas_incremental.finish_update(state)
     return
 
 
@@ -135,11 +294,13 @@ def drive_point_ts(param_dict, intf_files, coh_files, ts_points_file):
     For general use, please provide a file with [lon, lat, row, col, name] """
     lons, lats, names, rows, cols = stacking_utilities.drive_cache_ts_points(ts_points_file, intf_files[0],
                                                                              param_dict["geocoded_flag"])
+    lons, lats, names, rows, cols = get_points_in_region(lons, lats, names, rows, cols, param_dict.get("region"))
     outdir = os.path.join(param_dict["ts_output_dir"], "ts")
     os.makedirs(outdir, exist_ok=True)
-    print("Computing TS for %d pixels" % len(lons))
+    logger.info("Computing TS for %d pixels" % len(lons))
     intf_tuple, coh_tuple, baseline_tuple = param_dict["reader"](intf_files, coh_files, param_dict["baseline_file"],
-                                                                 param_dict["ts_type"], param_dict["dem_error"])
+                                                                 param_dict["ts_type"], param_dict["dem_error"],
+                                                                 param_dict["cube_dir"], param_dict.get("region"))
     signal_spread_tuple = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))  # forcing TS compute, even for noisy pixels.
     nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
     datestrs, x_dts, x_axis_days = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
@@ -148,16 +309,32 @@ def drive_point_ts(param_dict, intf_files, coh_files, ts_points_file):
         TS, nanflag, output_metrics_dict = nsbas.compute_TS(rows[i], cols[i], param_dict, intf_tuple,
                                                             signal_spread_tuple, baseline_tuple, coh_tuple, datestrs)
         nsbas.nsbas_ts_points_outputs(x_dts, TS[0], rows[i], cols[i], names[i], lons[i], lats[i], outdir)
+    nsbas.flush_correction_times()
     return
 
 
+def get_points_in_region(lons, lats, names, rows, cols, region):
+    """ The points inside the area of interest, with their full-frame rows and cols moved into the region """
+    if region is None:
+        return lons, lats, names, rows, cols
+    keep = []
+    for i in range(len(rows)):
+        try:
+            rows[i], cols[i] = aoi.shift_to_region(int(rows[i]), int(cols[i]), region)
+            keep.append(i)
+        except ValueError:
+            logger.warning("Skipping point %s, outside the area of interest." % names[i])
+    return [[x[i] for i in keep] for x in [lons, lats, names, rows, cols]]
+
+
 def make_vels_from_ts_grids(param_dictionary, ts_slice_files):
     """
     Given existing TS grid files, create an estimate of velocity.
+    The grids are read a tile of rows at a time, and only dates between start_time and end_time are used.
     """
-    mydata = rmd.reader_from_ts(ts_slice_files)  # read filelist of time series grids
-    vel = nsbas.Velocities_from_TS(mydata)
-    rwr.produce_output_netcdf(mydata.xvalues, mydata.yvalues, vel, 'mm/yr',
+    xvalues, yvalues, fit = ts_velocity.fit_ts_files(ts_slice_files, param_dictionary.get("start_time"),
+                                                     param_dictionary.get("end_time"), max_nans=30)
+    rwr.produce_output_netcdf(xvalues, yvalues, fit.velocity, 'mm/yr',
                               os.path.join(param_dictionary["ts_output_dir"], 'velo_nsbas.grd'))
     netcdf_plots.produce_output_plot(os.path.join(param_dictionary["ts_output_dir"], 'velo_nsbas.grd'), 'LOS Velocity',
                                      os.path.join(param_dictionary["ts_output_dir"], 'velo_nsbas.png'),
@@ -170,9 +347,8 @@ def make_vel_unc_from_ts_grids(ts_slice_files, outdir):
     Given existing TS grid files, create an estimate of velocity uncertainty.
     I have called this function from outside of the program.  Can be called separately.
     """
-    mydata = rmd.reader_from_ts(ts_slice_files)  # read filelist of time series grids
-    unc = velo_uncertainties.empirical_uncertainty(mydata)
-    rwr.produce_output_netcdf(mydata.xvalues, mydata.yvalues, unc, 'mm/yr', os.path.join(outdir, 'velo_unc.grd'))
+    xvalues, yvalues, fit = ts_velocity.fit_ts_files(ts_slice_files, max_nans=30)
+    rwr.produce_output_netcdf(xvalues, yvalues, fit.empirical_unc, 'mm/yr', os.path.join(outdir, 'velo_unc.grd'))
     netcdf_plots.produce_output_plot(os.path.join(outdir, 'velo_unc.grd'), 'LOS Uncertainty',
                                      os.path.join(outdir, 'velo_unc.png'), 'Uncertainty (mm/yr)')
     return
@@ -0,0 +1,470 @@
+"""
+A batched engine for NSBAS inversions.
+Pixels whose valid interferograms are identical share the same design matrix.
+We therefore compute a bitmask of valid interferograms for every pixel, group pixels with identical masks,
+and solve each group with one factorization of G and a multi-RHS matrix product.
+The same masks give every pixel an eligibility code (compute_eligibility) before anything is solved, so both
+engines only visit the pixels they can invert, and the codes are written out as a diagnostic layer.
+The per-pixel functions in nsbas.py remain the reference implementation (nsbas_engine = pixel).
+For very large networks, nsbas_solver = sparse keeps G as a sparse matrix and solves each pixel with LSMR,
+warm-started from the previous pixel of the group (its neighbor, since groups are in raster order).
+"""
+
+import numpy as np
+import collections
+import scipy.sparse
+import scipy.sparse.linalg
+import datetime as dt
+import logging
+import time
+from . import stacking_utilities, nsbas, nsbas_metrics, dem_error_correction, diagnostics, run_report
+
+SPARSE_TOLERANCE = 1e-10   # relative stopping tolerance of LSMR (atol and btol)
+WEIGHTED_SOLVE_BYTES = 256 * 2 ** 20   # memory for the per-pixel normal matrices of a weighted solve
+logger = logging.getLogger(__name__)
+
+# Eligibility codes: why a pixel is inverted or not. Pixels outside start_index/end_index are NOT_VISITED.
+NOT_VISITED, ELIGIBLE, LOW_SIGNAL_SPREAD, TOO_FEW_INTFS, DISCONNECTED, REFERENCE_NAN = -1, 0, 1, 2, 3, 4
+ELIGIBILITY_COUNTERS = {LOW_SIGNAL_SPREAD: "low_signal_spread", TOO_FEW_INTFS: "too_many_nans",
+                        DISCONNECTED: "disconnected", REFERENCE_NAN: "reference_nan"}   # names in diagnostics
+
+# codes: (n_rows, nx) int8. signatures, groups: the pixels that pass the per-pixel tests, as in
+# group_pixels_by_signature. group_epochs: for each group, the epochs of the network it's inverted on.
+# connected: for each group, whether that network can be inverted (if not, its pixels are DISCONNECTED).
+eligibility = collections.namedtuple('eligibility', ['codes', 'signatures', 'groups', 'group_epochs', 'connected'])
+
+
+# ------------ VALIDITY MASKS AND GROUPING ------------ #
+
+def compute_validity_bitmasks(param_dict, intf_tuple, coh_tuple=None, coh_cutoff=None, row_range=None,
+                              block_rows=256):
+    """
+    For every pixel, which interferograms have real data after the reference pixel has been removed?
+    Done one block of rows at a time, so we never hold a boolean copy of the full cube.
+    :returns: packed bits with shape (ceil(n_intf/8), n_rows, nx), uint8
+    If coh_tuple and coh_cutoff are given, an interferogram also needs coherence above the cutoff to be valid.
+    row_range: optional (first_row, last_row+1) if we only want masks for a tile of rows.
+    """
+    n_intf, ny, nx = np.shape(intf_tuple.zvalues)
+    first_row, last_row = row_range if row_range is not None else (0, ny)
+    ref_values = intf_tuple.zvalues[:, param_dict["rowref"], param_dict["colref"]]
+    packed = np.zeros((int(np.ceil(n_intf / 8)), last_row - first_row, nx), dtype=np.uint8)
+    for r0 in range(first_row, last_row, block_rows):
+        r1 = min(r0 + block_rows, last_row)
+        block = np.subtract(intf_tuple.zvalues[:, r0:r1, :], ref_values[:, None, None])
+        valid = ~np.isnan(block)
+        if coh_tuple is not None and coh_cutoff is not None:
+            valid &= coh_tuple.zvalues[:, r0:r1, :] > coh_cutoff
+        packed[:, r0 - first_row:r1 - first_row, :] = np.packbits(valid, axis=0)
+    return packed
+
+
+def group_pixels_by_signature(packed_masks, pixel_indices):
+    """
+    Group pixels that share an identical validity bitmask.
+    :param packed_masks: 2D array (n_bytes, n_pixels) of packed bits, one column per pixel of the frame
+    :param pixel_indices: 1D array of flat pixel indices that we want to invert
+    :returns: unique signatures (n_groups, n_bytes), and a list of flat pixel indices belonging to each group
+    """
+    signatures = np.ascontiguousarray(packed_masks[:, pixel_indices].T)
+    unique_signatures, inverse = np.unique(signatures, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.cumsum(np.bincount(inverse, minlength=len(unique_signatures)))[:-1]
+    groups = np.split(pixel_indices[order], boundaries) if len(pixel_indices) > 0 else []
+    return unique_signatures, groups
+
+
+def count_bits(packed):
+    """ Number of set bits in each column of (n_bytes, n_pixels) packed bits """
+    counts = np.zeros(np.shape(packed)[1], dtype=int)
+    for byte_row in packed:
+        counts += np.unpackbits(byte_row[None, :], axis=0).sum(axis=0, dtype=int)
+    return counts
+
+
+def count_valid_intfs(param_dict, intf_tuple, nonnan_counts, row_range=None, block_rows=256):
+    """
+    Non-nan interferograms at each pixel before the reference pixel is removed (flat, for the rows in row_range).
+    If the reference pixel has no nans, these are just nonnan_counts, and the cube isn't read again.
+    """
+    n_intf, ny, nx = np.shape(intf_tuple.zvalues)
+    if not np.any(np.isnan(intf_tuple.zvalues[:, param_dict["rowref"], param_dict["colref"]])):
+        return nonnan_counts
+    first_row, last_row = row_range if row_range is not None else (0, ny)
+    counts = np.zeros((last_row - first_row, nx), dtype=int)
+    for r0 in range(first_row, last_row, block_rows):
+        r1 = min(r0 + block_rows, last_row)
+        counts[r0 - first_row:r1 - first_row] = np.sum(~np.isnan(intf_tuple.zvalues[:, r0:r1, :]), axis=0)
+    return np.ravel(counts)
+
+
+def get_eligibility_codes(param_dict, nonnan_counts, signal_spread_tuple, n_intf, start_index=0, end_index=None,
+                          row_range=None, own_counts=None):
+    """
+    The per-pixel tests of nsbas.compute_TS as eligibility codes, flat (C-order) for the rows in row_range:
+    signal spread above nsbas_good_perc (else LOW_SIGNAL_SPREAD), and fewer than 50% nan interferograms
+    (else TOO_FEW_INTFS, or REFERENCE_NAN if the pixel only fails because of nans at the reference pixel).
+    start_index and end_index count pixels in the same (column-major) order as nsbas.iterator_func.
+    row_range: optional (first_row, last_row+1); nonnan_counts then only covers the pixels of those rows.
+    own_counts: optional non-nan counts before the reference pixel is removed (count_valid_intfs).
+    :returns: int8 array, one code per pixel
+    """
+    ny, nx = np.shape(signal_spread_tuple)
+    first_row, last_row = row_range if row_range is not None else (0, ny)
+    flat_idx = np.arange(first_row * nx, last_row * nx)
+    rows, cols = np.unravel_index(flat_idx, (ny, nx))
+    fortran_order = cols * ny + rows   # position of each pixel in the column-major iteration
+    if end_index is None:
+        end_index = ny * nx
+    visited = (fortran_order >= start_index) & (fortran_order < end_index)
+    codes = np.where(visited, ELIGIBLE, NOT_VISITED).astype(np.int8)
+    too_few = visited & (nonnan_counts <= n_intf * 0.5)
+    codes[too_few] = TOO_FEW_INTFS
+    if own_counts is not None:
+        codes[too_few & (own_counts > n_intf * 0.5)] = REFERENCE_NAN
+    codes[visited & ~(np.ravel(signal_spread_tuple)[flat_idx] > param_dict["nsbas_good_perc"])] = LOW_SIGNAL_SPREAD
+    return codes
+
+
+def get_eligible_pixels(param_dict, nonnan_counts, signal_spread_tuple, n_intf, start_index=0, end_index=None,
+                        row_range=None):
+    """
+    Flat (C-order) indices of pixels that pass the per-pixel tests of get_eligibility_codes.
+    :returns: eligible flat indices, and all flat indices visited between start_index and end_index
+    """
+    codes = get_eligibility_codes(param_dict, nonnan_counts, signal_spread_tuple, n_intf, start_index, end_index,
+                                  row_range)
+    nx = np.shape(signal_spread_tuple)[1]
+    flat_idx = np.arange(row_range[0] * nx, row_range[1] * nx) if row_range is not None else np.arange(len(codes))
+    return flat_idx[codes == ELIGIBLE], flat_idx[codes != NOT_VISITED]
+
+
+def compute_eligibility(param_dict, intf_tuple, signal_spread_tuple, coh_tuple=None, per_pixel_networks=False,
+                        start_index=0, end_index=None, row_range=None, check_networks=True):
+    """
+    The vectorized pre-pass of both engines: an eligibility code for every pixel (of the rows in row_range),
+    and the groups of pixels with identical networks, so that the solver only visits pixels it can invert.
+    After the per-pixel tests (get_eligibility_codes), a pixel is DISCONNECTED if the network it would be inverted
+    on has 4 or fewer dates, or (for time series) doesn't connect every date. That is checked once per group.
+    per_pixel_networks: as in group_iterator. For velocities with coherence, the selection also depends on coherence.
+    check_networks: False for models that don't need a connected network (nsbas_parametric). No pixel is then
+    DISCONNECTED, and every group keeps all the dates.
+    :returns: eligibility tuple, with flat pixel indices of the whole frame in groups
+    """
+    n_intf = len(intf_tuple.date_pairs_julian)
+    ny, nx = np.shape(signal_spread_tuple)
+    first_row, last_row = row_range if row_range is not None else (0, ny)
+    epochs = stacking_utilities.get_epoch_table(intf_tuple)
+    n_dates = len(epochs.datestrs)
+    nonnan_bits = compute_validity_bitmasks(param_dict, intf_tuple, row_range=row_range)
+    nonnan_bits = nonnan_bits.reshape(np.shape(nonnan_bits)[0], -1)
+    nonnan_counts = count_bits(nonnan_bits)
+    codes = get_eligibility_codes(param_dict, nonnan_counts, signal_spread_tuple, n_intf, start_index, end_index,
+                                  row_range, count_valid_intfs(param_dict, intf_tuple, nonnan_counts, row_range))
+
+    # The grouping signature. For velocities with coherence, the selection also depends on coherence.
+    n_bytes = np.shape(nonnan_bits)[0]
+    signature_bits = nonnan_bits
+    if per_pixel_networks and coh_tuple is not None:
+        coh_bits = compute_validity_bitmasks(param_dict, intf_tuple, coh_tuple, param_dict["signal_coh_cutoff"],
+                                             row_range)
+        signature_bits = np.vstack((nonnan_bits, coh_bits.reshape(np.shape(coh_bits)[0], -1)))
+    signatures, groups = group_pixels_by_signature(signature_bits, np.flatnonzero(codes == ELIGIBLE))
+    if not check_networks:
+        group_epochs, connected = [np.arange(n_dates)] * len(groups), np.ones(len(groups), dtype=bool)
+    elif per_pixel_networks and len(groups) > 0:   # the largest connected component of each group's network
+        selected = np.unpackbits(signatures[:, -n_bytes:], axis=1)[:, 0:n_intf].astype(bool)
+        _, group_epochs = stacking_utilities.reduce_masks_to_largest_cc(epochs, selected)
+        connected = np.array([len(x) > 4 for x in group_epochs], dtype=bool)
+    else:   # every group is inverted on the full list of dates
+        group_epochs = [np.arange(n_dates)] * len(groups)
+        connected = np.array([n_dates > 4 and np.max(stacking_utilities.label_connected_epochs(
+            epochs.pair_index[np.unpackbits(x)[0:n_intf].astype(bool)], n_dates)) == 1
+                              for x in signatures[:, 0:n_bytes]], dtype=bool)
+    for g in np.flatnonzero(~connected):
+        codes[groups[g]] = DISCONNECTED
+    for code, name in ELIGIBILITY_COUNTERS.items():
+        diagnostics.count(name, np.sum(codes == code))
+    return eligibility(codes=codes.reshape(last_row - first_row, nx), signatures=signatures,
+                       groups=[x + first_row * nx for x in groups], group_epochs=group_epochs, connected=connected)
+
+
+# ------------ BATCHED MATH ------------ #
+
+def build_nsbas_G(date_pairs_used, datestrs):
+    """ The SBAS design matrix for a network of interferograms, the same one built in nsbas.do_nsbas_pixel. """
+    epoch_index = {x: k for k, x in enumerate(datestrs)}
+    G = np.zeros([len(date_pairs_used), len(datestrs) - 1])
+    for i, ith_intf in enumerate(date_pairs_used):
+        G[i, epoch_index[ith_intf[0:7]]:epoch_index[ith_intf[8:15]]] = 1
+    return G
+
+
+def build_nsbas_G_sparse(date_pairs_used, datestrs):
+    """ The same design matrix as build_nsbas_G, in compressed sparse row format """
+    epoch_index = {x: k for k, x in enumerate(datestrs)}
+    starts = np.array([epoch_index[x[0:7]] for x in date_pairs_used], dtype=int)
+    ends = np.array([epoch_index[x[8:15]] for x in date_pairs_used], dtype=int)
+    lengths = ends - starts
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, lengths)   # starts[i] ... ends[i]-1
+    return scipy.sparse.csr_matrix((np.ones(indptr[-1]), indices, indptr),
+                                   shape=(len(date_pairs_used), len(datestrs) - 1))
+
+
+def solve_sparse_block(G, pixel_values, coh_values=None, tolerance=SPARSE_TOLERANCE):
+    """
+    Least squares with LSMR for each pixel (column of pixel_values), warm-started from the previous pixel.
+    G: sparse (n_intf_used, n_dates-1) design matrix.
+    coh_values: coherence, for weighted least squares as in do_nsbas_block (the weights are coherence squared).
+    :returns: (n_dates-1, n_pixels) incremental phases
+    """
+    n_pixels = np.shape(pixel_values)[1]
+    m = np.zeros((np.shape(G)[1], n_pixels))
+    x0 = None
+    for k in range(n_pixels):
+        A, b = G, pixel_values[:, k]
+        if coh_values is not None:
+            A = scipy.sparse.diags(coh_values[:, k]).dot(G)   # rows scaled by the square root of the weights
+            b = coh_values[:, k] * b
+        x0 = scipy.sparse.linalg.lsmr(A, b, atol=tolerance, btol=tolerance, x0=x0)[0]
+        m[:, k] = x0
+    return m
+
+
+def do_nsbas_block(pixel_values, date_pairs_used, wavelength, datestrs, coh_values=None):
+    """
+    The multi-pixel version of nsbas.do_nsbas_pixel, for pixels that share one network.
+    pixel_values: (n_intf_used, n_pixels) array of referenced phase, without nans
+    date_pairs_used: list of n_intf_used strings, format 2015157_2018177
+    datestrs: list of the dates we want to invert on, in format 2015157
+    coh_values: (n_intf_used, n_pixels) array of coherence for weighted least squares, or None
+    :returns: (n_dates, n_pixels) array of displacements in mm
+    """
+    _, m, _ = solve_nsbas_block(pixel_values, date_pairs_used, datestrs, coh_values)
+    return model_to_ts_block(m, wavelength, len(datestrs), np.shape(pixel_values)[1])
+
+
+def solve_nsbas_block(pixel_values, date_pairs_used, datestrs, coh_values=None, solver='dense'):
+    """
+    The inversion itself, with the same inputs as do_nsbas_block.
+    solver: 'dense' (one pseudo-inverse for the whole group) or 'sparse' (LSMR for each pixel, see solve_sparse_block)
+    :returns: G, the (n_dates-1, n_pixels) incremental phases, and the singular values of G if the solve computed
+    them (None otherwise). (None, None, None) if the network can't be inverted.
+    """
+    n_pixels = np.shape(pixel_values)[1]
+
+    # More defensive programming for degenerate cases like disconnected networks
+    cc_num, num_elements, _ = stacking_utilities.connected_components_search(date_pairs_used, datestrs)
+    if num_elements <= 4:
+        diagnostics.count("small_network", n_pixels)
+        return None, None, None
+    if num_elements != len(datestrs):
+        diagnostics.count("singular_network", n_pixels)
+        return None, None, None
+
+    if solver == 'sparse':
+        with run_report.phase("G build", n_pixels):
+            G = build_nsbas_G_sparse(date_pairs_used, datestrs)
+        return G, solve_sparse_block(G, pixel_values, coh_values), None
+    with run_report.phase("G build", n_pixels):
+        G = build_nsbas_G(date_pairs_used, datestrs)
+    if coh_values is not None:
+        return G, solve_weighted_block(G, pixel_values, coh_values), None
+    G_pinv, singular_values = pinv_with_singular_values(G)   # one factorization for the whole group
+    return G, np.dot(G_pinv, pixel_values), singular_values
+
+
+def pinv_with_singular_values(G, rcond=1e-15):
+    """ np.linalg.pinv, also returning the singular values of G from the same SVD (for the condition number) """
+    U, s, Vt = np.linalg.svd(G, full_matrices=False)
+    s_inv = np.zeros(np.shape(s))
+    large = s > rcond * np.max(s, initial=0)
+    s_inv[large] = 1 / s[large]
+    return np.dot(Vt.T * s_inv, U.T), s
+
+
+def solve_weighted_block(G, pixel_values, coh_values, max_bytes=WEIGHTED_SOLVE_BYTES):
+    """
+    Weighted least squares for each pixel (column of pixel_values), with coherence squared as the weights.
+    Every pixel has its own (k, k) normal matrix, so they are built and solved a chunk of pixels at a time,
+    with the chunk sized so that the normal matrices and their factorization fit in max_bytes for any k.
+    :returns: (k, n_pixels) incremental phases
+    """
+    k = np.shape(G)[1]
+    n_pixels = np.shape(pixel_values)[1]
+    chunk = max(1, int(max_bytes // (2 * 8 * k * k)))
+    m = np.empty((k, n_pixels))
+    for c0 in range(0, n_pixels, chunk):
+        W = np.square(coh_values[:, c0:c0 + chunk])   # using coherence squared as the weighting.
+        GTWG = np.einsum('ik,ip,il->pkl', G, W, G)
+        GTWd = np.einsum('ik,ip->pk', G, W * pixel_values[:, c0:c0 + chunk])
+        m[:, c0:c0 + chunk] = np.linalg.solve(GTWG, GTWd[:, :, None])[:, :, 0].T
+    return m
+
+
+def model_to_ts_block(m, wavelength, n_dates, n_pixels):
+    """ Incremental phases (or None) to a (n_dates, n_pixels) array of displacements in mm """
+    if m is None:
+        return np.full((n_dates, n_pixels), np.nan)
+    m_cumulative = np.vstack((np.zeros((1, n_pixels)), np.cumsum(m, axis=0)))
+    disp_ts = m_cumulative * -wavelength / (4 * np.pi)   # radians to mm, range change to LOS displacement
+    disp_ts = disp_ts - disp_ts[0, :]
+    return disp_ts
+
+
+def velocity_block(ts_block, x_axis_days):
+    """ Linear velocity (mm/yr) for each column of a (n_dates, n_pixels) array of time series """
+    coeffs = np.polyfit(x_axis_days, ts_block, 1)
+    return coeffs[0] * 365.24
+
+
+# ------------ COMPUTE ------------ #
+
+def Velocities(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple):
+    """ Batched version of nsbas.Velocities. Same inputs, same outputs. """
+    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    retval_main = np.full([len(intf_tuple.yvalues), len(intf_tuple.xvalues)], np.nan)
+    retval_metrics = [[{} for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
+
+    def group_function(group_datestrs, group_x_axis_days, flat_idx, ts_block, metrics):
+        rows, cols = np.unravel_index(flat_idx, np.shape(retval_main))
+        good_columns = ~np.all(np.isnan(ts_block), axis=0)
+        if np.any(good_columns):
+            retval_main[rows[good_columns], cols[good_columns]] = velocity_block(ts_block[:, good_columns],
+                                                                               group_x_axis_days)
+        for k in range(len(flat_idx)):
+            retval_metrics[rows[k]][cols[k]] = get_legacy_metrics(metrics, k)
+        return
+
+    group_iterator(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, group_function,
+                   per_pixel_networks=True)
+    return retval_main, retval_metrics
+
+
+def Full_TS(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple):
+    """ Batched version of nsbas.Full_TS. Same inputs, same outputs. """
+    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    datestrs, x_dts, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
+    empty_vector = [np.empty(np.shape(datestrs))]
+    retval_main = [[empty_vector for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
+    retval_metrics = [[{} for _i in range(len(intf_tuple.xvalues))] for _j in range(len(intf_tuple.yvalues))]
+    gridshape = (len(intf_tuple.yvalues), len(intf_tuple.xvalues))
+
+    def group_function(_group_datestrs, _group_x_axis_days, flat_idx, ts_block, metrics):
+        rows, cols = np.unravel_index(flat_idx, gridshape)
+        for k in range(len(flat_idx)):
+            retval_main[rows[k]][cols[k]] = [ts_block[:, k]]
+            retval_metrics[rows[k]][cols[k]] = get_legacy_metrics(metrics, k)
+        return
+
+    group_iterator(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, group_function,
+                   per_pixel_networks=False, start_index=param_dict.get("start_index", 0),
+                   end_index=param_dict.get("end_index"))
+    return retval_main, retval_metrics
+
+
+def get_legacy_metrics(metrics, k):
+    """ The per-pixel metrics dictionary that nsbas.Velocities and nsbas.Full_TS return, for pixel k of a block """
+    return {"Kz_error": float(metrics["Kz_error"][k])} if "Kz_error" in metrics else {}
+
+
+def group_iterator(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, group_function,
+                   per_pixel_networks, start_index=0, end_index=None, row_range=None, max_pixels_per_solve=100000):
+    """
+    The batched counterpart of nsbas.iterator_func.
+    1. compute validity bitmasks and eligibility codes for the whole cube (or for the rows in row_range),
+    2. group the pixels that pass the per-pixel tests by identical bitmask (compute_eligibility),
+    3. invert each group at once, and hand the results to group_function. Groups whose network can't be inverted
+    are not solved, but their metrics still describe the network.
+    per_pixel_networks: if True, each group is reduced to the largest connected component of its own network
+    (the behavior of nsbas.compute_vel). Otherwise every group is inverted on the full list of dates (compute_TS).
+    group_function(group_datestrs, group_x_axis_days, flat_idx, ts_block, metrics) stores the results.
+    metrics is a dict of name -> one value per pixel, for each metric registered in nsbas_metrics.
+    :returns: the (n_rows, nx) int8 eligibility codes of the pixels (see compute_eligibility)
+    Progress is logged at INFO for a whole frame, and at DEBUG for a tile of rows (the tile scheduler reports those).
+    """
+    log_level = logging.DEBUG if row_range is not None else logging.INFO
+    logger.log(log_level, "Performing batched iteration on %d files" % (len(intf_tuple.zvalues)))
+    logger.log(log_level, "Started at: %s" % dt.datetime.now())
+    n_intf = len(intf_tuple.date_pairs_julian)
+    date_pairs = list(intf_tuple.date_pairs_julian)
+    epochs = stacking_utilities.get_epoch_table(intf_tuple)
+    datestrs, x_axis_days = list(epochs.datestrs), list(epochs.days)
+    start_selection = time.perf_counter()
+    pixels = compute_eligibility(param_dict, intf_tuple, signal_spread_tuple, coh_tuple, per_pixel_networks,
+                                 start_index, end_index, row_range)
+    codes = np.ravel(pixels.codes)
+    offset = row_range[0] * np.shape(signal_spread_tuple)[1] if row_range is not None else 0
+
+    # Pixels that we visit but don't invert get a vector of nans, as in compute_TS.
+    ineligible = np.flatnonzero((codes != ELIGIBLE) & (codes != NOT_VISITED)) + offset
+    if len(ineligible) > 0:
+        group_function(datestrs, x_axis_days, ineligible, np.full((len(datestrs), len(ineligible)), np.nan),
+                       nsbas_metrics.empty_block_metrics(param_dict, len(ineligible)))
+    signatures, groups = pixels.signatures, pixels.groups
+    n_eligible = int(np.sum([len(x) for x in groups]))   # including the disconnected ones, which go fast
+    run_report.add_phase_time("pixel selection", time.perf_counter() - start_selection, np.sum(codes != NOT_VISITED))
+    logger.log(log_level, "Inverting %d pixels in %d groups of identical interferogram networks" %
+               (n_eligible, len(groups)))
+    progress = diagnostics.make_progress(n_eligible, level=log_level)
+
+    zvalues_flat = intf_tuple.zvalues.reshape(n_intf, -1)
+    coh_flat = coh_tuple.zvalues.reshape(n_intf, -1) if coh_tuple is not None else None
+    ref_values = intf_tuple.zvalues[:, param_dict["rowref"], param_dict["colref"]]
+    n_bytes = int(np.ceil(n_intf / 8))
+    for g in range(len(groups)):
+        nonnan = np.unpackbits(signatures[g, 0:n_bytes])[0:n_intf].astype(bool)
+        group_epochs = pixels.group_epochs[g]
+        group_datestrs = list(epochs.datestrs[group_epochs])
+        group_x_axis_days = list(epochs.days[group_epochs] - epochs.days[group_epochs[0]]) \
+            if len(group_epochs) else []
+        in_group = np.zeros(len(datestrs), dtype=bool)
+        in_group[group_epochs] = True
+        used = np.flatnonzero(nonnan & in_group[epochs.pair_index[:, 0]] & in_group[epochs.pair_index[:, 1]])
+        date_pairs_used = [date_pairs[k] for k in used]
+        network_index = np.searchsorted(group_epochs, epochs.pair_index[used])   # pairs in the group's own dates
+        if len(group_epochs) < len(datestrs) and pixels.connected[g]:
+            diagnostics.count("graph_reduction", len(groups[g]))
+
+        for c0 in range(0, len(groups[g]), max_pixels_per_solve):
+            flat_idx = groups[g][c0:c0 + max_pixels_per_solve]
+            pixel_values = zvalues_flat[np.ix_(used, flat_idx)] - ref_values[used][:, None]
+            coh_values = coh_flat[np.ix_(used, flat_idx)] if coh_flat is not None else None
+            G, m, singular_values = None, None, None
+            if pixels.connected[g]:
+                with run_report.phase("solve", len(flat_idx)):
+                    G, m, singular_values = solve_nsbas_block(pixel_values, date_pairs_used, group_datestrs,
+                                                              coh_values, param_dict.get("nsbas_solver", 'dense'))
+                diagnostics.count("inverted", len(flat_idx))
+            ts_block = model_to_ts_block(m, param_dict["wavelength"], len(group_datestrs), len(flat_idx))
+            ts_block, Kz_error = apply_corrections_block(param_dict, ts_block, group_datestrs, baseline_tuple)
+            with run_report.phase("metrics", len(flat_idx)):
+                block = nsbas_metrics.solved_block(G=G, pixel_values=pixel_values, model=m, ts_block=ts_block,
+                                                   kz_error=Kz_error, pair_index=network_index,
+                                                   n_dates=len(group_datestrs), singular_values=singular_values)
+                metrics = nsbas_metrics.compute_block_metrics(param_dict, block)
+            if pixels.connected[g]:
+                diagnostics.count("nan_only", np.sum(np.all(np.isnan(ts_block), axis=0)))
+            group_function(group_datestrs, group_x_axis_days, flat_idx, ts_block, metrics)
+            progress.update(len(flat_idx))
+    progress.finish()
+    logger.log(log_level, "Finished at: %s" % dt.datetime.now())
+    return pixels.codes
+
+
+def apply_corrections_block(param_dict, ts_block, datestrs, baseline_tuple):
+    """
+    DEM error correction and temporal smoothing, applied to each column of a (n_dates, n_pixels) block.
+    :returns: corrected block, and the Kz_error of each pixel (None without the DEM error correction)
+    """
+    n_pixels = np.shape(ts_block)[1]
+    Kz_error = None
+    if param_dict["dem_error"]:
+        with run_report.phase("DEM correction", n_pixels):
+            ts_block, Kz_error = dem_error_correction.driver_block(ts_block, datestrs, baseline_tuple)
+    if param_dict["sbas_smoothing"] > 0:
+        with run_report.phase("smoothing", n_pixels):
+            ts_block = nsbas.smooth_ts_block(ts_block, param_dict["sbas_smoothing"])   # one banded solve
+    return ts_block, Kz_error
@@ -0,0 +1,103 @@
+"""
+Checkpoints for long tiled NSBAS runs.
+Checkpoints are opt-in (nsbas_checkpoint in the config).
+Every finished tile of rows is saved as a compressed .npz file in the checkpoint directory, and listed in manifest.json
+together with the tile layout and a hash of the configuration and input files. A run started with --resume
+reloads the finished tiles and only computes the rest. If the configuration or the inputs changed since the
+checkpoint was written, it refuses to resume. The checkpoint is removed once the outputs of the run are written.
+"""
+
+import numpy as np
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+checkpoint_store = collections.namedtuple('checkpoint_store', ['directory', 'run_hash', 'tiles', 'completed'])
+logger = logging.getLogger(__name__)
+
+
+def get_run_hash(param_dict, input_files, ts_format):
+    """
+    Hash of everything that decides the answer: the parameters (except functions, like the reader, and the number
+    of workers), the output format, and the name, size, and modification time of each input file.
+    """
+    params = {key: value for key, value in param_dict.items()
+              if not callable(value) and key not in ["checkpoint", "resume", "n_workers"]}
+    files = []
+    for filename in input_files:
+        info = os.stat(filename) if filename and os.path.isfile(filename) else None
+        files.append([filename, info.st_size if info else None, info.st_mtime if info else None])
+    description = json.dumps({"params": params, "ts_format": ts_format, "files": files}, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def get_manifest_file(directory):
+    return os.path.join(directory, 'manifest.json')
+
+
+def get_tile_file(directory, row_range):
+    return os.path.join(directory, 'tile_%06d_%06d.npz' % (row_range[0], row_range[1]))
+
+
+def open_checkpoint(directory, run_hash, tiles, resume=False):
+    """
+    Start a checkpoint (clearing any old one), or with resume, pick up the one in directory.
+    :param tiles: list of (r0, r1) row ranges for a new run. On resume, the stored tile layout is used instead.
+    :returns: checkpoint_store
+    """
+    manifest_file = get_manifest_file(directory)
+    if resume and os.path.isfile(manifest_file):
+        manifest = json.load(open(manifest_file))
+        if manifest["run_hash"] != run_hash:
+            raise ValueError("Refusing to resume from %s: the configuration or input files have changed since the "
+                             "checkpoint was written. Run without --resume to start over." % directory)
+        store = checkpoint_store(directory=directory, run_hash=run_hash,
+                                 tiles=[tuple(x) for x in manifest["tiles"]],
+                                 completed=[tuple(x) for x in manifest["completed"]])
+        logger.info("Resuming from checkpoint in %s: %d of %d tiles already done" % (directory, len(store.completed),
+                                                                                    len(store.tiles)))
+        return store
+    if resume:
+        logger.info("No checkpoint found in %s. Starting from the beginning." % directory)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    store = checkpoint_store(directory=directory, run_hash=run_hash, tiles=[tuple(x) for x in tiles], completed=[])
+    write_manifest(store)
+    return store
+
+
+def write_manifest(store):
+    """ Written next to the old manifest and then moved, so a crash leaves either the old or the new one """
+    manifest_file = get_manifest_file(store.directory)
+    with open(manifest_file + '.tmp', 'w') as ofile:
+        json.dump({"run_hash": store.run_hash, "tiles": store.tiles, "completed": store.completed}, ofile)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return
+
+
+def save_tile(store, row_range, arrays):
+    """ Save the outputs of a finished tile (dict of name -> array), then mark it as done in the manifest """
+    tile_file = get_tile_file(store.directory, row_range)
+    with open(tile_file + '.tmp', 'wb') as ofile:
+        np.savez_compressed(ofile, **arrays)
+    os.replace(tile_file + '.tmp', tile_file)
+    store.completed.append(tuple(row_range))
+    write_manifest(store)
+    return
+
+
+def load_tile(store, row_range):
+    with np.load(get_tile_file(store.directory, row_range)) as tile:
+        return {key: tile[key] for key in tile.files}
+
+
+def remove_checkpoint(store):
+    """ Once the outputs of the run are written, the checkpoint is no longer needed. None means there was none. """
+    if store is None:
+        return
+    shutil.rmtree(store.directory, ignore_errors=True)
+    return
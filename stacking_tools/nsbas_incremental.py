@@ -0,0 +1,310 @@
+"""
+Incremental NSBAS time series: when new acquisitions arrive, only the new interferograms are read.
+With one unknown per date (the displacement relative to the first date), G^T G of a pixel is the graph Laplacian
+of its network of valid interferograms, so it follows from the pixel's bitmask of valid interferograms.
+Between runs we therefore keep, for every pixel, that bitmask and the right-hand side G^T d of the normal equations.
+A new interferogram adds its phase to two rows of G^T d, and sets one bit; a new date adds a row.
+Solving then needs one Cholesky factorization per group of pixels with identical bitmasks, as in nsbas_batched.
+Unweighted (NSBAS) only: coherence weights would make G^T G different for every pixel.
+
+The state lives in a netcdf file that is updated in place: a new interferogram only writes the rows of G^T d of
+its two dates, the new bits of the masks, and the count of valid interferograms of each pixel.
+The time series cube and velocities of the last run are updated in place too: only pixels whose normal equations
+(or eligibility) changed are solved again, a tile of rows at a time, and only they are written. Old dates of those
+pixels change too, so the whole series of a solved pixel is rewritten. New dates are appended to the cube.
+A new date that a pixel has no interferograms for disconnects its network, so the pixels that were solved but got
+no new data become nans, as in a full inversion. Only a new date before the last one of the cube (or a cube that
+can't grow) makes us write a new cube.
+"""
+
+import numpy as np
+import collections
+import logging
+import os
+import scipy.linalg
+from netCDF4 import Dataset
+from . import stacking_utilities, nsbas_batched, ts_output, diagnostics, run_report
+
+UPDATE_TILE_BYTES = 256 * 2 ** 20   # memory for the normal equations and time series of one tile of rows
+logger = logging.getLogger(__name__)
+
+# The metadata of a state file. The arrays stay on disk:
+# rhs: (date, y, x) G^T d in radians, dates in the order they were added (datestrs), with a row for the first date
+# that is never used. masks: (byte, y, x) packed bits, which interferograms of date_pairs_julian are valid for each
+# pixel. counts: (y, x) number of valid interferograms of each pixel. eligible: (y, x) 1 for the pixels solved in
+# the last run. velocity: (y, x) mm/yr from the last run.
+nsbas_state = collections.namedtuple('nsbas_state', ['filename', 'date_pairs_julian', 'datestrs', 'xvalues',
+                                                     'yvalues', 'rowref', 'colref'])
+
+
+# ------------ UPDATING THE STATE ------------ #
+
+def get_new_intf_files(state, intf_files, date_pair_function):
+    """ The interferograms whose date pairs aren't in the state yet. date_pair_function: filename -> 2015157_2018177 """
+    if state is None:
+        return list(intf_files)
+    known = set(state.date_pairs_julian)
+    return [x for x in intf_files if date_pair_function(x) not in known]
+
+
+def create_state(filename, intf_tuple, param_dict, chunk_rows=ts_output.CHUNK_ROWS):
+    """ An empty state file on the axes of intf_tuple. Dates, interferograms, and mask bytes grow in place. """
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues)
+    chunks = (1, max(1, min(chunk_rows, ny)), max(1, nx))
+    rootgrp = Dataset(filename, 'w', format='NETCDF4')
+    rootgrp.createDimension('intf', None)
+    rootgrp.createDimension('date', None)
+    rootgrp.createDimension('byte', None)
+    rootgrp.createDimension('y', ny)
+    rootgrp.createDimension('x', nx)
+    rootgrp.rowref, rootgrp.colref, rootgrp.updating = param_dict["rowref"], param_dict["colref"], 0
+    rootgrp.createVariable('date_pairs_julian', str, ('intf',))
+    rootgrp.createVariable('datestrs', str, ('date',))
+    rootgrp.createVariable('x', 'f8', ('x',))[:] = intf_tuple.xvalues
+    rootgrp.createVariable('y', 'f8', ('y',))[:] = intf_tuple.yvalues
+    rootgrp.createVariable('rhs', 'f8', ('date', 'y', 'x'), zlib=True, chunksizes=chunks)
+    rootgrp.createVariable('masks', 'u1', ('byte', 'y', 'x'), zlib=True, chunksizes=chunks)
+    rootgrp.createVariable('counts', 'i4', ('y', 'x'), zlib=True, fill_value=0)
+    rootgrp.createVariable('eligible', 'u1', ('y', 'x'), zlib=True, fill_value=0)
+    rootgrp.createVariable('velocity', 'f4', ('y', 'x'), zlib=True, fill_value=np.nan)
+    rootgrp.close()
+    return read_state(filename)
+
+
+def ingest(state, intf_tuple, param_dict):
+    """
+    Add the interferograms of intf_tuple to the state file. The cost is one pass over the new interferograms,
+    and one read and write of the rows of G^T d that they touch (and of the counts); the old interferograms are
+    never read.
+    The file is marked as updating until finish_update, so an interrupted update can't be mistaken for a good one.
+    :returns: the updated state, and a (ny, nx) boolean array of the pixels with a new valid interferogram
+    """
+    if (state.rowref, state.colref) != (param_dict["rowref"], param_dict["colref"]):
+        raise ValueError("Reference pixel %d/%d differs from the stored state's %d/%d" %
+                         (param_dict["rowref"], param_dict["colref"], state.rowref, state.colref))
+    gridshape = (len(state.yvalues), len(state.xvalues))
+    if np.shape(intf_tuple.zvalues)[1:] != gridshape:
+        raise ValueError("Interferograms of shape %s don't match the stored state's %s" %
+                         (np.shape(intf_tuple.zvalues)[1:], gridshape))
+    known = set(state.date_pairs_julian)
+    new_k = [k for k, x in enumerate(intf_tuple.date_pairs_julian) if x not in known]
+    new_pairs = [intf_tuple.date_pairs_julian[k] for k in new_k]
+    logger.info("Adding %d new interferograms to a state of %d" % (len(new_pairs), len(state.date_pairs_julian)))
+    changed = np.zeros(gridshape, dtype=bool)
+    if len(new_pairs) == 0:
+        return state, changed
+
+    # New dates go at the end of the file, with a row of zeros in the right-hand side
+    new_dates = sorted((set([x[0:7] for x in new_pairs]) | set([x[8:15] for x in new_pairs])) - set(state.datestrs))
+    datestrs = list(state.datestrs) + new_dates
+    epoch_index = {x: k for k, x in enumerate(datestrs)}
+    valid = np.zeros((len(new_k),) + gridshape, dtype=bool)
+    contributions = collections.defaultdict(list)   # date -> (sign, interferogram) pairs
+    for i, pair in enumerate(new_pairs):
+        contributions[epoch_index[pair[8:15]]].append((1, i))
+        contributions[epoch_index[pair[0:7]]].append((-1, i))
+
+    rootgrp = Dataset(state.filename, 'a')
+    rootgrp.set_auto_mask(False)
+    rootgrp.updating = 1
+    n_old = len(state.date_pairs_julian)
+    for i, k in enumerate(new_k):
+        valid[i] = ~np.isnan(intf_tuple.zvalues[k]) & ~np.isnan(intf_tuple.zvalues[k][state.rowref, state.colref])
+    for d, items in contributions.items():
+        rhs_row = rootgrp.variables['rhs'][d] if d < len(state.datestrs) else np.zeros(gridshape)
+        for sign, i in items:
+            pixel_values = np.subtract(intf_tuple.zvalues[new_k[i]],
+                                       intf_tuple.zvalues[new_k[i]][state.rowref, state.colref])
+            rhs_row += sign * np.where(valid[i], pixel_values, 0)
+        rootgrp.variables['rhs'][d] = rhs_row
+    tail_start = n_old // 8   # the last, partly filled byte of the masks, and the new ones
+    rootgrp.variables['masks'][tail_start:] = append_mask_bits(rootgrp.variables['masks'][tail_start:], n_old % 8,
+                                                               valid)
+    rootgrp.variables['counts'][:] = rootgrp.variables['counts'][:] + np.sum(valid, axis=0, dtype=np.int32)
+    rootgrp.variables['datestrs'][len(state.datestrs):] = np.array(new_dates, dtype=object)
+    rootgrp.variables['date_pairs_julian'][n_old:] = np.array(new_pairs, dtype=object)
+    rootgrp.close()
+    changed = np.any(valid, axis=0)
+    return state._replace(date_pairs_julian=list(state.date_pairs_julian) + new_pairs, datestrs=datestrs), changed
+
+
+def append_mask_bits(tail, n_tail, valid):
+    """
+    Append (n_new, ny, nx) booleans to the last byte of the packed masks, which holds n_tail interferograms
+    (tail is empty when n_tail is 0). Returns the bytes that replace tail.
+    """
+    if n_tail == 0:
+        return np.packbits(valid, axis=0)
+    old_bits = np.unpackbits(tail[0:1], axis=0)[0:n_tail].astype(bool)
+    return np.packbits(np.concatenate((old_bits, valid), axis=0), axis=0)
+
+
+def finish_update(state):
+    """ Mark the state as consistent with the outputs again """
+    with Dataset(state.filename, 'a') as rootgrp:
+        rootgrp.updating = 0
+    return
+
+
+# ------------ SOLVING ------------ #
+
+def update_outputs(param_dict, state, changed, signal_spread_tuple, cube_file, baseline_tuple=None,
+                   max_bytes=UPDATE_TILE_BYTES):
+    """
+    Solve again the pixels whose normal equations or eligibility changed, a tile of rows at a time, and write their
+    whole time series into the cube (cube_file, as in ts_output) and their velocities into the state.
+    Pixels are chosen as in nsbas.compute_TS, and pixels whose network doesn't connect every date are nans.
+    Corrections (DEM error, smoothing) and velocities are computed as in the batched engine.
+    Pixels that were solved but aren't anymore (not eligible, or dates were added) become nans.
+    The other pixels keep the outputs of the last run, and are neither read nor written, except inside the box of
+    rows and columns around the pixels of a tile that changed (the cube is chunked by blocks of rows anyway).
+    New dates are appended to the cube. If there's no growable cube that starts with the state's dates, a new one
+    is written next to it, with every pixel, and moved into place.
+    :returns: the number of pixels solved
+    """
+    epochs = stacking_utilities.make_epoch_table(state.date_pairs_julian)
+    datestrs = list(epochs.datestrs)
+    ts_dates = list(epochs.dates)
+    n_dates = len(datestrs)
+    file_order = np.array([state.datestrs.index(x) for x in datestrs])   # rows of rhs in date order
+    ny, nx = len(state.yvalues), len(state.xvalues)
+    cube_dates = get_growable_cube_dates(cube_file)
+    rewrite = cube_dates is None or ts_dates[0:len(cube_dates)] != cube_dates
+    dates_added = rewrite or n_dates > len(cube_dates)
+    bytes_per_row = nx * (8 * n_dates + 4 * n_dates + np.ceil(len(state.date_pairs_julian) / 8))
+    rows_per_tile = max(1, min(ny, int(max_bytes // bytes_per_row)))
+    if rewrite:
+        cube_grp, sink = None, ts_output.make_netcdf_sink(cube_file + '.tmp', state.xvalues, state.yvalues, ts_dates,
+                                                          growable=True)
+    else:   # written in place; new dates read as nans until written
+        cube_grp, sink = Dataset(cube_file, 'a'), None
+        cube_grp.set_auto_mask(False)
+        ts_output.append_cube_dates(cube_grp, ts_dates[len(cube_dates):])
+    rootgrp = Dataset(state.filename, 'a')
+    rootgrp.set_auto_mask(False)
+    n_solved = 0
+    progress = diagnostics.make_progress(ny * nx, "pixels checked")
+    try:
+        for r0 in range(0, ny, rows_per_tile):
+            r1 = min(r0 + rows_per_tile, ny)
+            nonnan_counts = np.ravel(rootgrp.variables['counts'][r0:r1, :])
+            eligible, _ = nsbas_batched.get_eligible_pixels(param_dict, nonnan_counts, signal_spread_tuple,
+                                                            len(state.date_pairs_julian), row_range=(r0, r1))
+            eligible_tile = np.zeros((r1 - r0, nx), dtype=bool)
+            eligible_tile.flat[eligible - r0 * nx] = True
+            if rewrite:
+                to_solve, to_write = eligible_tile, np.ones((r1 - r0, nx), dtype=bool)
+            else:
+                was_eligible = rootgrp.variables['eligible'][r0:r1, :].astype(bool)
+                to_solve = eligible_tile & (changed[r0:r1] | ~was_eligible)
+                to_write = to_solve | (was_eligible & (~eligible_tile | dates_added))
+            if not np.any(to_write):
+                progress.update((r1 - r0) * nx)
+                continue   # nothing in these rows changed
+            rows, cols = np.nonzero(to_write)
+            box = (slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1))
+            file_box = (slice(r0 + box[0].start, r0 + box[0].stop), box[1])
+            box_shape = (box[0].stop - box[0].start, box[1].stop - box[1].start)
+            if rewrite:
+                ts_box = np.full((n_dates, box_shape[0] * box_shape[1]), np.nan, dtype=np.float32)
+                velocity = np.full(box_shape[0] * box_shape[1], np.nan, dtype=np.float32)
+            else:
+                ts_box = np.asarray(cube_grp.variables['z'][(slice(None),) + file_box]).reshape(n_dates, -1)
+                velocity = np.ravel(rootgrp.variables['velocity'][file_box])
+                ts_box[:, np.ravel(to_write[box])] = np.nan
+                velocity[np.ravel(to_write[box])] = np.nan
+            if np.any(to_solve):
+                masks = rootgrp.variables['masks'][(slice(None),) + file_box].reshape(-1, len(velocity))
+                rhs = rootgrp.variables['rhs'][(slice(None),) + file_box].reshape(len(state.datestrs), -1)
+                solve_pixels(param_dict, epochs, masks, rhs[file_order], np.flatnonzero(to_solve[box]), ts_box,
+                             velocity, baseline_tuple)
+            n_solved += np.sum(to_solve)
+            with run_report.phase("write"):
+                if rewrite:
+                    sink.write_tile(r0, r1, ts_box.reshape(n_dates, r1 - r0, nx))
+                else:
+                    cube_grp.variables['z'][(slice(None),) + file_box] = ts_box.reshape((n_dates,) + box_shape)
+                rootgrp.variables['velocity'][file_box] = velocity.reshape(box_shape)
+                rootgrp.variables['eligible'][file_box] = eligible_tile[box]
+            progress.update((r1 - r0) * nx)
+    finally:
+        rootgrp.close()
+        sink.close() if rewrite else cube_grp.close()
+    if rewrite:
+        os.replace(cube_file + '.tmp', cube_file)
+    progress.finish()
+    logger.info("Solved %d pixels whose networks changed" % n_solved)
+    return n_solved
+
+
+def get_growable_cube_dates(cube_file):
+    """ The dates of a cube that new dates can be appended to, or None if there's no such cube """
+    if not os.path.isfile(cube_file):
+        return None
+    with Dataset(cube_file, 'r') as rootgrp:
+        if not rootgrp.dimensions['time'].isunlimited():
+            return None
+    return ts_output.get_cube_dates(cube_file)
+
+
+def solve_pixels(param_dict, epochs, masks, rhs, pixel_indices, ts_tile, velocity, baseline_tuple=None):
+    """
+    Time series for some pixels of a tile from their normal equations, written into ts_tile and velocity.
+    masks: (n_bytes, n_pixels) packed bits, rhs: (n_dates, n_pixels) G^T d in date order, both for the tile.
+    Pixels whose network doesn't connect every date get nans.
+    """
+    datestrs, x_axis_days = list(epochs.datestrs), list(epochs.days)
+    n_intf, n_dates = len(epochs.pair_index), len(datestrs)
+    signatures, groups = nsbas_batched.group_pixels_by_signature(masks, pixel_indices)
+    for g in range(len(groups)):
+        used = np.flatnonzero(np.unpackbits(signatures[g])[0:n_intf])
+        label = stacking_utilities.label_connected_epochs(epochs.pair_index[used], n_dates)
+        if n_dates <= 4 or np.max(label) > 1:
+            ts_tile[:, groups[g]] = np.nan   # like do_nsbas_pixel, small or disconnected networks give nans
+            velocity[groups[g]] = np.nan
+            continue
+        with run_report.phase("solve", len(groups[g])):
+            laplacian = get_network_laplacian(epochs.pair_index[used], n_dates)
+            displacement = np.zeros((n_dates, len(groups[g])))
+            factor = scipy.linalg.cho_factor(laplacian[1:, 1:], check_finite=False)
+            displacement[1:] = scipy.linalg.cho_solve(factor, rhs[1:, groups[g]], check_finite=False)
+        ts_block = displacement * -param_dict["wavelength"] / (4 * np.pi)   # radians to mm
+        ts_block, _ = nsbas_batched.apply_corrections_block(param_dict, ts_block, datestrs, baseline_tuple)
+        ts_tile[:, groups[g]] = ts_block
+        velocity[groups[g]] = nsbas_batched.velocity_block(ts_block, x_axis_days)
+    return
+
+
+def get_network_laplacian(pair_index, n_dates):
+    """ G^T G for one unknown per date: degree of each date on the diagonal, -1 for each interferogram """
+    laplacian = np.zeros((n_dates, n_dates))
+    a, b = pair_index[:, 0], pair_index[:, 1]
+    np.add.at(laplacian, (a, a), 1)
+    np.add.at(laplacian, (b, b), 1)
+    np.add.at(laplacian, (a, b), -1)
+    np.add.at(laplacian, (b, a), -1)
+    return laplacian
+
+
+# ------------ READING THE STATE ------------ #
+
+def read_state(filename):
+    """ The metadata of a state file written by create_state and ingest, or None if there isn't one yet """
+    if not os.path.isfile(filename):
+        return None
+    with Dataset(filename, 'r') as rootgrp:
+        rootgrp.set_auto_mask(False)
+        if int(rootgrp.updating):
+            raise ValueError("NSBAS state %s was interrupted during an update. Remove it (and nsbas_ts_cube.nc) "
+                             "to rebuild it from all interferograms." % filename)
+        return nsbas_state(filename=filename, date_pairs_julian=list(rootgrp.variables['date_pairs_julian'][:]),
+                           datestrs=list(rootgrp.variables['datestrs'][:]), xvalues=rootgrp.variables['x'][:],
+                           yvalues=rootgrp.variables['y'][:], rowref=int(rootgrp.rowref),
+                           colref=int(rootgrp.colref))
+
+
+def read_velocity(state):
+    with Dataset(state.filename, 'r') as rootgrp:
+        rootgrp.set_auto_mask(False)
+        return rootgrp.variables['velocity'][:]
+
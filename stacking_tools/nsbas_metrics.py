@@ -0,0 +1,128 @@
+"""
+Per-pixel metrics of an NSBAS run, kept in preallocated typed arrays (one layer per metric),
+instead of one dictionary per pixel. The batched engine hands each solved block of pixels to every registered
+metric, and writes the values straight into the arrays. A new metric only needs a call to register_metric.
+All layers are written together into one netcdf file (write_metrics).
+"""
+
+import numpy as np
+import scipy.sparse
+import collections
+import logging
+from netCDF4 import Dataset
+from . import stacking_utilities
+
+metric = collections.namedtuple('metric', ['name', 'dtype', 'fill', 'units', 'function', 'condition'])
+
+# What the solver knows about a block of pixels that share one network. G and model are None if the network
+# could not be inverted. kz_error is None without the DEM error correction. singular_values of G are None unless
+# the solve computed them (the unweighted dense solve).
+solved_block = collections.namedtuple('solved_block', ['G', 'pixel_values', 'model', 'ts_block', 'kz_error',
+                                                       'pair_index', 'n_dates', 'singular_values'],
+                                      defaults=[None])
+
+_registry = collections.OrderedDict()
+logger = logging.getLogger(__name__)
+
+
+def register_metric(name, dtype, fill, units, function, condition=None):
+    """
+    :param function: function(solved_block) returning one value per pixel of the block (or a scalar for all)
+    :param condition: optional function(param_dict) saying whether the metric applies to this run
+    """
+    _registry[name] = metric(name, dtype, fill, units, function, condition)
+    return
+
+
+def get_active_metrics(param_dict):
+    return [x for x in _registry.values() if x.condition is None or x.condition(param_dict)]
+
+
+def get_metric_specs(param_dict, gridshape):
+    """ name -> (shape, dtype) of each metric layer, for preallocation (or shared memory) """
+    return {x.name: (gridshape, x.dtype) for x in get_active_metrics(param_dict)}
+
+
+def allocate_metrics(param_dict, gridshape):
+    return {x.name: np.full(gridshape, x.fill, dtype=x.dtype) for x in get_active_metrics(param_dict)}
+
+
+def compute_block_metrics(param_dict, block):
+    """ name -> array of values for each pixel of a solved block """
+    n_pixels = np.shape(block.ts_block)[1]
+    return {x.name: np.broadcast_to(x.function(block), (n_pixels,)) for x in get_active_metrics(param_dict)}
+
+
+def empty_block_metrics(param_dict, n_pixels):
+    """ The fill values, for pixels that are not inverted """
+    return {x.name: np.full(n_pixels, x.fill, dtype=x.dtype) for x in get_active_metrics(param_dict)}
+
+
+def store_block_metrics(store, rows, cols, values):
+    for name, layer in store.items():
+        if name in values:
+            layer[rows, cols] = values[name]
+    return
+
+
+def store_pixel_metrics(store, i, j, metrics_dict):
+    """ For the per-pixel engine, which returns a dictionary of metrics for each pixel """
+    for name, layer in store.items():
+        if name in metrics_dict:
+            layer[i, j] = metrics_dict[name]
+    return
+
+
+def write_metrics(store, xvalues, yvalues, filename):
+    """ All metric layers in one netcdf file, one variable per metric """
+    logger.info("Writing %d metric layers to %s " % (len(store), filename))
+    rootgrp = Dataset(filename, 'w', format='NETCDF4')
+    rootgrp.createDimension('x', len(xvalues))
+    rootgrp.createDimension('y', len(yvalues))
+    rootgrp.node_offset = 1   # pixel-node registration
+    xvar = rootgrp.createVariable('x', 'f8', ('x',))
+    yvar = rootgrp.createVariable('y', 'f8', ('y',))
+    xvar[:], yvar[:] = xvalues, yvalues
+    for name, layer in store.items():
+        registered = _registry.get(name)
+        fill = registered.fill if registered is not None else None
+        zvar = rootgrp.createVariable(name, np.asarray(layer).dtype, ('y', 'x'), zlib=True, fill_value=fill)
+        zvar.units = registered.units if registered is not None else ''
+        zvar[:, :] = np.asarray(layer)
+    rootgrp.close()
+    return
+
+
+# ------------ THE BUILT-IN METRICS ------------ #
+
+def get_residual_rms(block):
+    """ RMS misfit of the SBAS inversion (radians), before the conversion to mm """
+    if block.model is None:
+        return np.nan
+    residual = block.G @ block.model - block.pixel_values   # G may be dense or sparse
+    return np.sqrt(np.mean(np.square(residual), axis=0))
+
+
+def get_n_components(block):
+    """ Number of connected components among the time series dates of the block's network """
+    return np.max(stacking_utilities.label_connected_epochs(block.pair_index, block.n_dates))
+
+
+def get_condition_number(block):
+    """
+    2-norm condition number of G, from the singular values of the solve when it has them.
+    Not computed for the sparse solver (nan), whose networks are too big for a dense SVD per block.
+    """
+    if block.G is None or scipy.sparse.issparse(block.G):
+        return np.nan
+    if block.singular_values is not None:
+        return block.singular_values[0] / block.singular_values[-1]
+    return np.linalg.cond(block.G)
+
+
+register_metric("Kz_error", np.float32, np.nan, 'm', lambda block: block.kz_error,
+                condition=lambda param_dict: param_dict["dem_error"])
+register_metric("n_intfs", np.int16, -1, 'count', lambda block: len(block.pair_index))
+register_metric("residual_rms", np.float32, np.nan, 'radians', get_residual_rms)
+register_metric("n_components", np.uint8, 0, 'count', get_n_components)
+register_metric("condition_number", np.float32, np.nan, '', get_condition_number)
@@ -0,0 +1,162 @@
+"""
+A parametric model of the deformation, inverted directly from the interferograms, with no time series in between.
+For each pixel: displacement(t) = velocity * t + annual sine and cosine terms + a step at each earthquake date,
+plus K_z_error * baseline(t) with the DEM error correction (the same term as in dem_error_correction).
+Interferograms only measure differences between two dates, so there is no offset term, and the network
+doesn't need to be connected as long as the model is constrained.
+Pixels with the same valid interferograms share one design matrix, grouped as in nsbas_batched.
+Whole frames run in tiles of rows through nsbas_tiles (ts_format='parametric'), like velocities and time series.
+"""
+
+import numpy as np
+import collections
+import datetime as dt
+import logging
+from . import stacking_utilities, nsbas, nsbas_batched, dem_error_correction, run_report, diagnostics
+
+model_parameter = collections.namedtuple('model_parameter', ['name', 'units'])
+parametric_design = collections.namedtuple('parametric_design', ['parameters', 'G'])   # G: all interferograms
+logger = logging.getLogger(__name__)
+
+
+# ------------ THE MODEL ------------ #
+
+def get_model_parameters(step_dates=(), dem_error=False):
+    """ The parameters of the model, in the order of the columns of the design matrix """
+    parameters = [model_parameter('velocity', 'mm/yr'), model_parameter('annual_sin', 'mm'),
+                  model_parameter('annual_cos', 'mm')]
+    parameters += [model_parameter('step_' + dt.datetime.strftime(x, "%Y%m%d"), 'mm') for x in step_dates]
+    if dem_error:
+        parameters.append(model_parameter('Kz_error', 'm'))
+    return parameters
+
+
+def build_epoch_basis(epochs, step_dates=(), baselines=None):
+    """
+    The model at each epoch, as a (n_epochs, n_params) matrix, in mm per unit of each parameter.
+    Time is in years since January 1 of the first year, so the seasonal phase is relative to January 1.
+    A step at date tq is seen by every acquisition after tq.
+    baselines: perpendicular baseline (m) of each epoch, for the DEM error term. None = no DEM error term.
+    """
+    t = np.array([(x - dt.datetime(epochs.dates[0].year, 1, 1)).days / 365.24 for x in epochs.dates])
+    columns = [t, np.sin(2 * np.pi * t), np.cos(2 * np.pi * t)]
+    columns += [np.array([x > step for x in epochs.dates], dtype=float) for step in step_dates]
+    if baselines is not None:
+        columns.append(np.multiply(baselines, 1000))   # topo phase = K_z_error * B, in mm
+    return np.stack(columns, axis=1)
+
+
+def build_parametric_G(epochs, step_dates=(), baselines=None):
+    """ One row per interferogram: the model at its second date minus the model at its first date """
+    basis = build_epoch_basis(epochs, step_dates, baselines)
+    return basis[epochs.pair_index[:, 1]] - basis[epochs.pair_index[:, 0]]
+
+
+def solve_parametric_block(G, data, weights=None):
+    """
+    Least squares for many pixels that share one design matrix.
+    :param G: (n_obs, n_params) design matrix
+    :param data: (n_obs, n_pixels) array of displacements in mm, without nans
+    :param weights: (n_obs, n_pixels) array of weights (coherence squared), or None
+    :returns: parameters and formal 1-sigma uncertainties, both (n_params, n_pixels). Sigmas are scaled by the
+    a-posteriori variance of unit weight, so they are nan without redundant observations.
+    Rank-deficient groups give nans.
+    """
+    n_obs, n_params = np.shape(G)
+    n_pixels = np.shape(data)[1]
+    if n_obs < n_params or np.linalg.matrix_rank(G) < n_params:
+        return np.full((n_params, n_pixels), np.nan), np.full((n_params, n_pixels), np.nan)
+    if weights is None:
+        N_inv = np.linalg.inv(np.dot(G.T, G))
+        m = np.dot(N_inv, np.dot(G.T, data))   # one factorization for the whole group
+        residual = data - np.dot(G, m)
+        variances = np.diag(N_inv)[:, None]
+        weighted_sq = np.sum(np.square(residual), axis=0)
+    else:
+        N = np.einsum('ik,ip,il->pkl', G, weights, G)
+        N_inv = np.linalg.inv(N)
+        m = np.einsum('pkl,pl->kp', N_inv, np.einsum('ik,ip->pk', G, weights * data))
+        residual = data - np.dot(G, m)
+        variances = np.diagonal(N_inv, axis1=1, axis2=2).T
+        weighted_sq = np.sum(weights * np.square(residual), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(variances * weighted_sq / (n_obs - n_params)) if n_obs > n_params else \
+            np.full((n_params, n_pixels), np.nan)
+    return m, sigma
+
+
+# ------------ COMPUTE ------------ #
+
+def get_parametric_design(param_dict, intf_tuple, baseline_tuple, step_dates=()):
+    """ The model parameters and the design matrix of all interferograms, built once per run """
+    epochs = stacking_utilities.get_epoch_table(intf_tuple)
+    baselines = None
+    if param_dict["dem_error"]:
+        baselines, _ = dem_error_correction.get_epoch_baselines(baseline_tuple, list(epochs.datestrs))
+        if len(baselines) != len(epochs.datestrs):
+            raise ValueError("Wrong number of baselines (%d) for the dates in the intfs (%d)" %
+                             (len(baselines), len(epochs.datestrs)))
+    parameters = get_model_parameters(step_dates, param_dict["dem_error"])
+    return parametric_design(parameters=parameters, G=build_parametric_G(epochs, step_dates, baselines))
+
+
+def invert_parametric_rows(param_dict, intf_tuple, signal_spread_tuple, coh_tuple, design, grids, row_range=None,
+                           max_pixels_per_solve=100000):
+    """
+    Invert the pixels of a block of rows (all rows if row_range is None) for the parametric model, writing into
+    grids: a dict of (ny, nx) arrays, one per parameter and one per sigma (name + '_sigma').
+    Pixels are chosen by nsbas_batched.compute_eligibility, but the network doesn't need to be connected.
+    :returns: the (n_rows, nx) eligibility codes of the block
+    """
+    n_intf = len(intf_tuple.date_pairs_julian)
+    gridshape = np.shape(signal_spread_tuple)
+    first_row, last_row = row_range if row_range is not None else (0, gridshape[0])
+    with run_report.phase("pixel selection", (last_row - first_row) * gridshape[1]):
+        pixels = nsbas_batched.compute_eligibility(param_dict, intf_tuple, signal_spread_tuple, coh_tuple,
+                                                   per_pixel_networks=True, row_range=row_range,
+                                                   check_networks=False)
+    n_bytes = int(np.ceil(n_intf / 8))
+    zvalues_flat = intf_tuple.zvalues.reshape(n_intf, -1)
+    coh_flat = coh_tuple.zvalues.reshape(n_intf, -1) if coh_tuple is not None else None
+    ref_values = intf_tuple.zvalues[:, param_dict["rowref"], param_dict["colref"]]
+    phase_to_mm = -param_dict["wavelength"] / (4 * np.pi)   # radians to mm, range change to LOS displacement
+    for signature, group in zip(pixels.signatures, pixels.groups):
+        used = np.flatnonzero(np.unpackbits(signature[-n_bytes:])[0:n_intf])   # coherent implies non-nan
+        for c0 in range(0, len(group), max_pixels_per_solve):
+            flat_idx = group[c0:c0 + max_pixels_per_solve]
+            data = (zvalues_flat[np.ix_(used, flat_idx)] - ref_values[used][:, None]) * phase_to_mm
+            weights = np.square(coh_flat[np.ix_(used, flat_idx)]) if coh_flat is not None else None
+            with run_report.phase("solve", len(flat_idx)):
+                m, sigma = solve_parametric_block(design.G[used], data, weights)
+            rows, cols = np.unravel_index(flat_idx, gridshape)
+            for k, x in enumerate(design.parameters):
+                grids[x.name][rows, cols] = m[k]
+                grids[x.name + '_sigma'][rows, cols] = sigma[k]
+    return pixels.codes
+
+
+def Parametric_Model(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, step_dates=(),
+                     block_rows=256):
+    """
+    Invert every pixel's interferograms for the parametric model, one block of rows at a time, in this process.
+    (nsbas_tiles runs the same blocks in parallel with ts_format='parametric'.)
+    Pixels are chosen as in nsbas: signal spread above nsbas_good_perc and fewer than 50% nan interferograms.
+    With coherence (WNSBAS), interferograms also need coherence above signal_coh_cutoff, and are weighted by
+    coherence squared.
+    :returns: list of model_parameters, and dict of (ny, nx) grids: each parameter and its sigma (name + '_sigma')
+    """
+    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    design = get_parametric_design(param_dict, intf_tuple, baseline_tuple, step_dates)
+    ny, nx = np.shape(signal_spread_tuple)
+    grids = {}
+    for x in design.parameters:
+        grids[x.name], grids[x.name + '_sigma'] = np.full((ny, nx), np.nan), np.full((ny, nx), np.nan)
+    logger.info("Inverting interferograms for %d model parameters: %s" %
+                (len(design.parameters), ', '.join([x.name for x in design.parameters])))
+    progress = diagnostics.make_progress(ny * nx)
+    for r0 in range(0, ny, block_rows):
+        r1 = min(r0 + block_rows, ny)
+        invert_parametric_rows(param_dict, intf_tuple, signal_spread_tuple, coh_tuple, design, grids, (r0, r1))
+        progress.update((r1 - r0) * nx)
+    progress.finish()
+    return design.parameters, grids
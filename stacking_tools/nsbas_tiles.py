@@ -0,0 +1,323 @@
+"""
+A tile scheduler for full-frame NSBAS runs.
+The cube is split into blocks of rows, and a pool of workers inverts each block with the chosen NSBAS engine.
+Inputs and outputs live in shared memory (or in the memory-mapped cube file, if the reader made one), so each
+worker writes its tile straight into the preallocated output arrays and nothing has to be stitched together.
+Time series are the exception: each tile's float32 block goes back to the parent, which hands it to an
+output sink (ts_output), so the full time series cube doesn't have to fit in memory.
+The number of workers comes from nsbas_workers in the stacking config.
+With a checkpoint (nsbas_checkpoint), every finished tile is also saved to disk, and a resumed run only computes
+the tiles that aren't there yet.
+"""
+
+import numpy as np
+import collections
+import datetime as dt
+import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from . import stacking_utilities, nsbas, nsbas_batched, nsbas_metrics, nsbas_checkpoint, nsbas_parametric, \
+    ts_output, diagnostics, run_report
+from . import readmytupledata as rmd
+
+_tile_state = {}   # the arrays and parameters each worker needs, set once per process
+CHECKPOINT_TILES_PER_WORKER = 16   # smaller tiles with a checkpoint, so less work is lost to an interruption
+TILE_BYTES = 512 * 2 ** 20   # working memory of one tile in one worker
+PENDING_TILES_PER_WORKER = 2   # finished tiles that may wait for the parent, per worker
+PIXELWISE_CORRECTION_PHASES = ("pixel selection", "DEM correction", "smoothing")   # timed apart from "solve"
+logger = logging.getLogger(__name__)
+
+
+# ------------ SETUP ------------ #
+
+def get_row_tiles(ny, n_workers, tiles_per_worker=4, bytes_per_row=0, max_bytes=TILE_BYTES,
+                  chunk_rows=ts_output.CHUNK_ROWS):
+    """
+    Split ny rows into contiguous blocks, several per worker for load balancing, and no bigger than max_bytes
+    (at bytes_per_row, see get_tile_bytes_per_row). Tiles are a multiple of chunk_rows, or divide it, so that each
+    chunk of the time series cube is written by one tile. Returns list of (r0, r1).
+    """
+    rows_per_tile = max(1, int(np.ceil(ny / (tiles_per_worker * max(n_workers, 1)))))
+    if bytes_per_row > 0:
+        rows_per_tile = max(1, min(rows_per_tile, int(max_bytes // bytes_per_row)))
+    if rows_per_tile >= chunk_rows:
+        rows_per_tile -= rows_per_tile % chunk_rows
+    else:
+        rows_per_tile = max([x for x in range(1, rows_per_tile + 1) if chunk_rows % x == 0])
+    return [(r0, min(r0 + rows_per_tile, ny)) for r0 in range(0, ny, rows_per_tile)]
+
+
+def get_tile_bytes_per_row(intf_tuple, coh_tuple=None):
+    """
+    Memory that a worker needs for each row of a tile: the float32 time series of the tile, and the float64
+    referenced phase (and coherence) of the group solves, which are about the size of the interferograms.
+    """
+    nx, n_intf = len(intf_tuple.xvalues), len(intf_tuple.zvalues)
+    return nx * (4 * len(intf_tuple.ts_dates) + 8 * n_intf * (2 if coh_tuple is not None else 1))
+
+
+def get_output_specs(param_dict, intf_tuple, ts_format):
+    """
+    Shapes, dtypes, and fill values of the output arrays for this run, including one layer per metric.
+    Time series are not here; they go to a ts_output sink one tile at a time.
+    The parametric model has a layer per parameter and per sigma instead of the metrics.
+    """
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues)
+    specs = {"velocity": ((ny, nx), np.float64, np.nan)} if ts_format == 'velocity' else {}
+    specs["eligibility"] = ((ny, nx), np.int8, nsbas_batched.NOT_VISITED)
+    if ts_format == 'parametric':
+        for x in nsbas_parametric.get_model_parameters(param_dict["step_dates"], param_dict["dem_error"]):
+            specs[x.name] = specs[x.name + '_sigma'] = ((ny, nx), np.float64, np.nan)
+        return specs
+    for metric in nsbas_metrics.get_active_metrics(param_dict):
+        specs[metric.name] = ((ny, nx), metric.dtype, metric.fill)
+    return specs
+
+
+def share_array(array):
+    """ Copy an array into a new block of shared memory. Returns the block and a view of it. """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(np.shape(array), dtype=array.dtype, buffer=shm.buf)
+    view[:] = array
+    return shm, view
+
+
+def attach_tile_worker(shared_specs, memmap_specs, intf_tuple, coh_tuple, param_dict, signal_spread_tuple,
+                       baseline_tuple, ts_format):
+    """
+    Pool initializer: attach to the shared blocks and rebuild the tuples around them.
+    shared_specs: dict of key -> (shm name, shape, dtype). The tuples arrive without their zvalues.
+    memmap_specs: dict of key -> filename, for input cubes that are already memory-mapped on disk.
+    """
+    arrays, blocks = {}, []
+    for key, (name, shape, dtype) in shared_specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    for key, filename in memmap_specs.items():
+        arrays[key] = rmd.open_cube(filename)
+    intf_tuple = intf_tuple._replace(zvalues=arrays.pop("intf"))
+    if coh_tuple is not None:
+        coh_tuple = coh_tuple._replace(zvalues=arrays.pop("coh"))
+    set_tile_state(intf_tuple, coh_tuple, param_dict, signal_spread_tuple, baseline_tuple, ts_format, arrays)
+    _tile_state["blocks"] = blocks   # keep the shared blocks open for the life of the worker
+    return
+
+
+def set_tile_state(intf_tuple, coh_tuple, param_dict, signal_spread_tuple, baseline_tuple, ts_format, outputs):
+    intf_tuple = intf_tuple._replace(epochs=stacking_utilities.get_epoch_table(intf_tuple))
+    datestrs = list(intf_tuple.epochs.datestrs)
+    metrics = {x.name: outputs[x.name] for x in nsbas_metrics.get_active_metrics(param_dict) if x.name in outputs}
+    if ts_format == 'parametric':
+        _tile_state["design"] = nsbas_parametric.get_parametric_design(param_dict, intf_tuple, baseline_tuple,
+                                                                       param_dict["step_dates"])
+    _tile_state.update({"intf_tuple": intf_tuple, "coh_tuple": coh_tuple, "param_dict": param_dict,
+                        "signal_spread": signal_spread_tuple, "baseline_tuple": baseline_tuple,
+                        "ts_format": ts_format, "outputs": outputs, "metrics": metrics, "datestrs": datestrs})
+    return
+
+
+# ------------ COMPUTE ------------ #
+
+def compute_tile(row_range):
+    """
+    Invert every pixel in a block of rows, writing into the output arrays.
+    Returns the row range, the number of pixels, the phase timings and diagnostics counts of this tile (so workers
+    can hand them to the parent), and for time series, the (n_dates, n_rows, nx) float32 block of the tile (None
+    otherwise).
+    """
+    st = _tile_state
+    nx = len(st["intf_tuple"].xvalues)
+    n_pixels = (row_range[1] - row_range[0]) * nx
+    if st["ts_format"] == 'timeseries':
+        st["ts_tile"] = np.full((len(st["intf_tuple"].ts_dates), row_range[1] - row_range[0], nx), np.nan,
+                                dtype=np.float32)
+    if st["ts_format"] == 'parametric':
+        st["outputs"]["eligibility"][row_range[0]:row_range[1]] = \
+            nsbas_parametric.invert_parametric_rows(st["param_dict"], st["intf_tuple"], st["signal_spread"],
+                                                    st["coh_tuple"], st["design"], st["outputs"], row_range)
+    elif st["param_dict"]["nsbas_engine"] == 'pixel':
+        with run_report.phase("solve", n_pixels, exclude=PIXELWISE_CORRECTION_PHASES):
+            compute_tile_pixelwise(row_range)
+    else:
+        compute_tile_batched(row_range)
+    return row_range, n_pixels, run_report.pop_phase_totals(), diagnostics.pop_counts(), st.pop("ts_tile", None)
+
+
+def compute_tile_pixelwise(row_range):
+    """
+    The reference engine: nsbas.compute_vel or nsbas.compute_TS for each eligible pixel of the tile.
+    The others keep the fill values of the outputs, which are what those functions would return for them.
+    """
+    st = _tile_state
+    outputs = st["outputs"]
+    with run_report.phase("pixel selection", (row_range[1] - row_range[0]) * len(st["intf_tuple"].xvalues)):
+        pixels = nsbas_batched.compute_eligibility(st["param_dict"], st["intf_tuple"], st["signal_spread"],
+                                                   st["coh_tuple"], per_pixel_networks=(st["ts_format"] == 'velocity'),
+                                                   row_range=row_range)
+    outputs["eligibility"][row_range[0]:row_range[1]] = pixels.codes
+    rows, cols = np.nonzero(pixels.codes == nsbas_batched.ELIGIBLE)
+    for i, j in zip(rows + row_range[0], cols):
+        if st["ts_format"] == 'velocity':
+            vel, _, metrics = nsbas.compute_vel(i, j, st["param_dict"], st["intf_tuple"], st["signal_spread"],
+                                                st["baseline_tuple"], st["coh_tuple"], st["datestrs"])
+            outputs["velocity"][i, j] = vel
+        else:
+            TS, _, metrics = nsbas.compute_TS(i, j, st["param_dict"], st["intf_tuple"], st["signal_spread"],
+                                              st["baseline_tuple"], st["coh_tuple"], st["datestrs"])
+            st["ts_tile"][:, i - row_range[0], j] = TS[0]
+        nsbas_metrics.store_pixel_metrics(st["metrics"], i, j, metrics)
+    nsbas.flush_correction_times()   # inside the "solve" phase, which leaves them out
+    return
+
+
+def compute_tile_batched(row_range):
+    """ The batched engine: pixels of the tile are grouped by network and inverted together. """
+    st = _tile_state
+    outputs = st["outputs"]
+    gridshape = np.shape(st["signal_spread"])
+
+    def group_function(_group_datestrs, group_x_axis_days, flat_idx, ts_block, metrics):
+        rows, cols = np.unravel_index(flat_idx, gridshape)
+        if st["ts_format"] == 'velocity':
+            good_columns = ~np.all(np.isnan(ts_block), axis=0)
+            if np.any(good_columns):
+                outputs["velocity"][rows[good_columns], cols[good_columns]] = \
+                    nsbas_batched.velocity_block(ts_block[:, good_columns], group_x_axis_days)
+        else:
+            st["ts_tile"][:, rows - row_range[0], cols] = ts_block
+        nsbas_metrics.store_block_metrics(st["metrics"], rows, cols, metrics)
+        return
+
+    outputs["eligibility"][row_range[0]:row_range[1]] = \
+        nsbas_batched.group_iterator(st["param_dict"], st["intf_tuple"], st["signal_spread"], st["baseline_tuple"],
+                                     st["coh_tuple"], group_function,
+                                     per_pixel_networks=(st["ts_format"] == 'velocity'), row_range=row_range)
+    return
+
+
+def run_tiled_nsbas(param_dict, intf_tuple, signal_spread_tuple, baseline_tuple, coh_tuple, ts_format,
+                    ts_sink=None, checkpoint=None, mp_context=None):
+    """
+    Run NSBAS velocities (ts_format='velocity'), full time series (ts_format='timeseries'), or the parametric
+    model of nsbas_parametric (ts_format='parametric', with param_dict["step_dates"]) tile by tile.
+    :param ts_sink: for time series, a ts_output.ts_sink that receives each finished tile. The caller closes it.
+    If None, the time series are kept in memory and returned as "ts".
+    :param checkpoint: a nsbas_checkpoint.checkpoint_store from open_run_checkpoint. Its tiles are used, finished
+    tiles are saved to it, and tiles it already has are loaded instead of computed.
+    :param mp_context: the multiprocessing context of the workers (like mp.get_context('spawn')). Default: mp.
+    :returns: dict of output arrays: "velocity" (ny, nx) or "ts" (n_dates, ny, nx) if there's no sink, the
+    (ny, nx) int8 "eligibility" codes of nsbas_batched.compute_eligibility, plus a (ny, nx) layer for each metric
+    in nsbas_metrics (for the parametric model, a layer for each parameter and its sigma instead). The per-pixel
+    engine only fills the metrics it computes (Kz_error).
+    """
+    nsbas.initial_defensive_programming(intf_tuple, signal_spread_tuple, coh_tuple, param_dict)
+    ny = len(intf_tuple.yvalues)
+    n_workers = param_dict["n_workers"]
+    tiles = get_row_tiles(ny, n_workers, bytes_per_row=get_tile_bytes_per_row(intf_tuple, coh_tuple)) \
+        if checkpoint is None else checkpoint.tiles
+    done = [] if checkpoint is None else list(checkpoint.completed)
+    todo = [x for x in tiles if x not in done]
+    output_specs = get_output_specs(param_dict, intf_tuple, ts_format)
+    own_sink = ts_format == 'timeseries' and ts_sink is None
+    if own_sink:
+        ts_sink = ts_output.make_memory_sink(len(intf_tuple.ts_dates), ny, len(intf_tuple.xvalues))
+    logger.info("Running NSBAS on %d tiles of rows with %d worker(s)" % (len(todo), n_workers))
+    logger.info("Started at: %s" % dt.datetime.now())
+    progress = diagnostics.make_progress(sum([(r1 - r0) for r0, r1 in todo]) * len(intf_tuple.xvalues))
+
+    if n_workers <= 1:   # no need for shared memory
+        outputs = {key: np.full(shape, fill, dtype=dtype) for key, (shape, dtype, fill) in output_specs.items()}
+        restore_tiles(checkpoint, done, outputs, ts_sink)
+        set_tile_state(intf_tuple, coh_tuple, param_dict, signal_spread_tuple, baseline_tuple, ts_format, outputs)
+        for tile in todo:
+            finish_tile(ts_sink, checkpoint, outputs, *compute_tile(tile))
+            progress.update((tile[1] - tile[0]) * len(intf_tuple.xvalues))
+        _tile_state.clear()
+        progress.finish()
+        if own_sink:
+            outputs["ts"] = ts_sink.close()
+        return outputs
+
+    blocks, views, shared_specs, memmap_specs = [], {}, {}, {}
+    inputs = {"intf": intf_tuple.zvalues}
+    if coh_tuple is not None:
+        inputs["coh"] = coh_tuple.zvalues
+    for key, array in inputs.items():
+        if isinstance(array, np.memmap) and array.filename is not None:
+            array.flush()
+            memmap_specs[key] = array.filename   # workers re-open the file instead of copying the cube
+            continue
+        shm, views[key] = share_array(np.asarray(array))
+        blocks.append(shm)
+        shared_specs[key] = (shm.name, np.shape(array), views[key].dtype)
+    for key, (shape, dtype, fill) in output_specs.items():
+        shm, views[key] = share_array(np.full(shape, fill, dtype=dtype))
+        blocks.append(shm)
+        shared_specs[key] = (shm.name, shape, dtype)
+
+    try:
+        restore_tiles(checkpoint, done, views, ts_sink)
+        initargs = (shared_specs, memmap_specs, intf_tuple._replace(zvalues=None),
+                    coh_tuple._replace(zvalues=None) if coh_tuple is not None else None,
+                    param_dict, signal_spread_tuple, baseline_tuple, ts_format)
+        with (mp_context or mp).Pool(n_workers, initializer=attach_tile_worker, initargs=initargs) as pool:
+            for result in imap_bounded(pool, compute_tile, todo, PENDING_TILES_PER_WORKER * n_workers):
+                finish_tile(ts_sink, checkpoint, views, *result)
+                progress.update(result[1])
+        outputs = {key: np.array(views[key]) for key in output_specs.keys()}
+    finally:
+        views.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    if own_sink:
+        outputs["ts"] = ts_sink.close()
+    progress.finish()
+    logger.info("Finished at: %s" % dt.datetime.now())
+    return outputs
+
+
+def imap_bounded(pool, function, items, max_pending):
+    """
+    Like pool.imap, but no more than max_pending items are submitted ahead of the one being handed back,
+    so finished tiles can't pile up in the parent when writing them is slower than computing them.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+    return
+
+
+def finish_tile(ts_sink, checkpoint, outputs, row_range, _n_pixels, phase_totals, counts, ts_tile):
+    """ In the parent: keep the tile's timings and counts, hand its time series to the sink, and checkpoint it """
+    run_report.merge_phase_totals(phase_totals)
+    diagnostics.merge_counts(counts)
+    if ts_tile is not None:
+        with run_report.phase("write"):
+            ts_sink.write_tile(row_range[0], row_range[1], ts_tile)
+    if checkpoint is not None:
+        with run_report.phase("checkpoint"):
+            arrays = {key: outputs[key][row_range[0]:row_range[1]] for key in outputs.keys()}
+            if ts_tile is not None:
+                arrays["ts"] = ts_tile
+            nsbas_checkpoint.save_tile(checkpoint, row_range, arrays)
+    return
+
+
+def restore_tiles(checkpoint, tiles, outputs, ts_sink):
+    """ Put the tiles that a previous run already saved back into the outputs and the sink """
+    for row_range in tiles:
+        with run_report.phase("checkpoint"):
+            arrays = nsbas_checkpoint.load_tile(checkpoint, row_range)
+        for key in outputs.keys():
+            outputs[key][row_range[0]:row_range[1]] = arrays[key]
+        if "ts" in arrays:
+            ts_sink.write_tile(row_range[0], row_range[1], arrays["ts"])
+    if tiles:
+        logger.info("Restored %d tiles from the checkpoint" % len(tiles))
+    return
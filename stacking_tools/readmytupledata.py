@@ -1,10 +1,12 @@
 import numpy as np
 import collections
 import re
+import os
 from datetime import datetime
+from netCDF4 import Dataset
 from s1_batches.read_write_insar_utilities import isce_read_write
 from Tectonic_Utils.read_write import netcdf_read_write as rwr
-from . import stacking_utilities
+from . import stacking_utilities, aoi
 
 
 """
@@ -12,27 +14,104 @@ This should be re-written to be a list of objects instead of an object of lists.
 When I have time. 
 """
 
+# epochs: a stacking_utilities.epoch_table, so that dates are parsed once, at read time
 data = collections.namedtuple('data', ['filepaths', 'date_pairs_julian', 'date_deltas',
-                                       'xvalues', 'yvalues', 'zvalues', 'date_pairs_dt', 'ts_dates'])
+                                       'xvalues', 'yvalues', 'zvalues', 'date_pairs_dt', 'ts_dates', 'epochs'],
+                              defaults=(None,))
 
 
-def reader(filepathslist):
+def allocate_cube(n_grids, first_grid, cube_file=None):
+    """
+    Preallocate the 3D data cube, so grids are copied in one at a time instead of stacking a list of arrays.
+    If cube_file is given, the cube is a float32 memory-mapped .npy file on disk. Only the parts being
+    accessed are paged into RAM, and slices such as cube[:, r0:r1, c0:c1] read just that window.
+    """
+    shape = (n_grids,) + np.shape(first_grid)
+    if cube_file is None:
+        return np.empty(shape, dtype=np.asarray(first_grid).dtype)
+    print("Memory-mapping data cube of shape %s into %s " % (str(shape), cube_file))
+    return np.lib.format.open_memmap(cube_file, mode='w+', dtype=np.float32, shape=shape)
+
+
+def open_cube(cube_file):
+    """ Re-open a memory-mapped cube written by allocate_cube, read-only. """
+    return np.load(cube_file, mmap_mode='r')
+
+
+def get_cube_file(cube_dir, name):
+    """ Where to put a memory-mapped cube. No cube_dir means we keep the cube in RAM. """
+    if cube_dir is None or cube_dir == '':
+        return None
+    return os.path.join(cube_dir, name + '_cube.npy')
+
+
+def cube_row_blocks(zvalues, block_rows=256):
+    """ Iterate through a data cube in tiles of rows. Yields (r0, r1, zvalues[:, r0:r1, :]). """
+    ny = np.shape(zvalues)[1]
+    for r0 in range(0, ny, block_rows):
+        r1 = min(r0 + block_rows, ny)
+        yield r0, r1, np.asarray(zvalues[:, r0:r1, :])
+
+
+def get_gmtsar_date_pair(filepath):
+    """ The date pair of a GMTSAR interferogram from its path, in real julian days (format 2015158_2018178) """
+    datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepath)[0]  # example: 2010040_2014052
+    # adding 1 to both dates because 000 = January 1
+    date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
+    date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
+    return date_new[0:15]
+
+
+def get_isce_date_pair(filepath):
+    """
+    The date pair of an ISCE interferogram, in the same format as get_gmtsar_date_pair.
+    The dates are in YYYYMMDD_YYYYMMDD format somewhere within the filepath (maybe multiple times). We take the first.
+    """
+    datesplit = re.findall(r"\d\d\d\d\d\d\d\d_\d\d\d\d\d\d\d\d", filepath)[0]  # example: 20100402_20140304
+    date1 = datetime.strptime(datesplit[0:8], "%Y%m%d")
+    date2 = datetime.strptime(datesplit[9:17], "%Y%m%d")
+    return datetime.strftime(date1, "%Y%j") + "_" + datetime.strftime(date2, "%Y%j")
+
+
+def read_grd(filename, region=None):
+    """
+    One GMTSAR grid as [xdata, ydata, zdata]. With a region (see aoi.py), only its window of rows and columns
+    is read from disk, and the pixels outside its polygon are nan.
+    """
+    if region is None:
+        return rwr.read_netcdf4(filename)
+    (r0, r1), (c0, c1) = region.rows, region.cols
+    print("Reading rows %d-%d, cols %d-%d of %s " % (r0, r1, c0, c1, filename))
+    with Dataset(filename, 'r') as rootgrp:
+        if len(rootgrp.variables.keys()) != 3:   # gdal-style layout, z is a flipped vector: read it all, then crop
+            xdata, ydata, zdata = rwr.read_netcdf4(filename)
+            return [xdata[c0:c1], ydata[r0:r1], aoi.crop_grid(zdata, region)]
+        [xkey, ykey, zkey] = rwr.properly_parse_three_variables(*rootgrp.variables.keys())
+        # the registration that rwr.parse_pixelnode_registration gets from grdinfo, without running GMT for each grid
+        if getattr(rootgrp, 'node_offset', getattr(rootgrp.variables[zkey], 'node_offset', 0)) != 1:
+            raise ValueError("ERROR! " + filename + " not pixel-node registered")
+        xdata = rootgrp.variables[xkey][c0:c1]
+        ydata = rootgrp.variables[ykey][r0:r1]
+        zdata = rootgrp.variables[zkey][r0:r1, c0:c1]
+    return [xdata, ydata, aoi.apply_mask(zdata, region)]
+
+
+def reader(filepathslist, cube_file=None, region=None):
     """
     This function takes in a list of filepaths to GMTSAR grd files, taking in a cuboid of data.
     It splits and returns this data in a named tuple.
+    If cube_file is given, zvalues is a memory-mapped float32 array in that file (see allocate_cube).
+    If region is given (see aoi.py), only its window of each grid is read, and the axes are the subset axes.
     """
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xdata, ydata, zvalues = [], [], []
+    xdata, ydata, zvalues = [], [], None
     for i in range(len(filepathslist)):
         print(filepathslist[i])
         # Establish timing and filepath information
         filepaths.append(filepathslist[i])
-        datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepathslist[i])[0]  # example: 2010040_2014052
-        # adding 1 to both dates because 000 = January 1
-        date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
-        date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
-        date_pairs_julian.append(date_new[0:15])  # example: 2015158_2018178
+        date_new = get_gmtsar_date_pair(filepathslist[i])
+        date_pairs_julian.append(date_new)  # example: 2015158_2018178
         acq1 = datetime.strptime(date_new[0:7], '%Y%j')
         acq2 = datetime.strptime(date_new[8:15], '%Y%j')
         date_pairs.append([acq1, acq2])
@@ -40,8 +119,10 @@ def reader(filepathslist):
         date_deltas.append(delta.days / 365.24)  # in years. 
 
         # Read in the data
-        xdata, ydata, zdata = rwr.read_netcdf4(filepathslist[i])  # does this work on netcdf3 as well?
-        zvalues.append(zdata)
+        xdata, ydata, zdata = read_grd(filepathslist[i], region)  # does this work on netcdf3 as well?
+        if zvalues is None:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
 
@@ -50,16 +131,17 @@ def reader(filepathslist):
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xdata), yvalues=np.array(ydata),
-                  zvalues=np.array(zvalues), date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates,
+                  epochs=stacking_utilities.make_epoch_table(date_pairs_julian))
     return mydata
 
 
-def reader_from_ts(filepathslist):
+def reader_from_ts(filepathslist, cube_file=None):
     """ 
     This function makes a tuple of grids in timesteps
     It can read in radar coords or geocoded coords, depending on the use of xvar, yvar
     """
-    filepaths, zvalues, ts_dates = [], [], []
+    filepaths, zvalues, ts_dates = [], None, []
     xvalues, yvalues = [], []
     for i in range(len(filepathslist)):
         print(filepathslist[i])
@@ -69,25 +151,29 @@ def reader_from_ts(filepathslist):
         ts_dates.append(datetime.strptime(datestr, "%Y%m%d"))
         # Read in the data, either netcdf3 or netcdf4
         [xvalues, yvalues, zdata] = rwr.read_netcdf4(filepathslist[i])
-        zvalues.append(zdata)
+        if zvalues is None:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=None, date_deltas=None,
-                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=np.array(zvalues),
+                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=zvalues,
                   date_pairs_dt=None, ts_dates=np.array(ts_dates))
     return mydata
 
 
-def reader_simple_format(file_names):
+def reader_simple_format(file_names, cube_file=None):
     """
     An earlier reading function, works fast, useful for things like coherence statistics
     """
     filename = file_names[0]
     [xdata, ydata] = rwr.read_netcdf3(filename)[0:2]
-    data_all = []
-    for ifile in file_names:  # this happens to be in date order on my mac
-        data = rwr.read_netcdf3(ifile)[2]
-        data_all.append(data)
+    data_all = None
+    for i, ifile in enumerate(file_names):  # this happens to be in date order on my mac
+        zdata = rwr.read_netcdf3(ifile)[2]
+        if data_all is None:
+            data_all = allocate_cube(len(file_names), zdata, cube_file)
+        data_all[i] = zdata
     date_pairs = []
     for name in file_names:
         pairname = name.split('/')[-2][0:15]
@@ -96,36 +182,46 @@ def reader_simple_format(file_names):
     return [xdata, ydata, data_all, date_pairs]
 
 
-def reader_isce(filepathslist, band=1):
+def read_isce_grid(filename, band=1, region=None):
+    """
+    One ISCE grid in the same [xdata, ydata, zdata] form as the netcdf readers, with radar-coordinate axes.
+    With a region (see aoi.py), only its window is read, and the pixels outside its polygon are nan.
+    """
+    window = None if region is None else (region.rows, region.cols)
+    _, _, zdata = isce_read_write.read_scalar_data(filename, band, flush_zeros=False, window=window)
+    r0, c0 = (0, 0) if region is None else (region.rows[0], region.cols[0])
+    xdata, ydata = np.arange(c0, c0 + np.shape(zdata)[1]), np.arange(r0, r0 + np.shape(zdata)[0])
+    return xdata, ydata, aoi.apply_mask(zdata, region)
+
+
+def reader_isce(filepathslist, band=1, cube_file=None, region=None):
     """
     This function takes in a list of filepaths that each contain a 2d array of data, taking
     in a cuboid of data. It splits and stores this data in a named tuple which is returned. This can then be used
     to extract key pieces of information. It reads in ISCE format. 
+    If cube_file is given, zvalues is a memory-mapped float32 array in that file (see allocate_cube).
+    If region is given (see aoi.py), only its window of each grid is read, and the axes are the subset axes.
     """
 
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xvalues, yvalues, zvalues = [], [], []
+    xvalues, yvalues, zvalues = [], [], None
     for i in range(len(filepathslist)):
         filepaths.append(filepathslist[i])
-        # In the case of ISCE, we have the dates in YYYYMMDD_YYYYMMDD format somewhere within the filepath
-        # (maybe multiple times). We take the first.
-        datesplit = re.findall(r"\d\d\d\d\d\d\d\d_\d\d\d\d\d\d\d\d", filepathslist[i])[0]  # example: 20100402_20140304
-        date1 = datetime.strptime(datesplit[0:8], "%Y%m%d")
-        date2 = datetime.strptime(datesplit[9:17], "%Y%m%d")
+        datestr_julian = get_isce_date_pair(filepathslist[i])
+        date1 = datetime.strptime(datestr_julian[0:7], "%Y%j")
+        date2 = datetime.strptime(datestr_julian[8:15], "%Y%j")
         date_pairs.append([date1, date2])
-        # in order to maintain consistency with GMTSAR formats:
-        datestr_julian = datetime.strftime(date1, "%Y%j") + "_" + datetime.strftime(date2, "%Y%j")
         date_pairs_julian.append(datestr_julian)  # example: 2015158_2018178
         delta = abs(date1 - date2)
         date_deltas.append(delta.days / 365.24)  # in years.
 
-        _, _, zdata = isce_read_write.read_scalar_data(filepathslist[i], band,
-                                                       flush_zeros=False)  # NOTE: For unwrapped files, will be band=2
+        # NOTE: For unwrapped files, will be band=2
+        xvalues, yvalues, zdata = read_isce_grid(filepathslist[i], band, region)
         # flush_zeros=False preserves the zeros in the input datasets. Added April 9 2020. uncertain results.
-        xvalues = range(0, np.shape(zdata)[1])
-        yvalues = range(0, np.shape(zdata)[0])
-        zvalues.append(zdata)
+        if zvalues is None:
+            zvalues = allocate_cube(len(filepathslist), zdata, cube_file)
+        zvalues[i] = zdata
         if i == round(len(filepathslist) / 2):
             print('halfway done reading files...')
 
@@ -134,6 +230,7 @@ def reader_isce(filepathslist, band=1):
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xvalues), yvalues=np.array(yvalues),
-                  zvalues=np.array(zvalues), date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates)
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=ts_dates,
+                  epochs=stacking_utilities.make_epoch_table(date_pairs_julian))
 
     return mydata
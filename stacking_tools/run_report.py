@@ -0,0 +1,162 @@
+"""
+Instrumentation for a stacking run.
+Each stage (and any sub-phase of a stage) records wall time, CPU time, resident memory at its start and
+end, the peak RSS of the process so far, bytes read and written, and the number of files opened.
+Inner loops that run many times, like the NSBAS solves, add their time and pixel count into running totals
+instead. At the end of the run, everything is written to run_report.json in the output directory.
+"""
+
+import contextlib
+import datetime as dt
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+_report = {"started": None, "stages": []}
+_phase_totals = {}       # name -> {"seconds": float, "pixels": int, "calls": int}
+_opened_files = set()   # filenames opened from Python since the audit hook was installed
+_hook_installed = False
+logger = logging.getLogger(__name__)
+
+
+def _audit_open(event, args):
+    if event == 'open' and isinstance(args[0], (str, bytes, os.PathLike)):
+        _opened_files.add(args[0])
+    return
+
+
+def install_file_counter():
+    """ Count the files opened from Python (not by GMT subprocesses). Audit hooks can't be removed, so only once. """
+    global _hook_installed
+    if not _hook_installed:
+        sys.addaudithook(_audit_open)
+        _hook_installed = True
+    return
+
+
+def get_io_bytes():
+    """ Bytes read and written by this process so far, from /proc (Linux only). None elsewhere. """
+    try:
+        counters = {}
+        with open('/proc/self/io') as ifile:
+            for line in ifile:
+                key, value = line.split(':')
+                counters[key] = int(value)
+        return counters['rchar'], counters['wchar']
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def get_peak_rss_mb():
+    """
+    High-water mark of resident memory of this process since it started (MB). It never goes down, so for a stage
+    it's the peak so far, not the peak of that stage. Worker processes aren't included.
+    """
+    scale = 1e6 if sys.platform == 'darwin' else 1e3   # bytes on mac, kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def get_current_rss_mb():
+    """ Resident memory of this process right now (MB), from /proc (Linux only). None elsewhere. """
+    try:
+        with open('/proc/self/statm') as ifile:
+            resident_pages = int(ifile.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def take_snapshot():
+    read_bytes, written_bytes = get_io_bytes()
+    times = os.times()
+    return {"wall": time.perf_counter(), "cpu": times.user + times.system + times.children_user +
+            times.children_system, "read": read_bytes, "written": written_bytes, "files": len(_opened_files),
+            "rss": get_current_rss_mb()}
+
+
+@contextlib.contextmanager
+def stage(name, parent=None):
+    """
+    Time a stage of the run (or, with parent, a sub-phase of that stage). Records are appended to the report
+    even if the stage raises.
+    """
+    install_file_counter()
+    if _report["started"] is None:
+        _report["started"] = dt.datetime.now().isoformat()
+    before = take_snapshot()
+    record = {"name": name, "parent": parent}
+    try:
+        yield record
+    finally:
+        after = take_snapshot()
+        record.update({"wall_s": after["wall"] - before["wall"], "cpu_s": after["cpu"] - before["cpu"],
+                       "peak_rss_so_far_mb": get_peak_rss_mb(), "files_opened": after["files"] - before["files"]})
+        if before["rss"] is not None:
+            record.update({"rss_start_mb": before["rss"], "rss_end_mb": after["rss"]})
+        if before["read"] is not None:
+            record.update({"bytes_read": after["read"] - before["read"],
+                           "bytes_written": after["written"] - before["written"]})
+        _report["stages"].append(record)
+    return
+
+
+@contextlib.contextmanager
+def phase(name, n_pixels=0, exclude=()):
+    """
+    Add the time spent in this block (and the pixels it handled) to the running total for name.
+    exclude: names of phases timed inside this block. Their time is left out of this one, so it isn't counted twice.
+    """
+    start = time.perf_counter()
+    excluded_before = get_phase_seconds(exclude)
+    try:
+        yield
+    finally:
+        excluded = get_phase_seconds(exclude) - excluded_before
+        add_phase_time(name, time.perf_counter() - start - excluded, n_pixels)
+    return
+
+
+def get_phase_seconds(names):
+    """ Total seconds recorded so far for some phases """
+    return sum(_phase_totals[name]["seconds"] for name in names if name in _phase_totals)
+
+
+def add_phase_time(name, seconds, n_pixels=0, calls=1):
+    totals = _phase_totals.setdefault(name, {"seconds": 0.0, "pixels": 0, "calls": 0})
+    totals["seconds"] += seconds
+    totals["pixels"] += int(n_pixels)
+    totals["calls"] += calls
+    return
+
+
+def pop_phase_totals():
+    """ Hand back the running totals and reset them. Used to pass totals from worker processes to the parent. """
+    totals = {key: dict(value) for key, value in _phase_totals.items()}
+    _phase_totals.clear()
+    return totals
+
+
+def merge_phase_totals(totals):
+    for name, value in totals.items():
+        add_phase_time(name, value["seconds"], value["pixels"], value["calls"])
+    return
+
+
+def get_report():
+    phases = {}
+    for name, value in _phase_totals.items():
+        phases[name] = dict(value)
+        phases[name]["pixels_per_s"] = value["pixels"] / value["seconds"] if value["seconds"] > 0 else None
+    return {"started": _report["started"], "finished": dt.datetime.now().isoformat(),
+            "stages": list(_report["stages"]), "nsbas_phases": phases}
+
+
+def write_report(outdir, filename='run_report.json'):
+    outfile = os.path.join(outdir, filename)
+    logger.info("Writing timing and memory report to %s " % outfile)
+    with open(outfile, 'w') as ofile:
+        json.dump(get_report(), ofile, indent=2)
+    return outfile
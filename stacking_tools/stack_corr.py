@@ -9,32 +9,52 @@ def stack_corr(mytuple, cutoff):
     """This function takes in a mytuple of data (argument 1) and counts how many times a certain
     piece of data is above a specified cutoff value (argument 2) in each 2-D array stored in mytuple.
     It returns a 2-D array of percentages, showing how much certain pieces of data satisfy the given cutoff
-    condition. You can use cutoff=np.nan to do number of non-nans"""
+    condition. You can use cutoff=np.nan to do number of non-nans
+    Works through the cube in tiles of rows, so a memory-mapped cube is never loaded all at once."""
     print('Number of files being stacked: ' + str(len(mytuple.filepaths)))
     a = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)))
-    c = 0
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F')  # iterate through the 3D array of data
-    while not it.finished:
-        i = it.multi_index[0]
-        j = it.multi_index[1]
-        data_vector = mytuple.zvalues[:, i, j]
-        a[i][j] = get_signal_spread(data_vector, cutoff)
-        c = c + 1
-        if np.mod(c, 20000) == 0:
-            print('Done with ' + str(c) + ' out of ' + str(len(mytuple.xvalues) * len(mytuple.yvalues)) + ' pixels')
-        it.iternext()
+    for r0, r1, block in rmd.cube_row_blocks(mytuple.zvalues):
+        a[r0:r1, :] = get_signal_spread(block, cutoff)
     return a
 
 
-def get_signal_spread(data_vector, cutoff):
-    """For a pixel, what is the percentage of good images? """
+def stack_corr_streaming(corr_files, cutoff, grid_reader):
+    """
+    Same answer as stack_corr, but the grids are read one at a time and added into an integer count array,
+    so memory goes like one grid instead of the whole stack.
+    grid_reader: function that takes a filename and returns [xdata, ydata, zdata]
+    """
+    print('Number of files being stacked: ' + str(len(corr_files)))
+    xdata, ydata, counts = [], [], None
+    for i, filename in enumerate(corr_files):
+        xdata, ydata, zdata = grid_reader(filename)
+        if counts is None:
+            counts = np.zeros(np.shape(zdata), dtype=np.int32)
+        counts += count_good_values(zdata, cutoff)
+        if i == round(len(corr_files) / 2):
+            print('halfway done reading files...')
+    a = 100 * counts / len(corr_files)
+    return xdata, ydata, a
+
+
+def count_good_values(zdata, cutoff):
+    """Boolean grid (or cube) of the values that count as signal. np.nan cutoff means count the non-nans."""
     if np.isnan(cutoff):
         # for GMTSAR, we usually use this criterion
         # (cutoff has been imposed during unwrapping, and the bad pixels are already nans)
-        a = 100 * np.sum(~np.isnan(data_vector)) / len(data_vector)
+        return ~np.isnan(zdata)
     else:
-        a = 100 * len(np.where(data_vector > cutoff)[0]) / len(data_vector)  # This has been tested.
-    return a
+        return zdata > cutoff  # This has been tested.
+
+
+def get_signal_spread(data_vector, cutoff):
+    """For a pixel (or a cube of pixels along axis 0), what is the percentage of good images? """
+    return 100 * np.sum(count_good_values(data_vector, cutoff), axis=0) / len(data_vector)
+
+
+def threshold_to_mask(zdata, cutoff):
+    """1 where zdata >= cutoff, nan elsewhere."""
+    return np.where(zdata >= cutoff, 1.0, np.nan)
 
 
 def dummy_signal_spread(intfs, output_dir, output_filename):
@@ -52,34 +72,28 @@ def dummy_signal_spread(intfs, output_dir, output_filename):
 def signal_spread_to_mask(ss_file, cutoff, mask_file):
     """ Given a signal spread file, make a nice mask that we can use for plotting."""
     [xdata, ydata, zdata] = netcdf_read_write.read_netcdf3(ss_file)
-    mask_response = np.zeros(np.shape(zdata))
-    for i in range(len(ydata)):
-        for j in range(len(xdata)):
-            if zdata[i][j] >= cutoff:
-                mask_response[i][j] = 1
-            else:
-                mask_response[i][j] = np.nan
+    mask_response = threshold_to_mask(zdata, cutoff)
     netcdf_read_write.produce_output_netcdf(xdata, ydata, mask_response, 'unitless', mask_file)
     return
 
 
-def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename):
+def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename, region=None):
+    """ With a region (see aoi.py), the signal spread is made on the area of interest only. """
     print("Making stack_corr")
     output_file = output_dir + "/" + output_filename
-    mytuple = rmd.reader(corr_files)  
-    a = stack_corr(mytuple, cutoff)  # if unwrapped files, we use Nan to show when it was unwrapped successfully.
-    netcdf_read_write.produce_output_netcdf(mytuple.xvalues, mytuple.yvalues, a, 'Percentage', output_file)
+    # if unwrapped files, we use Nan to show when it was unwrapped successfully.
+    xdata, ydata, a = stack_corr_streaming(corr_files, cutoff, lambda filename: rmd.read_grd(filename, region))
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, a, 'Percentage', output_file)
     netcdf_plots.produce_output_plot(output_file, 'Signal Spread', output_dir + '/signalspread.png',
                                      'Percentage of coherence (out of ' + str(len(corr_files)) + ' images)',
                                      aspect=1.2)
     return
 
 
-def drive_signal_spread_isce(corr_files, cutoff, output_dir, output_filename):
-    cor_data = rmd.reader_isce(corr_files)
-    a = stack_corr(cor_data, cutoff)
-    netcdf_read_write.produce_output_netcdf(cor_data.xvalues, cor_data.yvalues, a, 'Percentage', output_dir+'/' +
-                                            output_filename)
+def drive_signal_spread_isce(corr_files, cutoff, output_dir, output_filename, region=None):
+    xdata, ydata, a = stack_corr_streaming(corr_files, cutoff,
+                                           lambda filename: rmd.read_isce_grid(filename, region=region))
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, a, 'Percentage', output_dir+'/' + output_filename)
     netcdf_plots.produce_output_plot(output_dir + '/' + output_filename, 'Signal Spread above cor=' + str(cutoff),
                                      output_dir + '/signalspread_full.png', 'Percentage of coherence', aspect=1 / 4,
                                      invert_yaxis=False)
@@ -7,7 +7,9 @@ import collections
 
 Params = collections.namedtuple('Params',
                                 ['config_file', 'SAT', 'wavelength', 'startstage', 'endstage', 'ref_loc', 'ref_idx',
-                                 'ts_type', 'file_format',
+                                 'ts_type', 'file_format', 'nsbas_engine', 'nsbas_workers', 'memmap_cube',
+                                 'ts_sink', 'ts_legacy_grids', 'step_dates', 'nsbas_solver', 'nsbas_checkpoint',
+                                 'resume', 'log_level', 'aoi_window', 'aoi_bounds', 'aoi_polygon',
                                  'custom_unwrapping', 'detrend_atm_topo', 'gacos', 'aps', 'dem_error',
                                  'sbas_smoothing', 'ts_format', 'make_signal_spread', 'signal_coh_cutoff', 
                                  'nsbas_min_intfs', 'intf_filename', 'corr_filename', 'geocoded_intfs', 'baseline_file',
@@ -30,6 +32,9 @@ def parse_cmd_and_config():
     parser = argparse.ArgumentParser(description='Run stack processing. Either config or print_config are required.')
     parser.add_argument('--config', type=str, help='supply name of config file to setup processing options.')
     parser.add_argument('--print_config', help='file system location where to print example config file.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted NSBAS run from its checkpoint in ts_output_dir '
+                             '(written with nsbas_checkpoint = 1).')
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
@@ -37,6 +42,7 @@ def parse_cmd_and_config():
     if args.config is not None:
         config_file = args.config
         config, config_params = read_config_general(config_file)
+        config_params = config_params._replace(resume=args.resume)
         return config, config_params
     elif args.print_config is not None:
         directory = args.print_config
@@ -103,6 +109,20 @@ def read_config_general(config_file):
     sbas_smoothing = config.getfloat('py-config', 'sbas_smoothing') if (
         config.has_option('py-config', 'sbas_smoothing')) else 1
     ts_type = config.get('py-config', 'ts_type')
+    nsbas_engine = config.get('py-config', 'nsbas_engine') if (
+        config.has_option('py-config', 'nsbas_engine')) else 'batched'
+    nsbas_solver = config.get('py-config', 'nsbas_solver') if (
+        config.has_option('py-config', 'nsbas_solver')) else 'dense'
+    nsbas_workers = config.getint('py-config', 'nsbas_workers') if (
+        config.has_option('py-config', 'nsbas_workers')) else 1
+    nsbas_checkpoint = config.getint('py-config', 'nsbas_checkpoint') if (
+        config.has_option('py-config', 'nsbas_checkpoint')) else 0
+    log_level = config.get('py-config', 'log_level') if config.has_option('py-config', 'log_level') else 'INFO'
+    memmap_cube = config.getint('py-config', 'memmap_cube') if (
+        config.has_option('py-config', 'memmap_cube')) else 0
+    ts_sink = config.get('py-config', 'ts_sink') if config.has_option('py-config', 'ts_sink') else 'netcdf'
+    ts_legacy_grids = config.getint('py-config', 'ts_legacy_grids') if (
+        config.has_option('py-config', 'ts_legacy_grids')) else 1
     ts_format = config.get('py-config', 'ts_format')
     file_format = config.get('py-config', 'file_format')
     intf_dir = config.get('py-config', 'intf_dir')
@@ -119,6 +139,7 @@ def read_config_general(config_file):
     start_time = config.get('py-config', 'start_time') if config.has_option('py-config', 'start_time') else '19900101'
     end_time = config.get('py-config', 'end_time') if config.has_option('py-config', 'end_time') else '20500101'
     coseismic = config.get('py-config', 'coseismic') if config.has_option('py-config', 'coseismic') else ''
+    step_dates = config.get('py-config', 'step_dates') if config.has_option('py-config', 'step_dates') else ''
     intf_timespan = config.get('py-config', 'intf_timespan') if config.has_option('py-config', 'intf_timespan') else ''
     gps_file = config.get('py-config', 'gps_file') if config.has_option('py-config', 'gps_file') else ''
     flight_angle = config.getfloat('py-config', 'flight_angle') if config.has_option('py-config', 'flight_angle') else 0
@@ -126,6 +147,9 @@ def read_config_general(config_file):
     skip_file = config.get('py-config', 'skip_file') if config.has_option('py-config', 'skip_file') else ''
     ts_points_file = config.get('py-config', 'ts_points_file') if (
         config.has_option('py-config', 'ts_points_file')) else ''
+    aoi_window = config.get('py-config', 'aoi_window') if config.has_option('py-config', 'aoi_window') else ''
+    aoi_bounds = config.get('py-config', 'aoi_bounds') if config.has_option('py-config', 'aoi_bounds') else ''
+    aoi_polygon = config.get('py-config', 'aoi_polygon') if config.has_option('py-config', 'aoi_polygon') else ''
     ts_output_dir = config.get('py-config', 'ts_output_dir')
 
     # Start time and end times in datetime format. 
@@ -133,6 +157,7 @@ def read_config_general(config_file):
     end_time = dt.datetime.strptime(end_time, "%Y%m%d")
     if coseismic != "":
         coseismic = dt.datetime.strptime(coseismic, "%Y%m%d")
+    step_dates = [dt.datetime.strptime(x.strip(), "%Y%m%d") for x in step_dates.split(',') if x.strip() != ""]
 
     # enforce startstage <= endstage
     if endstage < startstage:
@@ -144,6 +169,11 @@ def read_config_general(config_file):
                            ref_loc=ref_loc, ref_idx=ref_idx, ts_type=ts_type, custom_unwrapping=custom_unwrapping,
                            detrend_atm_topo=detrend_atm_topo, gacos=gacos, aps=aps, dem_error=dem_error,
                            sbas_smoothing=sbas_smoothing, ts_format=ts_format, file_format=file_format,
+                           nsbas_engine=nsbas_engine, nsbas_workers=nsbas_workers, memmap_cube=memmap_cube,
+                           ts_sink=ts_sink, ts_legacy_grids=ts_legacy_grids, step_dates=step_dates,
+                           nsbas_solver=nsbas_solver, nsbas_checkpoint=nsbas_checkpoint, resume=False,
+                           log_level=log_level,
+                           aoi_window=aoi_window, aoi_bounds=aoi_bounds, aoi_polygon=aoi_polygon,
                            nsbas_min_intfs=nsbas_min_intfs, intf_filename=intf_filename, corr_filename=corr_filename,
                            baseline_file=baseline_file, geocoded_intfs=geocoded_intfs,
                            start_time=start_time, end_time=end_time, coseismic=coseismic, intf_timespan=intf_timespan,
@@ -177,7 +207,8 @@ def print_default_config(filename):
     ifile.write("ref_loc = \n")
     ifile.write("ref_idx = \n\n")
     ifile.write("# timeseries type: STACK or NSBAS or WNSBAS or COSEISMIC\n")
-    ifile.write("# timeseries format: velocity, points, timeseries, velocities_from_timeseries\n")
+    ifile.write("# timeseries format: velocity, points, timeseries, velocities_from_timeseries, parametric, "
+                "incremental\n")
     ifile.write("ts_type = \n")
     ifile.write("ts_format = \n\n")
     ifile.write("# File I/O Options\n")
@@ -192,24 +223,56 @@ def print_default_config(filename):
     ifile.write("geocoded_intfs = 1\n")
     ifile.write("ts_output_dir = Output/\n")
     ifile.write("make_signal_spread = 1\n")
+    ifile.write("# memmap_cube: keep the interferogram cube in a memory-mapped file in ts_output_dir instead of RAM\n")
+    ifile.write("memmap_cube = 0\n")
+    ifile.write("# ts_sink: where full time series go while they're computed: netcdf (a cube file in ts_output_dir) "
+                "or memory\n")
+    ifile.write("ts_sink = netcdf\n")
+    ifile.write("# ts_legacy_grids: also write one grid per date (YYYYMMDD.grd). Incremental runs then rewrite "
+                "every grid.\n")
+    ifile.write("ts_legacy_grids = 1\n")
     ifile.write("signal_coh_cutoff = 0\n")
     ifile.write("signal_spread_filename = signalspread.nc\n")
     ifile.write("baseline_file = \n\n")
     ifile.write("# sbas parameters\n")
     ifile.write("sbas_smoothing = 1\n\n")
     ifile.write("# nsbas parameters: minimum % of good igrams for nsbas, or -1 for full-rank pixels only\n")
-    ifile.write("nsbas_min_intfs = 50\n\n")
+    ifile.write("nsbas_min_intfs = 50\n")
+    ifile.write("# nsbas_engine: batched (groups pixels with identical networks) or pixel (reference, one at a time)\n")
+    ifile.write("nsbas_engine = batched\n")
+    ifile.write("# nsbas_solver: dense (one pseudo-inverse per network) or sparse (LSMR per pixel, for very large "
+                "networks)\n")
+    ifile.write("nsbas_solver = dense\n")
+    ifile.write("# nsbas_workers: number of processes that invert tiles of rows in parallel\n")
+    ifile.write("nsbas_workers = 1\n")
+    ifile.write("# nsbas_checkpoint: save every finished tile in ts_output_dir, so an interrupted run can be picked up "
+                "with --resume\n")
+    ifile.write("nsbas_checkpoint = 0\n")
+    ifile.write("# log_level: DEBUG, INFO (progress, and a summary of what happened to the pixels), or WARNING\n")
+    ifile.write("log_level = INFO\n\n")
     ifile.write("# Do you want to choose a subset of your images to generate a time series? \n")
     ifile.write("# intf_timespan is the duration of interferograms you want to use (300- means less than 300 days "
                 "300+ means greater than 300 days)\n")
     ifile.write("start_time = 20141001\n")
     ifile.write("end_time = 20190704\n")
     ifile.write("coseismic = \n")
+    ifile.write("# step_dates: earthquake dates (YYYYMMDD,YYYYMMDD) for steps in the parametric model "
+                "(ts_format = parametric)\n")
+    ifile.write("step_dates = \n")
     ifile.write("intf_timespan = \n\n")
     ifile.write("# choose which interferograms to skip (bad intfs)\n")
     ifile.write("skip_file = \n\n")
     ifile.write("# Choose points to reverse-geocode and get their velocities and time series\n")
     ifile.write("ts_points_file = \n\n")
+    ifile.write("# Area of interest: only this part of each interferogram is read and processed. "
+                "Leave empty for all.\n")
+    ifile.write("# aoi_window: row_start/row_end/col_start/col_end (end-exclusive, full-frame pixels)\n")
+    ifile.write("# aoi_bounds: lonmin/lonmax/latmin/latmax\n")
+    ifile.write("# aoi_polygon: text file with 'lon lat' vertices. Pixels outside the polygon are nan.\n")
+    ifile.write("# The reference pixel (ref_idx, full frame) must be inside the area of interest.\n")
+    ifile.write("aoi_window = \n")
+    ifile.write("aoi_bounds = \n")
+    ifile.write("aoi_polygon = \n\n")
     ifile.write("#de-trending options, including GPS velocity file, optional to be used for de-trending\n")
     ifile.write("detrend = False\n")
     ifile.write("trendparams = \n")
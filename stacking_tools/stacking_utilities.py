@@ -5,6 +5,9 @@ import sys
 import glob
 import re
 import collections
+import functools
+import hashlib
+import logging
 import datetime as dt
 import matplotlib
 # matplotlib.use('Agg')
@@ -13,8 +16,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 from Tectonic_Utils.read_write import netcdf_read_write
 from Tectonic_Utils.geodesy import haversine
-from s1_batches.intf_generating import get_ra_rc_from_ll
+from s1_batches.intf_generating import get_ra_rc_from_ll, trans_dat_index
 from s1_batches.read_write_insar_utilities import isce_read_write
+from . import aoi
+
+NETWORK_CACHE_SIZE = 4096   # number of distinct per-pixel networks whose largest connected component we keep
+logger = logging.getLogger(__name__)
 
 
 def get_list_of_intf_all(config_params):
@@ -107,6 +114,54 @@ def get_TS_dates(date_julstrings):
     return datestrs, x_axis_datetimes, x_axis_days
 
 
+epoch_table = collections.namedtuple('epoch_table', ['datestrs', 'dates', 'pair_index', 'days', 'years',
+                                                     'network_id'])
+_epoch_tables = {}   # network_id -> epoch_table, so that memoized functions can be keyed on the id alone
+
+
+def make_epoch_table(date_julstrings):
+    """
+    Parse the dates of an interferogram network once, so that the per-pixel code can work with integers.
+    :param date_julstrings: list of N date_julstrings in format [YYYYJJJ_YYYJJJ,...]
+    :returns: epoch_table with the M sorted unique datestrs (YYYYJJJ) and their datetimes,
+    an (N, 2) int32 array of the epoch index of each interferogram's first and second date,
+    and each epoch's offset from the first epoch in days (int) and in decimal years.
+    network_id is a hash of the interferogram list, the same for every table of the same network.
+    """
+    firsts = [x[0:7] for x in date_julstrings]
+    seconds = [x[8:15] for x in date_julstrings]
+    datestrs = np.array(sorted(set(firsts + seconds)))
+    pair_index = np.stack((np.searchsorted(datestrs, firsts), np.searchsorted(datestrs, seconds)),
+                          axis=1).astype(np.int32).reshape(-1, 2)
+    dates = [dt.datetime.strptime(x, "%Y%j") for x in datestrs]
+    days = np.array([(x - dates[0]).days for x in dates], dtype=int)
+    network_id = hashlib.sha1(' '.join(date_julstrings).encode()).hexdigest()
+    pair_index.flags.writeable = False
+    return register_epoch_table(epoch_table(datestrs=datestrs, dates=dates, pair_index=pair_index, days=days,
+                                            years=days / 365.24, network_id=network_id))
+
+
+def register_epoch_table(epochs):
+    """
+    Make an epoch table findable by its network_id in this process. The registry belongs to each process, so a
+    table that arrives from another one (pickled to a spawned worker) has to be registered there again.
+    Returns the registered table of that network.
+    """
+    return _epoch_tables.setdefault(epochs.network_id, epochs)
+
+
+def get_registered_epoch_table(network_id):
+    """ The epoch table with this network_id, made earlier by make_epoch_table """
+    return _epoch_tables[network_id]
+
+
+def get_epoch_table(intf_tuple):
+    """ The epoch table of an intf_tuple, made on the spot if the tuple was built without one. """
+    if intf_tuple.epochs is not None:
+        return register_epoch_table(intf_tuple.epochs)
+    return make_epoch_table(intf_tuple.date_pairs_julian)
+
+
 def get_list_of_ts_grids(config_params):
     """
     Glob function. Used instead of regular reader for making velocities out of pre-existing time series grids.
@@ -285,12 +340,18 @@ def check_clean_computation(rowref, colref, mytuple, signal_spread_data):
     num_intfs = len(ref_pixel_values)
     assert (num_nans / num_intfs < 0.5), ValueError("DataCube refpixel has >50% nans.")
     reference_ss = signal_spread_data[rowref, colref]
-    print("Intf Stack has %f percent nan igrams for ref pixel %d, %d" % (100*num_nans/num_intfs, rowref, colref))
-    print("Signal Spread has %f percent coherent igrams for ref pixel %d, %d" % (reference_ss, rowref, colref))
+    logger.info("Intf Stack has %f percent nan igrams for ref pixel %d, %d" % (100*num_nans/num_intfs, rowref, colref))
+    logger.info("Signal Spread has %f percent coherent igrams for ref pixel %d, %d" % (reference_ss, rowref, colref))
     assert (signal_spread_data[rowref, colref] > 50), ValueError("RefPix has <50% coherent interferograms.")
     return
 
 
+def read_signal_spread(signalspread_filename, intf_tuple):
+    """ The signal spread on the axes of intf_tuple, which can be an area of interest of the grid (see aoi.py) """
+    [xdata, ydata, ss_data] = netcdf_read_write.read_any_grd(signalspread_filename)
+    return aoi.crop_grid_to_axes(xdata, ydata, ss_data, intf_tuple.xvalues, intf_tuple.yvalues)
+
+
 def report_on_refpixel(rowref, colref, signal_spread_data, outdir):
     ofile = open(outdir+"/metrics_report.txt", 'w')
     ofile.write("Refpixel is Row/col %d %d \n" % (rowref, colref))
@@ -323,46 +384,59 @@ def find_connected_dates(date_pairs, sample_date):
     return connected_dates
 
 
+def label_connected_epochs(pair_index, n_epochs):
+    """
+    Connected components of a network of interferograms, with dates as integer epoch indices.
+    Union-find: each interferogram joins the components of its two dates, and each component is rooted
+    at its lowest epoch, so components are labeled in order of their first date.
+    :param pair_index: (N, 2) int array, epoch index of the first and second date of each interferogram
+    :param n_epochs: number of dates in the network. Dates not touched by any interferogram are their own component.
+    :returns: int array of component labels (1, 2, ...) for each epoch
+    """
+    parent = list(range(n_epochs))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]   # path halving
+            x = parent[x]
+        return x
+
+    for a, b in np.asarray(pair_index).reshape(-1, 2).tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    roots = np.array([find(x) for x in range(n_epochs)], dtype=int)
+    _, label = np.unique(roots, return_inverse=True)
+    return np.ravel(label) + 1
+
+
+def get_largest_component_mask(pair_index, n_epochs):
+    """
+    Which epochs belong to the largest connected component of the network? (The first one, in case of a tie.)
+    :returns: boolean array over epochs, and the number of epochs in that component
+    """
+    label = label_connected_epochs(pair_index, n_epochs)
+    counts = np.bincount(label)
+    return label == np.argmax(counts), np.max(counts)
+
+
 def connected_components_search(date_pairs, datestrs):
     """
     Are we inverting a complete network?
     This function will catch both 'disconnected networks' and 'bad day' cases.
     We want only one connected component with len==len(datestrs).
     Otherwise the network should fail.
-    1. initialize the queue with the first date
-    2. find anything connected to that date, add to the queue.
-    3. When all of the dates connected to the first date have been added to queue, pop the first date from queue
-    4. Repeat until the queue is gone.
-    5. See if all dates have been added to the component.
+    The dates are turned into integer epoch indices once, and searched with label_connected_epochs.
     Returns the number of the biggest connected component, the number of elements of that component, and
     the total labels, for each date.
     Reduces to a single connected component with length len(datestrs) if we have one cc that touches every date.
     :param date_pairs: list of strings with date pairs used, format '2015157_2018177' (real julian day)
     :param datestrs: list of strings with dates desired for inversion, format '2015157'
     """
-
-    # Initializing first time through
-    label = np.zeros(np.shape(datestrs))
-    unenqueued = set(datestrs)
-    current_cc = 1
-
-    while unenqueued:   # while we still have unlabeled nodes:
-        # Put the first datestr with cc==0 into the queue, for traversal. Ugly but workable.
-        queue = [unenqueued.pop()]
-
-        # loop into the next connected component
-        while len(queue) > 0:
-            sample_date = queue.pop()  # go exploring the queue, starting at the back.
-            idx_sample = datestrs.index(sample_date)
-            label[idx_sample] = current_cc
-            connected_dates = find_connected_dates(date_pairs, sample_date)
-            for i in range(len(connected_dates)):
-                if connected_dates[i] in unenqueued:
-                    queue.append(connected_dates[i])
-                    unenqueued.remove(connected_dates[i])
-
-        current_cc = current_cc + 1
-    # print(label)  # testing code
+    epoch_index = {x: k for k, x in enumerate(datestrs)}
+    pair_index = [(epoch_index[x[0:7]], epoch_index[x[8:15]]) for x in date_pairs
+                  if x[0:7] in epoch_index and x[8:15] in epoch_index]
+    label = label_connected_epochs(np.array(pair_index, dtype=int), len(datestrs)).astype(float)
     cc_num, num_elements = find_largest_connected_component(label)
     return cc_num, num_elements, label
 
@@ -387,6 +461,50 @@ def reduce_graph_to_largest_cc(date_pairs, datestrs):
         return new_date_pairs, new_datestrs
 
 
+def reduce_pairs_to_largest_cc(epochs, valid):
+    """
+    The integer version of reduce_graph_to_largest_cc, for one pixel's network.
+    Pixels that share a network share the answer: results are memoized by the packed validity mask and the
+    network_id of the epoch table, which is registered in this process for the memoized lookup.
+    :param epochs: epoch_table of all interferograms (make_epoch_table)
+    :param valid: boolean array (N), the interferograms with real data at this pixel
+    :returns: boolean array (N) of the valid interferograms in the largest component, and the sorted int array
+    of epochs that those interferograms touch. Both are shared between calls, so they are read-only.
+    """
+    register_epoch_table(epochs)
+    return reduce_packed_mask_to_largest_cc(np.packbits(valid).tobytes(), epochs.network_id)
+
+
+@functools.lru_cache(maxsize=NETWORK_CACHE_SIZE)
+def reduce_packed_mask_to_largest_cc(mask_bytes, network_id):
+    """ The memoized body of reduce_pairs_to_largest_cc. The mask is packed into bytes so that it can be hashed. """
+    epochs = get_registered_epoch_table(network_id)
+    pair_index, n_epochs = epochs.pair_index, len(epochs.datestrs)
+    valid = np.unpackbits(np.frombuffer(mask_bytes, dtype=np.uint8))[0:len(pair_index)].astype(bool)
+    in_cc, _ = get_largest_component_mask(pair_index[valid], n_epochs)
+    kept = valid & in_cc[pair_index[:, 0]]
+    epochs = np.flatnonzero(np.bincount(np.ravel(pair_index[kept]), minlength=n_epochs))
+    kept.flags.writeable, epochs.flags.writeable = False, False
+    return kept, epochs
+
+
+def reduce_masks_to_largest_cc(epochs, valid_masks):
+    """
+    reduce_pairs_to_largest_cc for many pixels at once. Each distinct network is searched only once.
+    :param valid_masks: boolean array (n_pixels, N) of the interferograms with real data at each pixel
+    :returns: boolean array (n_pixels, N) of the interferograms kept at each pixel, and a list of the epochs used
+    by each pixel
+    """
+    packed = np.packbits(np.asarray(valid_masks, dtype=bool), axis=1)
+    unique_masks, inverse = np.unique(packed, axis=0, return_inverse=True)
+    n_intf = np.shape(valid_masks)[1]
+    register_epoch_table(epochs)
+    results = [reduce_packed_mask_to_largest_cc(x.tobytes(), epochs.network_id) for x in unique_masks]
+    inverse = np.ravel(inverse)
+    kept = np.array([x[0] for x in results], dtype=bool).reshape(-1, n_intf)[inverse]
+    return kept, [results[k][1] for k in inverse]
+
+
 # Functions to get TS points in row/col coordinates
 def drive_cache_ts_points(ts_points_file, intf_file_example, geocoded_flag):
     """ If you want to re-compute things, you need to delete the cache. """
@@ -405,16 +523,23 @@ def drive_cache_ts_points(ts_points_file, intf_file_example, geocoded_flag):
 
 
 def match_ts_points_row_col(lons, lats, names, rows, cols, example_grd, geocoded_flag):
-    """Find each row and col that hasn't been found before, either in geocoded or radarcoords. """
+    """Find each row and col that hasn't been found before, either in geocoded or radarcoords.
+    In radarcoords, all the new points are looked up in one batched query of the trans.dat index. """
     trans_dat = "merged/trans.dat"
-    for i in range(len(lons)):
-        if rows[i] == '':
-            if geocoded_flag:
-                irow, icol = get_reference_pixel_from_geocoded_grd(lons[i], lats[i], example_grd)
+    todo = [i for i in range(len(lons)) if rows[i] == '']
+    if geocoded_flag:
+        for i in todo:
+            rows[i], cols[i] = get_reference_pixel_from_geocoded_grd(lons[i], lats[i], example_grd)
+    elif len(todo) > 0:
+        index = get_ra_rc_from_ll.get_trans_index(trans_dat)
+        _, _, irows, icols = trans_dat_index.ll_to_ra_row_col(index, example_grd, np.array(lons)[todo],
+                                                              np.array(lats)[todo])
+        for k, i in enumerate(todo):
+            if irows[k] == -1:
+                print("WARNING: Cannot Find %f %f in file." % (lons[i], lats[i]))
+                rows[i], cols[i] = np.nan, np.nan
             else:
-                irow, icol = get_referece_pixel_from_radarcoord_grd(lons[i], lats[i], trans_dat, example_grd)
-            rows[i] = irow
-            cols[i] = icol
+                rows[i], cols[i] = irows[k], icols[k]
     return lons, lats, names, rows, cols
 
 
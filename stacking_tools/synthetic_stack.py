@@ -0,0 +1,183 @@
+"""
+Synthetic interferogram stacks for testing and benchmarking.
+A network of acquisitions is connected to its next few neighbors; each pixel has a linear velocity
+(a Gaussian bowl of subsidence) plus noise, and some fraction of the observations are nan.
+The stack can be returned in memory as a readmytupledata.data tuple, or written to disk
+as a GMTSAR-style directory (???????_???????/unwrap.grd, corr.grd, intf_record.in, baseline table)
+or an ISCE-style stack (YYYYMMDD_YYYYMMDD/filt_fine.unw, filt_fine.cor, with .xml and .vrt headers).
+"""
+
+import numpy as np
+import collections
+import datetime as dt
+import os
+from netCDF4 import Dataset
+from s1_batches.read_write_insar_utilities import isce_read_write
+from . import stacking_utilities
+from . import readmytupledata as rmd
+
+synthetic_stack = collections.namedtuple('synthetic_stack', ['dates', 'pairs', 'xvalues', 'yvalues', 'phase',
+                                                             'coherence', 'velocity', 'baselines'])
+
+
+# ------------ MAKING THE DATA ------------ #
+
+def make_network(n_dates, start_date=dt.datetime(2015, 1, 10), interval_days=12, max_neighbors=3):
+    """ Acquisition dates, and index pairs (a, b) connecting each date to its next max_neighbors dates. """
+    dates = [start_date + dt.timedelta(days=interval_days * k) for k in range(n_dates)]
+    pairs = [(a, b) for a in range(n_dates) for b in range(a + 1, min(a + 1 + max_neighbors, n_dates))]
+    return dates, pairs
+
+
+def make_synthetic_stack(ny=100, nx=100, n_dates=20, max_neighbors=3, nan_fraction=0.05, max_velocity=-20,
+                         noise=0.5, wavelength=56, seed=0):
+    """
+    :param max_velocity: mm/yr at the center of the deforming bowl (negative = away from satellite)
+    :param noise: standard deviation of phase noise on each interferogram, radians
+    :param nan_fraction: fraction of observations that are nan (in patches), in addition to a decorrelated corner
+    :returns: a synthetic_stack. phase is (n_intfs, ny, nx) float32 radians, with the same sign convention
+    as the NSBAS code (displacement = -wavelength / (4 pi) * phase).
+    """
+    rng = np.random.default_rng(seed)
+    dates, pairs = make_network(n_dates, max_neighbors=max_neighbors)
+    yy, xx = np.meshgrid(np.linspace(-1, 1, ny), np.linspace(-1, 1, nx), indexing='ij')
+    velocity = max_velocity * np.exp(-(xx ** 2 + yy ** 2) / 0.2)   # mm/yr
+    years = np.array([(x - dates[0]).days / 365.24 for x in dates])
+
+    phase = np.empty((len(pairs), ny, nx), dtype=np.float32)
+    coherence = np.empty((len(pairs), ny, nx), dtype=np.float32)
+    decorrelated = (xx > 0.6) & (yy > 0.6)   # a corner that is often incoherent
+    for k, (a, b) in enumerate(pairs):
+        displacement = velocity * (years[b] - years[a])
+        phase[k] = -4 * np.pi / wavelength * displacement + rng.normal(scale=noise, size=(ny, nx))
+        coherence[k] = rng.uniform(0.4, 0.9, size=(ny, nx))
+        bad = get_patchy_mask(rng, ny, nx, nan_fraction)
+        bad = bad | (decorrelated & (rng.random() < 0.5))
+        phase[k][bad] = np.nan
+        coherence[k][bad] = rng.uniform(0.0, 0.1, size=np.sum(bad))
+    baselines = rng.normal(scale=100, size=n_dates)
+    baselines[0] = 0
+    return synthetic_stack(dates=dates, pairs=pairs, xvalues=np.arange(nx, dtype=float),
+                           yvalues=np.arange(ny, dtype=float), phase=phase, coherence=coherence, velocity=velocity,
+                           baselines=baselines)
+
+
+def get_patchy_mask(rng, ny, nx, fraction, patch_size=8):
+    """ Boolean mask covering about fraction of the grid in square patches, like decorrelated areas. """
+    coarse = rng.random((ny // patch_size + 1, nx // patch_size + 1)) < fraction
+    return np.repeat(np.repeat(coarse, patch_size, axis=0), patch_size, axis=1)[0:ny, 0:nx]
+
+
+def to_intf_tuple(stack, coherence=False):
+    """ The stack as a readmytupledata.data tuple, as the readers would have made it. """
+    date_pairs_julian = np.array([dt.datetime.strftime(stack.dates[a], "%Y%j") + "_" +
+                                  dt.datetime.strftime(stack.dates[b], "%Y%j") for a, b in stack.pairs])
+    return rmd.data(filepaths=date_pairs_julian, date_pairs_julian=date_pairs_julian,
+                    date_deltas=np.array([(stack.dates[b] - stack.dates[a]).days / 365.24 for a, b in stack.pairs]),
+                    xvalues=stack.xvalues, yvalues=stack.yvalues,
+                    zvalues=stack.coherence if coherence else stack.phase,
+                    date_pairs_dt=np.array([[stack.dates[a], stack.dates[b]] for a, b in stack.pairs]),
+                    ts_dates=list(stack.dates), epochs=stacking_utilities.make_epoch_table(date_pairs_julian))
+
+
+# ------------ WRITING THE DATA ------------ #
+
+def write_pixelnode_grd(xdata, ydata, zdata, filename):
+    """ A GMT-readable, pixel-node registered netcdf grid, written without calling GMT. """
+    rootgrp = Dataset(filename, 'w', format='NETCDF4')
+    rootgrp.createDimension('x', len(xdata))
+    rootgrp.createDimension('y', len(ydata))
+    rootgrp.node_offset = 1   # pixel-node registration
+    xvar = rootgrp.createVariable('x', 'f8', ('x',))
+    yvar = rootgrp.createVariable('y', 'f8', ('y',))
+    zvar = rootgrp.createVariable('z', 'f4', ('y', 'x'), fill_value=np.nan)
+    xvar[:], yvar[:], zvar[:, :] = xdata, ydata, zdata
+    rootgrp.close()
+    return
+
+
+def write_gmtsar_stack(stack, outdir, intf_filename='unwrap.grd', corr_filename='corr.grd'):
+    """
+    Write a GMTSAR-style stack: outdir/intf_all/YYYYJJJ_YYYYJJJ/{unwrap.grd, corr.grd}, outdir/intf_record.in,
+    and outdir/baseline_table.dat. As in GMTSAR, directory names and baseline times count days from 0.
+    :returns: lists of interferogram and coherence filenames
+    """
+    intf_files, corr_files = [], []
+    record = open(os.path.join(outdir, 'intf_record.in'), 'w')
+    for k, (a, b) in enumerate(stack.pairs):
+        dirname = get_gmtsar_datestr(stack.dates[a]) + "_" + get_gmtsar_datestr(stack.dates[b])
+        os.makedirs(os.path.join(outdir, 'intf_all', dirname), exist_ok=True)
+        intf_files.append(os.path.join(outdir, 'intf_all', dirname, intf_filename))
+        corr_files.append(os.path.join(outdir, 'intf_all', dirname, corr_filename))
+        write_pixelnode_grd(stack.xvalues, stack.yvalues, stack.phase[k], intf_files[-1])
+        write_pixelnode_grd(stack.xvalues, stack.yvalues, stack.coherence[k], corr_files[-1])
+        record.write("S1_%s_ALL_F1:S1_%s_ALL_F1\n" % (dt.datetime.strftime(stack.dates[a], "%Y%m%d"),
+                                                     dt.datetime.strftime(stack.dates[b], "%Y%m%d")))
+    record.close()
+    write_baseline_table(stack, os.path.join(outdir, 'baseline_table.dat'))
+    return intf_files, corr_files
+
+
+def get_gmtsar_datestr(date):
+    """ GMTSAR names days of the year starting from 0, like 2015000 for January 1. """
+    return "%d%03d" % (date.year, date.timetuple().tm_yday - 1)
+
+
+def write_baseline_table(stack, filename):
+    """ Same columns as GMTSAR's baseline_table.dat: stem, YYYYDDD.fraction, mission day, baselines. """
+    ofile = open(filename, 'w')
+    for date, baseline in zip(stack.dates, stack.baselines):
+        stem = "s1a-iw2-slc-vv-%st135134-%st135224-005918-0079fd-002" % (dt.datetime.strftime(date, "%Y%m%d"),
+                                                                         dt.datetime.strftime(date, "%Y%m%d"))
+        ofile.write("%s %s.5774740903 %d %f %f\n" % (stem, get_gmtsar_datestr(date),
+                                                     (date - stack.dates[0]).days + 498, baseline, baseline))
+    ofile.close()
+    return
+
+
+def write_isce_stack(stack, outdir):
+    """
+    Write an ISCE-style stack: outdir/YYYYMMDD_YYYYMMDD/filt_fine.unw (two bands, amplitude and unwrapped phase,
+    interleaved by line) and filt_fine.cor (one band), each with .xml and .vrt headers.
+    :returns: lists of interferogram and coherence filenames
+    """
+    intf_files, corr_files = [], []
+    ny, nx = len(stack.yvalues), len(stack.xvalues)
+    for k, (a, b) in enumerate(stack.pairs):
+        dirname = dt.datetime.strftime(stack.dates[a], "%Y%m%d") + "_" + dt.datetime.strftime(stack.dates[b], "%Y%m%d")
+        os.makedirs(os.path.join(outdir, dirname), exist_ok=True)
+        intf_files.append(os.path.join(outdir, dirname, 'filt_fine.unw'))
+        corr_files.append(os.path.join(outdir, dirname, 'filt_fine.cor'))
+        isce_read_write.write_binary_raster(intf_files[-1], [np.ones((ny, nx)), stack.phase[k]], scheme='BIL')
+        isce_read_write.write_binary_raster(corr_files[-1], [stack.coherence[k]], scheme='BIL')
+        write_isce_headers(intf_files[-1], nx, ny, 2)
+        write_isce_headers(corr_files[-1], nx, ny, 1)
+    return intf_files, corr_files
+
+
+def write_isce_headers(filename, nx, ny, n_bands):
+    """ Minimal .xml (read by isce_read_write) and .vrt (read by GDAL) for a float32 BIL raster. """
+    xml = open(filename + '.xml', 'w')
+    xml.write("<imageFile>\n")
+    for name, size in [('coordinate1', nx), ('coordinate2', ny)]:
+        xml.write('  <component name="%s">\n' % name)
+        xml.write('    <property name="delta"><value>1.0</value></property>\n')
+        xml.write('    <property name="size"><value>%d</value></property>\n' % size)
+        xml.write('    <property name="startingvalue"><value>0.0</value></property>\n')
+        xml.write('  </component>\n')
+    xml.write("</imageFile>\n")
+    xml.close()
+
+    vrt = open(filename + '.vrt', 'w')
+    vrt.write('<VRTDataset rasterXSize="%d" rasterYSize="%d">\n' % (nx, ny))
+    for band in range(n_bands):
+        vrt.write('  <VRTRasterBand dataType="Float32" band="%d" subClass="VRTRawRasterBand">\n' % (band + 1))
+        vrt.write('    <SourceFilename relativeToVRT="1">%s</SourceFilename>\n' % os.path.basename(filename))
+        vrt.write('    <ByteOrder>LSB</ByteOrder>\n')
+        vrt.write('    <ImageOffset>%d</ImageOffset>\n' % (band * nx * 4))
+        vrt.write('    <PixelOffset>4</PixelOffset>\n')
+        vrt.write('    <LineOffset>%d</LineOffset>\n' % (n_bands * nx * 4))
+        vrt.write('  </VRTRasterBand>\n')
+    vrt.write('</VRTDataset>\n')
+    vrt.close()
+    return
@@ -0,0 +1,86 @@
+# Does reading an area of interest give the same answers as reading everything and cropping?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+from matplotlib.path import Path
+from netCDF4 import Dataset
+from .. import aoi, nsbas_batched, stack_corr, synthetic_stack
+from .. import readmytupledata as rmd
+from .test_nsbas_batched import make_param_dict
+
+
+class AreaOfInterestTests(unittest.TestCase):
+
+    def test_points_in_polygon(self):
+        poly_rows, poly_cols = np.array([0.3, 9.6, 9.45, 4.15, 0.55]), np.array([0.45, 1.35, 8.65, 4.7, 8.55])
+        yy, xx = np.meshgrid(np.arange(11), np.arange(10), indexing='ij')
+        inside = aoi.points_in_polygon(yy, xx, poly_rows, poly_cols)
+        expected = Path(np.column_stack([poly_cols, poly_rows])).contains_points(np.column_stack([xx.ravel(),
+                                                                                                   yy.ravel()]))
+        np.testing.assert_array_equal(inside.ravel(), expected)
+        self.assertTrue(inside[8, 4] and not inside[4, 7])   # (4, 7) is in the notch of the concave polygon
+
+    def test_read_and_invert_area_of_interest(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=20, nx=16, n_dates=8, nan_fraction=0.05)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            intf_files, _ = synthetic_stack.write_gmtsar_stack(stack, tmpdir)
+            polygon_file = os.path.join(tmpdir, 'aoi.txt')
+            with open(polygon_file, 'w') as ofile:
+                ofile.write("# lon lat\n3 4\n12 5\n10 15\n4 13\n")   # the axes of the synthetic grids are 0, 1, 2...
+            region = aoi.get_region('2/18/0/16', '', polygon_file, intf_files[0], 1, 'gmtsar')
+            self.assertEqual((region.rows, region.cols), ((4, 16), (3, 13)))
+            frame = aoi.region(rows=(0, 20), cols=(0, 16), mask=None)   # the whole grid, read without GMT
+            full = rmd.reader(intf_files, region=frame)
+            subset = rmd.reader(intf_files, region=region)
+            _, _, ss_full = stack_corr.stack_corr_streaming(intf_files, np.nan,
+                                                            lambda filename: rmd.read_grd(filename, frame))
+            _, _, ss_subset = stack_corr.stack_corr_streaming(intf_files, np.nan,
+                                                              lambda filename: rmd.read_grd(filename, region))
+        np.testing.assert_array_equal(subset.xvalues, full.xvalues[3:13])
+        np.testing.assert_array_equal(subset.yvalues, full.yvalues[4:16])
+        np.testing.assert_array_equal(subset.zvalues[:, region.mask], full.zvalues[:, 4:16, 3:13][:, region.mask])
+        self.assertTrue(np.all(np.isnan(subset.zvalues[:, ~region.mask])))
+        np.testing.assert_array_equal(aoi.crop_grid_to_axes(full.xvalues, full.yvalues, ss_full, subset.xvalues,
+                                                            subset.yvalues)[region.mask], ss_subset[region.mask])
+        np.testing.assert_array_equal(ss_subset[~region.mask], 0)
+
+        # Pixels inside the polygon get the same velocities as in the full frame
+        param_dict = make_param_dict()
+        param_dict.update({"rowref": 9, "colref": 7})
+        vel_full, _ = nsbas_batched.Velocities(param_dict, full, ss_full, None, None)
+        param_dict["rowref"], param_dict["colref"] = aoi.shift_to_region(9, 7, region)
+        vel_subset, _ = nsbas_batched.Velocities(param_dict, subset, ss_subset, None, None)
+        np.testing.assert_allclose(vel_subset[region.mask], vel_full[4:16, 3:13][region.mask], atol=1e-6)
+        self.assertTrue(np.all(np.isnan(vel_subset[~region.mask])))
+        with self.assertRaises(ValueError):
+            aoi.shift_to_region(2, 7, region)   # reference pixel outside the area of interest
+
+    def test_bounds_box_mask(self):
+        # On geocoded grids the box is the window, edges included, so there's nothing to mask
+        stack = synthetic_stack.make_synthetic_stack(ny=20, nx=16, n_dates=5)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            intf_files, _ = synthetic_stack.write_gmtsar_stack(stack, tmpdir)
+            region = aoi.get_region('', '3/12/4/15', '', intf_files[0], 1, 'gmtsar')
+        self.assertEqual((region.rows, region.cols, region.mask), ((4, 16), (3, 13), None))
+
+        # In radar coordinates the box is tilted: its corners are kept, and the corners of its window are masked
+        vertex_rows, vertex_cols = np.array([2, 4, 12, 10]), np.array([1, 9, 7, 0])
+        mask = aoi.get_polygon_mask((2, 13), (0, 10), *aoi.pad_box_corners(vertex_rows, vertex_cols))
+        self.assertTrue(np.all(mask[vertex_rows - 2, vertex_cols]))
+        self.assertFalse(mask[0, 9] or mask[10, 0] or mask[0, 0] or mask[10, 9])
+
+    def test_read_area_of_interest_needs_pixel_node_registration(self):
+        frame = aoi.region(rows=(0, 3), cols=(0, 4), mask=None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'gridline.grd')
+            synthetic_stack.write_pixelnode_grd(np.arange(4.0), np.arange(3.0), np.zeros((3, 4)), filename)
+            self.assertEqual(np.shape(rmd.read_grd(filename, frame)[2]), (3, 4))
+            with Dataset(filename, 'a') as rootgrp:
+                rootgrp.node_offset = 0   # gridline registration
+            self.assertRaises(ValueError, rmd.read_grd, filename, frame)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import datetime as dt
+import numpy as np
+
+# Does the block DEM error correction agree with a per-pixel least-squares solve of the Fattahi and Amelung model?
+
+from .. import dem_error_correction
+
+
+def reference_driver(ts_vector, dtarray, baselines):
+    """ One pixel at a time, as the correction was originally written """
+    ts_vector = np.multiply(ts_vector, 0.001)
+    G = np.ones((len(baselines) - 1, 2))
+    v = np.zeros(len(baselines) - 1)
+    for i in range(len(baselines) - 1):
+        v[i] = (ts_vector[i + 1] - ts_vector[i]) / (dtarray[i + 1] - dtarray[i]).days
+        G[i, 1] = (baselines[i + 1] - baselines[i]) / (dtarray[i + 1] - dtarray[i]).days
+    K_z_error = np.linalg.lstsq(G, v, rcond=0.1)[0][1]
+    return np.multiply(ts_vector - K_z_error * (np.array(baselines) - baselines[0]), 1000), K_z_error
+
+
+class DemErrorTests(unittest.TestCase):
+
+    def test_block_matches_per_pixel(self):
+        rng = np.random.default_rng(0)
+        dtarray = [dt.datetime(2016, 1, 5) + dt.timedelta(days=12 * k) for k in range(15)]
+        datestrs = [dt.datetime.strftime(x, "%Y%j") for x in dtarray]
+        baselines = rng.normal(scale=80, size=15)
+        baseline_tuple = [(baselines[k], dtarray[k], datestrs[k]) for k in range(15)]
+        baseline_tuple.append((25.0, dt.datetime(2020, 1, 1), "2020001"))   # a date we don't use
+        ts_block = rng.normal(size=(15, 6)).cumsum(axis=0) + np.outer(baselines, rng.normal(scale=0.05, size=6))
+        ts_block[:, 4] = np.nan
+
+        corrected, Kz_error = dem_error_correction.driver_block(ts_block, datestrs, baseline_tuple)
+        for k in [0, 1, 2, 3, 5]:
+            expected_ts, expected_Kz = reference_driver(ts_block[:, k], dtarray, baselines)
+            np.testing.assert_allclose(corrected[:, k], expected_ts, atol=1e-9)
+            self.assertAlmostEqual(Kz_error[k], expected_Kz, places=12)
+            single_ts, single_Kz = dem_error_correction.driver(ts_block[:, k], datestrs, baseline_tuple)
+            np.testing.assert_allclose(single_ts, corrected[:, k])
+        self.assertTrue(np.isnan(Kz_error[4]))
+        _, nan_Kz = dem_error_correction.driver(ts_block[:, 4], datestrs, baseline_tuple)
+        self.assertTrue(np.isnan(nan_Kz))
+
+
+if __name__ == "__main__":
+    unittest.main()
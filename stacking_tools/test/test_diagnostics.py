@@ -0,0 +1,71 @@
+# Do the NSBAS engines count what happens to each pixel, also across worker processes, and is progress logged?
+
+import contextlib
+import datetime as dt
+import io
+import logging
+import os
+import tempfile
+import unittest
+import numpy as np
+from .. import diagnostics, nsbas, nsbas_tiles, nsbas_parametric, nsbas_checkpoint
+from .test_nsbas_batched import make_synthetic_intf_tuple, make_param_dict
+from .test_nsbas_parametric import make_parametric_stack
+
+
+class DiagnosticsTests(unittest.TestCase):
+
+    def test_counts_match_across_engines_and_workers(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        signal_spread[-2:, :] = 10   # low signal spread
+        param_dict = make_param_dict()
+        diagnostics.pop_counts()
+        nsbas.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+        counts_ref = diagnostics.pop_counts()
+        self.assertEqual(counts_ref["low_signal_spread"], 14)
+        self.assertEqual(counts_ref["low_signal_spread"] + counts_ref.get("too_many_nans", 0) +
+                         counts_ref["inverted"], 11 * 7)
+
+        # The tiled engines find the disconnected pixels before inverting, instead of in the solver
+        counts_tiled = dict(counts_ref, disconnected=2, inverted=61)
+        counts_tiled.pop("singular_network"), counts_tiled.pop("nan_only")
+        for engine in ['batched', 'pixel']:
+            for n_workers in [1, 2]:
+                param_dict.update({"nsbas_engine": engine, "n_workers": n_workers})
+                nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+                self.assertEqual(diagnostics.pop_counts(), counts_tiled)
+
+    def test_progress_and_summary(self):
+        with self.assertLogs(diagnostics.logger, level='INFO') as logs:
+            progress = diagnostics.make_progress(100, interval_s=0)
+            progress.update(40)
+            progress.finish()
+            diagnostics.log_summary({"singular_network": 3, "something_else": 1})
+        self.assertIn("Done with 40 of 100 pixels", logs.output[0])
+        self.assertIn("ETA", logs.output[0])
+        self.assertTrue(any(["singular_network" in x for x in logs.output]))
+        self.assertTrue(any(["something_else" in x for x in logs.output]))
+        with self.assertRaises(AssertionError):   # nothing is logged above the chosen level
+            with self.assertLogs(diagnostics.logger, level='WARNING'):
+                diagnostics.make_progress(100, interval_s=0, level=logging.INFO).update(1)
+
+    def test_messages_go_through_logging(self):
+        ny, nx, n_dates = 3, 4, 12
+        intf_tuple, _ = make_parametric_stack(np.zeros((5, ny, nx)), dt.datetime(2015, 3, 1), np.zeros(n_dates),
+                                              ny, nx, n_dates)
+        param_dict = {"nsbas_good_perc": 50, "wavelength": 56, "rowref": 0, "colref": 0, "dem_error": 0,
+                      "ts_type": 'NSBAS'}
+        package_logger = logging.getLogger(diagnostics.__name__.rsplit('.', 1)[0])
+        stdout = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir, contextlib.redirect_stdout(stdout):
+            with self.assertLogs(package_logger, level='INFO') as logs:
+                nsbas_parametric.Parametric_Model(param_dict, intf_tuple, 100 * np.ones((ny, nx)), None, None, [])
+                nsbas_checkpoint.open_checkpoint(os.path.join(tmpdir, 'checkpoint'), 'hash', [(0, ny)], resume=True)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertTrue(any(["Done with %d pixels" % (ny * nx) in x for x in logs.output]))
+        self.assertTrue(any(["No checkpoint found" in x for x in logs.output]))
+
+
+if __name__ == "__main__":
+    unittest.main()
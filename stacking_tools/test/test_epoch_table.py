@@ -0,0 +1,85 @@
+import unittest
+import pickle
+import tempfile
+import numpy as np
+
+# Does the integer epoch table describe the network the same way as the date strings?
+
+from .. import stacking_utilities, synthetic_stack, aoi
+from .. import readmytupledata as rmd
+from .test_nsbas_batched import make_synthetic_intf_tuple
+
+
+class EpochTableTests(unittest.TestCase):
+
+    def test_epoch_table(self):
+        date_pairs = ['2015010_2015022', '2015022_2015046', '2015010_2015046', '2016001_2016013']
+        epochs = stacking_utilities.make_epoch_table(date_pairs)
+        datestrs, _, x_axis_days = stacking_utilities.get_TS_dates(date_pairs)
+        self.assertEqual(list(epochs.datestrs), datestrs)
+        self.assertEqual(list(epochs.days), x_axis_days)
+        np.testing.assert_array_equal(epochs.pair_index, [[0, 1], [1, 2], [0, 2], [3, 4]])
+        self.assertEqual(epochs.pair_index.dtype, np.int32)
+        np.testing.assert_allclose(epochs.years, np.array(x_axis_days) / 365.24)
+
+    def test_connected_components(self):
+        date_pairs = ['2015010_2015022', '2015022_2015046', '2015010_2015046', '2016001_2016013']
+        datestrs, _, _ = stacking_utilities.get_TS_dates(date_pairs)
+        cc_num, num_elements, labels = stacking_utilities.connected_components_search(date_pairs, datestrs)
+        self.assertEqual(num_elements, 3)
+        np.testing.assert_array_equal(labels == float(cc_num), [True, True, True, False, False])
+        new_pairs, new_datestrs = stacking_utilities.reduce_graph_to_largest_cc(date_pairs, datestrs)
+        self.assertEqual(new_pairs, date_pairs[0:3])
+        self.assertEqual(new_datestrs, datestrs[0:3])
+
+        epochs = stacking_utilities.make_epoch_table(date_pairs)
+        valid = np.array([True, False, True, True])
+        kept, used_epochs = stacking_utilities.reduce_pairs_to_largest_cc(epochs, valid)
+        np.testing.assert_array_equal(kept, [True, False, True, False])
+        np.testing.assert_array_equal(used_epochs, [0, 1, 2])
+
+    def test_batched_networks_are_memoized(self):
+        date_pairs = ['2015010_2015022', '2015022_2015046', '2015010_2015046', '2016001_2016013']
+        epochs = stacking_utilities.make_epoch_table(date_pairs)
+        masks = np.array([[True, True, True, True], [True, False, True, True], [True, True, True, True],
+                          [False, False, False, True]])
+        stacking_utilities.reduce_packed_mask_to_largest_cc.cache_clear()
+        kept, used_epochs = stacking_utilities.reduce_masks_to_largest_cc(epochs, masks)
+        np.testing.assert_array_equal(kept, [[True, True, True, False], [True, False, True, False],
+                                             [True, True, True, False], [False, False, False, True]])
+        np.testing.assert_array_equal(used_epochs[1], [0, 1, 2])
+        np.testing.assert_array_equal(used_epochs[3], [3, 4])
+        self.assertEqual(stacking_utilities.reduce_packed_mask_to_largest_cc.cache_info().misses, 3)
+        for k in range(len(masks)):
+            kept_k, epochs_k = stacking_utilities.reduce_pairs_to_largest_cc(epochs, masks[k])
+            np.testing.assert_array_equal(kept_k, kept[k])
+        self.assertEqual(stacking_utilities.reduce_packed_mask_to_largest_cc.cache_info().misses, 3)
+
+        # A table pickled into another process isn't in that process's registry until it's used
+        stacking_utilities._epoch_tables.pop(epochs.network_id)
+        stacking_utilities.reduce_packed_mask_to_largest_cc.cache_clear()
+        unpickled = pickle.loads(pickle.dumps(epochs))
+        kept_again, _ = stacking_utilities.reduce_masks_to_largest_cc(unpickled, masks)
+        np.testing.assert_array_equal(kept_again, kept)
+        self.assertIs(stacking_utilities.get_registered_epoch_table(epochs.network_id), unpickled)
+
+    def test_readers_attach_table(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=4, nx=3, n_dates=6)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            intf_files, _ = synthetic_stack.write_gmtsar_stack(stack, tmpdir)
+            intf_tuple = rmd.reader(intf_files, region=aoi.region(rows=(0, 4), cols=(0, 3), mask=None))
+        self.assertIsNotNone(intf_tuple.epochs)
+        self.assertEqual(len(intf_tuple.epochs.pair_index), len(intf_tuple.date_pairs_julian))
+        self.assertEqual(list(intf_tuple.epochs.dates), list(intf_tuple.ts_dates))
+        self.assertIs(synthetic_stack.to_intf_tuple(stack).epochs, intf_tuple.epochs)   # same network, same table
+
+    def test_table_made_on_the_spot(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        self.assertIsNone(intf_tuple.epochs)
+        epochs = stacking_utilities.get_epoch_table(intf_tuple)
+        self.assertEqual(len(epochs.pair_index), len(intf_tuple.date_pairs_julian))
+        self.assertIs(stacking_utilities.get_registered_epoch_table(epochs.network_id), epochs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# Does the batched NSBAS engine reproduce the per-pixel reference implementation?
+
+import unittest
+import datetime as dt
+import numpy as np
+from .. import nsbas, nsbas_batched, nsbas_tiles, stacking_utilities
+from .. import readmytupledata as rmd
+
+
+def make_synthetic_intf_tuple(ny=6, nx=5, n_dates=8, seed=0):
+    """A small network (each date connected to the next two) with a few nans and a disconnected last date."""
+    rng = np.random.default_rng(seed)
+    dates = [dt.datetime(2015, 1, 10) + dt.timedelta(days=12 * k) for k in range(n_dates)]
+    pairs = [(a, b) for a in range(n_dates) for b in range(a + 1, min(a + 3, n_dates))]
+    date_pairs_julian = [dt.datetime.strftime(dates[a], "%Y%j") + "_" + dt.datetime.strftime(dates[b], "%Y%j")
+                         for a, b in pairs]
+    displacement = rng.normal(size=(n_dates, ny, nx)).cumsum(axis=0)
+    zvalues = np.array([displacement[b] - displacement[a] for a, b in pairs])
+    zvalues = zvalues + rng.normal(scale=0.05, size=np.shape(zvalues))
+    zvalues[1, 2:4, 1:3] = np.nan   # pixels missing one interferogram
+    zvalues[4, 3:5, 2:4] = np.nan
+    last_date_intfs = [k for k, (a, b) in enumerate(pairs) if b == n_dates - 1]
+    zvalues[np.ix_(last_date_intfs, [5], [0, 1])] = np.nan   # pixels where the last date is disconnected
+    intf_tuple = rmd.data(filepaths=np.array(date_pairs_julian), date_pairs_julian=np.array(date_pairs_julian),
+                          date_deltas=np.array([(dates[b] - dates[a]).days / 365.24 for a, b in pairs]),
+                          xvalues=np.arange(nx), yvalues=np.arange(ny), zvalues=zvalues,
+                          date_pairs_dt=np.array([[dates[a], dates[b]] for a, b in pairs]), ts_dates=dates)
+    coh_values = rng.uniform(0.3, 1.0, size=np.shape(zvalues))
+    coh_tuple = intf_tuple._replace(zvalues=coh_values)
+    return intf_tuple, coh_tuple
+
+
+def make_param_dict(ts_type='NSBAS', sbas_smoothing=0):
+    return {"nsbas_good_perc": 50, "sbas_smoothing": sbas_smoothing, "wavelength": 56, "rowref": 0, "colref": 0,
+            "dem_error": 0, "ts_type": ts_type, "signal_coh_cutoff": 0.1, "start_index": 0, "end_index": None}
+
+
+class BatchedNSBASTests(unittest.TestCase):
+
+    def test_full_ts_matches_reference(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        for smoothing in [0, 2.0]:
+            param_dict = make_param_dict(sbas_smoothing=smoothing)
+            ts_ref, _ = nsbas.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+            ts_batch, _ = nsbas_batched.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+            for i in range(len(intf_tuple.yvalues)):
+                for j in range(len(intf_tuple.xvalues)):
+                    np.testing.assert_allclose(ts_batch[i][j][0], ts_ref[i][j][0], atol=1e-8, equal_nan=True)
+        self.assertTrue(np.all(np.isnan(ts_batch[5][0][0])))   # the disconnected pixel is returned as nans
+
+    def test_velocities_match_reference(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple()
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        vel_ref, _ = nsbas.Velocities(param_dict, intf_tuple, signal_spread, None, None)
+        vel_batch, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, None)
+        np.testing.assert_allclose(vel_batch, vel_ref, atol=1e-8)
+
+        param_dict = make_param_dict(ts_type='WNSBAS')
+        vel_ref, _ = nsbas.Velocities(param_dict, intf_tuple, signal_spread, None, coh_tuple)
+        vel_batch, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, coh_tuple)
+        np.testing.assert_allclose(vel_batch, vel_ref, atol=1e-8)
+
+    def test_sparse_solver_matches_dense(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple(ny=8, nx=6, n_dates=12)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        datestrs, _, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
+        G = nsbas_batched.build_nsbas_G(intf_tuple.date_pairs_julian, datestrs)
+        G_sparse = nsbas_batched.build_nsbas_G_sparse(intf_tuple.date_pairs_julian, datestrs)
+        np.testing.assert_array_equal(G_sparse.toarray(), G)
+        for ts_type, coh in [('NSBAS', None), ('WNSBAS', coh_tuple)]:
+            param_dict = make_param_dict(ts_type=ts_type)
+            vel_dense, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, coh)
+            ts_dense, _ = nsbas_batched.Full_TS(param_dict, intf_tuple, signal_spread, None, coh)
+            param_dict["nsbas_solver"] = 'sparse'
+            vel_sparse, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, coh)
+            ts_sparse, _ = nsbas_batched.Full_TS(param_dict, intf_tuple, signal_spread, None, coh)
+            np.testing.assert_allclose(vel_sparse, vel_dense, atol=1e-6, equal_nan=True)
+            np.testing.assert_allclose(ts_sparse[4][3][0], ts_dense[4][3][0], atol=1e-6)
+
+    def test_weighted_solve_in_chunks(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple(ny=8, nx=6, n_dates=12)
+        datestrs, _, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
+        G = nsbas_batched.build_nsbas_G(intf_tuple.date_pairs_julian, datestrs)
+        pixel_values = intf_tuple.zvalues[:, 0:2, :].reshape(len(G), -1)
+        coh_values = coh_tuple.zvalues[:, 0:2, :].reshape(len(G), -1)
+        m_all = nsbas_batched.solve_weighted_block(G, pixel_values, coh_values)
+        m_chunks = nsbas_batched.solve_weighted_block(G, pixel_values, coh_values, max_bytes=3 * 16 * 11 ** 2)
+        np.testing.assert_allclose(m_chunks, m_all, atol=1e-10)   # three pixels at a time
+
+    def test_pinv_gives_singular_values(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(n_dates=12)
+        datestrs, _, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
+        G = nsbas_batched.build_nsbas_G(intf_tuple.date_pairs_julian, datestrs)
+        G_pinv, singular_values = nsbas_batched.pinv_with_singular_values(G)
+        np.testing.assert_allclose(G_pinv, np.linalg.pinv(G), atol=1e-12)
+        self.assertAlmostEqual(singular_values[0] / singular_values[-1], np.linalg.cond(G))
+
+    def test_grouping_by_signature(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        packed = nsbas_batched.compute_validity_bitmasks(make_param_dict(), intf_tuple)
+        packed = packed.reshape(np.shape(packed)[0], -1)
+        signatures, groups = nsbas_batched.group_pixels_by_signature(packed, np.arange(np.shape(packed)[1]))
+        self.assertEqual(len(signatures), len(groups))
+        self.assertEqual(sum([len(x) for x in groups]), np.size(intf_tuple.zvalues[0]))
+        self.assertEqual(len(groups), 5)   # full network, two nan patterns, their overlap, disconnected date
+        datestrs, _, _ = stacking_utilities.get_TS_dates(intf_tuple.date_pairs_julian)
+        self.assertEqual(len(datestrs), 8)
+
+    def test_eligibility_codes(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        intf_tuple.zvalues[[1, 4, 5], 0, 0] = np.nan   # nans at the reference pixel
+        intf_tuple.zvalues[[0, 2, 3, 6, 7, 8, 9, 10], 1, 4] = np.nan
+        intf_tuple.zvalues[[0, 2, 3, 6], 2, 4] = np.nan   # enough data, but not once the reference is removed
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        signal_spread[0, 4] = 10
+        param_dict = make_param_dict()
+        expected = np.zeros(np.shape(signal_spread), dtype=np.int8)
+        expected[0, 4], expected[1, 4] = nsbas_batched.LOW_SIGNAL_SPREAD, nsbas_batched.TOO_FEW_INTFS
+        expected[2, 4] = nsbas_batched.REFERENCE_NAN
+        pixels = nsbas_batched.compute_eligibility(param_dict, intf_tuple, signal_spread, per_pixel_networks=True)
+        np.testing.assert_array_equal(pixels.codes, expected)   # velocities use the largest connected component
+        expected[5, 0:2] = nsbas_batched.DISCONNECTED
+        pixels = nsbas_batched.compute_eligibility(param_dict, intf_tuple, signal_spread)
+        np.testing.assert_array_equal(pixels.codes, expected)
+        pixels = nsbas_batched.compute_eligibility(param_dict, intf_tuple, signal_spread, end_index=10)
+        self.assertEqual(pixels.codes[5, 1], nsbas_batched.NOT_VISITED)   # column-major, like nsbas.iterator_func
+        self.assertEqual(pixels.codes[3, 1], nsbas_batched.ELIGIBLE)
+
+        # Skipping the ineligible pixels doesn't change the answers
+        ts_ref, _ = nsbas.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+        ts_ref = np.array([[ts_ref[i][j][0] for j in range(5)] for i in range(6)]).transpose((2, 0, 1))
+        for engine in ['batched', 'pixel']:
+            param_dict.update({"nsbas_engine": engine, "n_workers": 1})
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+            np.testing.assert_array_equal(outputs["eligibility"], expected)
+            np.testing.assert_allclose(outputs["ts"], ts_ref, atol=1e-4, equal_nan=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
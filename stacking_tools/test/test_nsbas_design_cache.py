@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+# Do the cached design matrix and smoothing operator give the same answers as fresh least-squares solves?
+
+from .. import nsbas
+from .test_nsbas_batched import make_synthetic_intf_tuple
+
+
+class DesignCacheTests(unittest.TestCase):
+
+    def test_cached_pixels_match_lstsq(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple()
+        datestrs = sorted(set([x[0:7] for x in intf_tuple.date_pairs_julian] +
+                              [x[8:15] for x in intf_tuple.date_pairs_julian]))
+        nsbas.get_design_entry.cache_clear()
+        for i, j in [(0, 0), (1, 1), (2, 1), (3, 3), (0, 4)]:
+            pixel_value = intf_tuple.zvalues[:, i, j] - intf_tuple.zvalues[:, 0, 0]
+            ts = nsbas.do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, 56, datestrs)
+            good = ~np.isnan(pixel_value)
+            G = np.zeros((np.sum(good), len(datestrs) - 1))
+            for row, pair in enumerate(intf_tuple.date_pairs_julian[good]):
+                G[row, datestrs.index(pair[0:7]):datestrs.index(pair[8:15])] = 1
+            m = np.linalg.lstsq(G, pixel_value[good], rcond=None)[0]
+            expected = np.concatenate(([0], np.cumsum(m))) * -56 / (4 * np.pi)
+            np.testing.assert_allclose(ts, expected, atol=1e-10)
+            weighted = nsbas.do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, 56, datestrs,
+                                            coh_tuple.zvalues[:, i, j])
+            self.assertEqual(len(weighted), len(datestrs))
+        stats = nsbas.get_design_cache_stats()
+        self.assertEqual(stats["networks"], 3)   # full network, and two with one interferogram missing
+        self.assertEqual(stats["hits"] + stats["misses"], 10)
+
+    def test_disconnected_network_returns_nans(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        datestrs = sorted(set([x[0:7] for x in intf_tuple.date_pairs_julian] +
+                              [x[8:15] for x in intf_tuple.date_pairs_julian]))
+        pixel_value = intf_tuple.zvalues[:, 5, 0] - intf_tuple.zvalues[:, 0, 0]
+        ts = nsbas.do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, 56, datestrs)
+        self.assertTrue(np.all(np.isnan(ts)))
+
+    def test_block_smoothing_matches_normal_equations(self):
+        rng = np.random.default_rng(1)
+        ts_block = rng.normal(size=(15, 4)).cumsum(axis=0)
+        ts_block[6, 3] = np.nan
+        smoothing = 2.0
+        G = np.vstack((np.eye(15), smoothing * (np.eye(15) - np.eye(15, k=1))[0:14]))
+        smoothed = nsbas.smooth_ts_block(ts_block, smoothing)
+        for k in range(3):
+            d = np.hstack((ts_block[:, k], np.zeros(14)))
+            np.testing.assert_allclose(smoothed[:, k], np.linalg.lstsq(G, d, rcond=None)[0], atol=1e-10)
+            np.testing.assert_allclose(nsbas.temporal_smoothing_ts(ts_block[:, k], smoothing), smoothed[:, k])
+        self.assertTrue(np.all(np.isnan(smoothed[:, 3])))
+
+
+if __name__ == "__main__":
+    unittest.main()
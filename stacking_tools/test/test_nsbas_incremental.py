@@ -0,0 +1,124 @@
+# Does adding interferograms to a stored NSBAS state give the same time series as inverting everything at once?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+from netCDF4 import Dataset
+from .. import nsbas_incremental, nsbas_batched, synthetic_stack, stacking_utilities, ts_output
+from .. import readmytupledata as rmd
+from .test_nsbas_batched import make_param_dict
+
+
+def subset_intf_tuple(intf_tuple, keep):
+    date_pairs_julian = intf_tuple.date_pairs_julian[keep]
+    return intf_tuple._replace(filepaths=intf_tuple.filepaths[keep], date_pairs_julian=date_pairs_julian,
+                               date_deltas=intf_tuple.date_deltas[keep], zvalues=intf_tuple.zvalues[keep],
+                               date_pairs_dt=intf_tuple.date_pairs_dt[keep],
+                               epochs=stacking_utilities.make_epoch_table(date_pairs_julian))
+
+
+def full_ts(param_dict, intf_tuple, signal_spread):
+    ny, nx = np.shape(signal_spread)
+    ts, _ = nsbas_batched.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+    return np.array([[ts[i][j][0] for j in range(nx)] for i in range(ny)]).transpose((2, 0, 1))
+
+
+def read_cube(cube_file):
+    with ts_output.open_ts_cube(cube_file) as cube:
+        return np.array(cube[:])
+
+
+class IncrementalNSBASTests(unittest.TestCase):
+
+    def test_incremental_matches_full_inversion(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=9, nx=8, n_dates=12, nan_fraction=0.1)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        signal_spread = 100 * np.ones((9, 8))
+        param_dict = make_param_dict()
+        ts_ref = full_ts(param_dict, intf_tuple, signal_spread)
+
+        # The last two acquisitions arrive later
+        late = np.array([b >= 10 for a, b in stack.pairs])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file, cube_file = os.path.join(tmpdir, 'nsbas_state.nc'), os.path.join(tmpdir, 'ts_cube.nc')
+            early_tuple = subset_intf_tuple(intf_tuple, ~late)
+            state = nsbas_incremental.create_state(state_file, early_tuple, param_dict)
+            state, changed = nsbas_incremental.ingest(state, early_tuple, param_dict)
+            self.assertEqual(len(state.datestrs), 10)
+            nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file)
+            np.testing.assert_allclose(read_cube(cube_file), full_ts(param_dict, early_tuple, signal_spread),
+                                       atol=1e-4, equal_nan=True)
+            with self.assertRaises(ValueError):
+                nsbas_incremental.read_state(state_file)   # not finished yet
+            nsbas_incremental.finish_update(state)
+
+            state = nsbas_incremental.read_state(state_file)
+            state, changed = nsbas_incremental.ingest(state, subset_intf_tuple(intf_tuple, late), param_dict)
+            self.assertEqual(len(state.date_pairs_julian), len(stack.pairs))
+            cube_inode = os.stat(cube_file).st_ino
+            nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file, max_bytes=2000)
+            nsbas_incremental.finish_update(state)
+            self.assertEqual(os.stat(cube_file).st_ino, cube_inode)   # new dates were appended, not a new cube
+            np.testing.assert_allclose(read_cube(cube_file), ts_ref, atol=1e-4, equal_nan=True)   # old dates too
+            self.assertTrue(np.any(~np.isnan(nsbas_incremental.read_velocity(state))))
+
+            # Ingesting the same interferograms again changes nothing, and solves nothing
+            state, changed = nsbas_incremental.ingest(nsbas_incremental.read_state(state_file), intf_tuple,
+                                                      param_dict)
+            self.assertFalse(np.any(changed))
+            self.assertEqual(nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file),
+                             0)
+
+    def test_only_changed_pixels_are_solved(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=9, nx=8, n_dates=12, nan_fraction=0)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        zvalues = np.array(intf_tuple.zvalues)
+        zvalues[5, 3:, :] = np.nan   # an interferogram between old dates, with data in the first three rows only
+        intf_tuple = intf_tuple._replace(zvalues=zvalues)
+        signal_spread = 100 * np.ones((9, 8))
+        param_dict = make_param_dict()
+        held_back = np.arange(len(stack.pairs)) == 5
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file, cube_file = os.path.join(tmpdir, 'nsbas_state.nc'), os.path.join(tmpdir, 'ts_cube.nc')
+            state = nsbas_incremental.create_state(state_file, intf_tuple, param_dict)
+            state, changed = nsbas_incremental.ingest(state, subset_intf_tuple(intf_tuple, ~held_back), param_dict)
+            nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file)
+            state, changed = nsbas_incremental.ingest(state, subset_intf_tuple(intf_tuple, held_back), param_dict)
+            np.testing.assert_array_equal(np.nonzero(changed)[0], np.repeat(np.arange(3), 8))
+            with Dataset(cube_file, 'a') as rootgrp:
+                rootgrp.variables['z'][:, 3:, :] = -999   # rows that must be left alone
+            n_solved = nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file)
+            self.assertEqual(n_solved, 3 * 8)
+            ts_ref = full_ts(param_dict, intf_tuple, signal_spread)
+            np.testing.assert_allclose(read_cube(cube_file)[:, 0:3], ts_ref[:, 0:3], atol=1e-4, equal_nan=True)
+            np.testing.assert_array_equal(read_cube(cube_file)[:, 3:],   # unless they aren't eligible anymore
+                                          np.where(np.isnan(ts_ref[:, 3:]), np.nan, -999))
+
+    def test_backfilled_dates_rewrite_the_cube(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=6, nx=5, n_dates=10, nan_fraction=0)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        signal_spread = 100 * np.ones((6, 5))
+        param_dict = make_param_dict()
+        early = np.array([a >= 1 for a, b in stack.pairs])   # the first acquisition arrives later
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file, cube_file = os.path.join(tmpdir, 'nsbas_state.nc'), os.path.join(tmpdir, 'ts_cube.nc')
+            state = nsbas_incremental.create_state(state_file, intf_tuple, param_dict)
+            for keep in [early, ~early]:
+                state, changed = nsbas_incremental.ingest(state, subset_intf_tuple(intf_tuple, keep), param_dict)
+                nsbas_incremental.update_outputs(param_dict, state, changed, signal_spread, cube_file)
+            self.assertEqual(ts_output.get_cube_dates(cube_file), list(intf_tuple.ts_dates))
+            np.testing.assert_allclose(read_cube(cube_file), full_ts(param_dict, intf_tuple, signal_spread),
+                                       atol=1e-4, equal_nan=True)
+
+    def test_new_intf_files(self):
+        state = nsbas_incremental.nsbas_state(filename=None, date_pairs_julian=['2015158_2015170'],
+                                              datestrs=['2015158', '2015170'], xvalues=None, yvalues=None,
+                                              rowref=0, colref=0)
+        files = ['intf_all/2015157_2015169/unwrap.grd', 'intf_all/2015169_2015181/unwrap.grd']
+        self.assertEqual(nsbas_incremental.get_new_intf_files(state, files, rmd.get_gmtsar_date_pair), [files[1]])
+        self.assertEqual(rmd.get_isce_date_pair('stack/20150607_20150619/filt_fine.unw'), '2015158_2015170')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Are the per-pixel metrics of the batched engine filled into typed layers, and written to one netcdf file?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+from netCDF4 import Dataset
+from .. import nsbas_metrics, nsbas_tiles, nsbas_batched, stacking_utilities
+from .test_nsbas_batched import make_synthetic_intf_tuple, make_param_dict
+
+
+class NSBASMetricsTests(unittest.TestCase):
+
+    def test_tiled_metrics(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 1})
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        self.assertNotIn("Kz_error", outputs)   # only with the DEM error correction
+        self.assertEqual(nsbas_metrics._registry["Kz_error"].units, 'm')   # as in the Kz_error grid
+        self.assertEqual(outputs["n_intfs"].dtype, np.int16)
+        self.assertEqual(outputs["n_components"].dtype, np.uint8)
+        self.assertEqual(outputs["residual_rms"].dtype, np.float32)
+
+        # A pixel with every interferogram: compare with a least squares solution of its own
+        n_intf = len(intf_tuple.zvalues)
+        pixel_values = intf_tuple.zvalues[:, 0, 6] - intf_tuple.zvalues[:, 0, 0]
+        datestrs = list(stacking_utilities.get_epoch_table(intf_tuple).datestrs)
+        G = nsbas_batched.build_nsbas_G(intf_tuple.date_pairs_julian, datestrs)
+        m = np.linalg.lstsq(G, pixel_values, rcond=None)[0]
+        self.assertEqual(outputs["n_intfs"][0, 6], n_intf)
+        self.assertEqual(outputs["n_components"][0, 6], 1)
+        self.assertAlmostEqual(outputs["residual_rms"][0, 6], np.sqrt(np.mean((G.dot(m) - pixel_values) ** 2)),
+                               places=5)
+        self.assertAlmostEqual(outputs["condition_number"][0, 6], np.linalg.cond(G), places=3)
+
+        # Pixels whose last date is disconnected are not inverted, but the network is still described
+        self.assertTrue(np.isnan(outputs["residual_rms"][5, 0]))
+        self.assertEqual(outputs["n_components"][5, 0], 2)
+        self.assertLess(outputs["n_intfs"][5, 0], n_intf)
+
+        param_dict["n_workers"] = 2
+        outputs_parallel = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None,
+                                                       'timeseries')
+        for name in nsbas_metrics.get_metric_specs(param_dict, (11, 7)):
+            np.testing.assert_array_equal(outputs_parallel[name], outputs[name])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'nsbas_metrics.nc')
+            store = {x.name: outputs[x.name] for x in nsbas_metrics.get_active_metrics(param_dict)}
+            nsbas_metrics.write_metrics(store, intf_tuple.xvalues, intf_tuple.yvalues, filename)
+            rootgrp = Dataset(filename, 'r')
+            self.assertEqual(set(rootgrp.variables.keys()) - {'x', 'y'}, set(store.keys()))
+            np.testing.assert_array_equal(rootgrp.variables["n_intfs"][:], outputs["n_intfs"])
+            rootgrp.close()
+
+    def test_sparse_solver_skips_condition_number(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 1, "nsbas_solver": 'sparse'})
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        self.assertTrue(np.all(np.isnan(outputs["condition_number"])))
+        self.assertFalse(np.isnan(outputs["residual_rms"][0, 6]))
+
+    def test_registered_metric(self):
+        param_dict = make_param_dict()
+        nsbas_metrics.register_metric("max_abs_ts", np.float32, np.nan, 'mm',
+                                      lambda block: np.max(np.abs(block.ts_block), axis=0),
+                                      condition=lambda params: params.get("test_max_abs_ts", False))
+        self.assertNotIn("max_abs_ts", nsbas_metrics.get_metric_specs(param_dict, (3, 3)))
+        param_dict["test_max_abs_ts"] = True
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 1})
+        try:
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        finally:
+            nsbas_metrics._registry.pop("max_abs_ts")
+        inverted = ~np.all(np.isnan(outputs["ts"]), axis=0)
+        np.testing.assert_allclose(outputs["max_abs_ts"][inverted], np.max(np.abs(outputs["ts"]), axis=0)[inverted],
+                                   rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# Does the parametric inversion recover a known velocity, seasonal signal, step, and DEM error from interferograms?
+
+import unittest
+import datetime as dt
+import numpy as np
+from .. import nsbas_parametric, nsbas_batched, nsbas_tiles, stacking_utilities, synthetic_stack
+
+
+def make_parametric_stack(params, step_date, baselines, ny=4, nx=5, n_dates=40, wavelength=56):
+    """ Interferograms made exactly from the parametric model, for a (n_params, ny, nx) array of parameters """
+    dates, pairs = synthetic_stack.make_network(n_dates, max_neighbors=3)
+    date_pairs = [dt.datetime.strftime(dates[a], "%Y%j") + "_" + dt.datetime.strftime(dates[b], "%Y%j")
+                  for a, b in pairs]
+    epochs = stacking_utilities.make_epoch_table(date_pairs)
+    G = nsbas_parametric.build_parametric_G(epochs, [step_date], baselines)
+    displacement = np.einsum('ik,kyx->iyx', G, params)
+    phase = (-4 * np.pi / wavelength * displacement).astype(np.float32)
+    stack = synthetic_stack.synthetic_stack(dates=dates, pairs=pairs, xvalues=np.arange(nx, dtype=float),
+                                            yvalues=np.arange(ny, dtype=float), phase=phase,
+                                            coherence=np.ones(np.shape(phase), dtype=np.float32),
+                                            velocity=params[0], baselines=baselines)
+    return synthetic_stack.to_intf_tuple(stack), synthetic_stack.to_intf_tuple(stack, coherence=True)
+
+
+class ParametricModelTests(unittest.TestCase):
+
+    def test_recovers_model(self):
+        rng = np.random.default_rng(0)
+        ny, nx, n_dates = 4, 5, 40
+        step_date = dt.datetime(2015, 8, 1)
+        baselines = rng.normal(scale=100, size=n_dates)
+        params = np.stack([rng.uniform(-20, 20, (ny, nx)), rng.uniform(-5, 5, (ny, nx)),
+                           rng.uniform(-5, 5, (ny, nx)), rng.uniform(-30, 30, (ny, nx)),
+                           rng.uniform(-1e-4, 1e-4, (ny, nx))])
+        params[:, 0, 0] = 0   # the reference pixel
+        names = ['velocity', 'annual_sin', 'annual_cos', 'step_20150801', 'Kz_error']
+        for ts_type, dem_error in [('NSBAS', 1), ('WNSBAS', 0)]:   # no DEM error with weights, as in nsbas
+            params[4] *= dem_error
+            intf_tuple, coh_tuple = make_parametric_stack(params, step_date, baselines, ny, nx, n_dates)
+            intf_tuple.zvalues[0:5, 2, 3] = np.nan   # a pixel with a different network
+            baseline_tuple = [(baselines[k], x, dt.datetime.strftime(x, "%Y%j"))
+                              for k, x in enumerate(intf_tuple.ts_dates)]
+            param_dict = {"nsbas_good_perc": 50, "wavelength": 56, "rowref": 0, "colref": 0, "dem_error": dem_error,
+                          "signal_coh_cutoff": 0.1, "ts_type": ts_type}
+            coh = coh_tuple if ts_type == 'WNSBAS' else None
+            parameters, grids = nsbas_parametric.Parametric_Model(param_dict, intf_tuple, 100 * np.ones((ny, nx)),
+                                                                  baseline_tuple, coh, [step_date], block_rows=3)
+            self.assertEqual([x.name for x in parameters], names[0:4 + dem_error])
+            for k, x in enumerate(parameters):
+                np.testing.assert_allclose(grids[x.name], params[k], atol=1e-3 * np.max(np.abs(params[k])))
+                self.assertLess(np.nanmax(grids[x.name + '_sigma']), 1e-3 * np.max(np.abs(params[k])))
+
+    def test_tiled_model_matches_single_pass(self):
+        rng = np.random.default_rng(2)
+        ny, nx, n_dates = 9, 5, 30
+        step_date = dt.datetime(2015, 6, 1)
+        params = np.stack([rng.uniform(-20, 20, (ny, nx)), rng.uniform(-5, 5, (ny, nx)), rng.uniform(-5, 5, (ny, nx)),
+                           rng.uniform(-30, 30, (ny, nx)), np.zeros((ny, nx))])
+        intf_tuple, coh_tuple = make_parametric_stack(params, step_date, np.zeros(n_dates), ny, nx, n_dates)
+        intf_tuple.zvalues[:] += rng.normal(scale=0.1, size=np.shape(intf_tuple.zvalues)).astype(np.float32)
+        intf_tuple.zvalues[0:4, 5, 2] = np.nan
+        intf_tuple.zvalues[:, 7, 1] = np.nan   # not eligible
+        param_dict = {"nsbas_good_perc": 50, "wavelength": 56, "rowref": 0, "colref": 0, "dem_error": 0,
+                      "signal_coh_cutoff": 0.1, "ts_type": 'NSBAS', "step_dates": [step_date],
+                      "nsbas_engine": 'batched'}
+        signal_spread = 100 * np.ones((ny, nx))
+        parameters, grids = nsbas_parametric.Parametric_Model(param_dict, intf_tuple, signal_spread, None, None,
+                                                              [step_date])
+        for n_workers in [1, 2]:
+            param_dict["n_workers"] = n_workers
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'parametric')
+            for x in parameters:
+                np.testing.assert_allclose(outputs[x.name], grids[x.name], atol=1e-8, equal_nan=True)
+                np.testing.assert_allclose(outputs[x.name + '_sigma'], grids[x.name + '_sigma'], atol=1e-8,
+                                           equal_nan=True)
+            self.assertTrue(np.isnan(outputs["velocity"][7, 1]))
+            self.assertEqual(outputs["eligibility"][7, 1], nsbas_batched.TOO_FEW_INTFS)
+            self.assertEqual(np.sum(outputs["eligibility"] == nsbas_batched.ELIGIBLE), ny * nx - 1)
+
+    def test_sigma_scales_with_noise(self):
+        rng = np.random.default_rng(1)
+        epochs = stacking_utilities.make_epoch_table(["2015010_2015022", "2015010_2015034", "2015022_2015046",
+                                                      "2015034_2015058", "2015046_2015070", "2015058_2015070",
+                                                      "2015022_2015058", "2015010_2015070"])
+        G = nsbas_parametric.build_parametric_G(epochs)
+        data = rng.normal(scale=2.0, size=(len(G), 2000))
+        m, sigma = nsbas_parametric.solve_parametric_block(G, data)
+        np.testing.assert_allclose(np.std(m, axis=1), np.mean(sigma, axis=1), rtol=0.1)
+        m_rank_deficient, _ = nsbas_parametric.solve_parametric_block(G[0:2], data[0:2])
+        self.assertTrue(np.all(np.isnan(m_rank_deficient)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+# Does the tiled executor give the same answers as a single pass over the whole cube?
+
+import unittest
+import tempfile
+import os
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from .. import nsbas_batched, nsbas_tiles, nsbas_checkpoint, nsbas_accessing, ts_output, stacking_utilities
+from .. import readmytupledata as rmd
+from .test_nsbas_batched import make_synthetic_intf_tuple, make_param_dict
+
+
+class TiledNSBASTests(unittest.TestCase):
+
+    def test_row_tiles_cover_frame(self):
+        tiles = nsbas_tiles.get_row_tiles(103, 4)
+        self.assertEqual(tiles[0][0], 0)
+        self.assertEqual(tiles[-1][1], 103)
+        for k in range(1, len(tiles)):
+            self.assertEqual(tiles[k][0], tiles[k - 1][1])
+
+    def test_row_tiles_fit_budget_and_chunks(self):
+        tiles = nsbas_tiles.get_row_tiles(3000, 1, bytes_per_row=1000, max_bytes=600 * 1000)
+        self.assertEqual(tiles[0], (0, 512))   # 750 rows for 4 tiles, 600 in the budget, rounded to 256-row chunks
+        self.assertEqual(tiles[-1][1], 3000)
+        tiles = nsbas_tiles.get_row_tiles(3000, 2, bytes_per_row=1000, max_bytes=100 * 1000)
+        self.assertEqual(tiles[0], (0, 64))   # 100 rows in the budget: the largest tile that divides a chunk
+        self.assertTrue(all([(r1 - r0) == 64 for r0, r1 in tiles[:-1]]))
+
+    def test_bounded_imap_keeps_order(self):
+        with ThreadPool(2) as pool:
+            self.assertEqual(list(nsbas_tiles.imap_bounded(pool, lambda x: x ** 2, range(10), 3)),
+                             [x ** 2 for x in range(10)])
+
+    def test_tiled_ts_matches_single_pass(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        ts_ref, _ = nsbas_batched.Full_TS(param_dict, intf_tuple, signal_spread, None, None)
+        ts_ref = np.array([[ts_ref[i][j][0] for j in range(7)] for i in range(11)]).transpose((2, 0, 1))
+        for engine in ['batched', 'pixel']:
+            for n_workers in [1, 2]:
+                param_dict.update({"nsbas_engine": engine, "n_workers": n_workers})
+                outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None,
+                                                      'timeseries')
+                np.testing.assert_allclose(outputs["ts"], ts_ref, atol=1e-4, equal_nan=True)
+
+    def test_tiled_ts_in_spawned_workers(self):
+        # spawned workers start with an empty epoch-table registry, unlike forked ones, and get the pickled table
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        intf_tuple = intf_tuple._replace(epochs=stacking_utilities.make_epoch_table(intf_tuple.date_pairs_julian))
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'pixel', "n_workers": 1})
+        outputs_ref = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        param_dict["n_workers"] = 2
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries',
+                                              mp_context=mp.get_context('spawn'))
+        np.testing.assert_allclose(outputs["ts"], outputs_ref["ts"], atol=1e-6, equal_nan=True)
+
+    def test_tiled_velocity_in_spawned_workers(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple(ny=11, nx=7)
+        intf_tuple = intf_tuple._replace(epochs=stacking_utilities.make_epoch_table(intf_tuple.date_pairs_julian))
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict(ts_type='WNSBAS')
+        vel_ref, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, coh_tuple)
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 2})
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, coh_tuple, 'velocity',
+                                              mp_context=mp.get_context('spawn'))
+        np.testing.assert_allclose(outputs["velocity"], vel_ref, atol=1e-8)
+
+    def test_tiled_velocity_matches_single_pass(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict(ts_type='WNSBAS')
+        vel_ref, _ = nsbas_batched.Velocities(param_dict, intf_tuple, signal_spread, None, coh_tuple)
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 3})
+        outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, coh_tuple, 'velocity')
+        np.testing.assert_allclose(outputs["velocity"], vel_ref, atol=1e-8)
+
+    def test_memmap_cube_matches_in_memory(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 1})
+        outputs_ref = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cube_file = rmd.get_cube_file(tmpdir, 'intf')
+            cube = rmd.allocate_cube(len(intf_tuple.zvalues), intf_tuple.zvalues[0], cube_file)
+            for k in range(len(intf_tuple.zvalues)):
+                cube[k] = intf_tuple.zvalues[k]
+            self.assertTrue(os.path.isfile(cube_file))
+            for r0, r1, block in rmd.cube_row_blocks(cube, block_rows=4):
+                np.testing.assert_allclose(block, intf_tuple.zvalues[:, r0:r1, :], rtol=1e-6, equal_nan=True)
+            param_dict["n_workers"] = 2
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple._replace(zvalues=cube), signal_spread,
+                                                  None, None, 'timeseries')
+            del cube
+        np.testing.assert_allclose(outputs["ts"], outputs_ref["ts"], atol=1e-3, equal_nan=True)
+
+    def test_netcdf_sink_matches_memory(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 2})
+        outputs_ref = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        self.assertEqual(outputs_ref["ts"].dtype, np.float32)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'ts_cube.nc')
+            sink = ts_output.make_netcdf_sink(filename, intf_tuple.xvalues, intf_tuple.yvalues, intf_tuple.ts_dates,
+                                              chunk_rows=4)
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries',
+                                                  sink)
+            self.assertNotIn("ts", outputs)
+            with ts_output.open_ts_cube(sink.close()) as cube:
+                self.assertEqual(np.shape(cube), np.shape(outputs_ref["ts"]))
+                np.testing.assert_array_equal(cube[3], outputs_ref["ts"][3])
+                np.testing.assert_array_equal(cube[:], outputs_ref["ts"])
+
+    def test_resume_from_checkpoint(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        param_dict = make_param_dict()
+        param_dict.update({"nsbas_engine": 'batched', "n_workers": 2})
+        outputs_ref = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries')
+        run_hash = nsbas_checkpoint.get_run_hash(param_dict, [], 'timeseries')
+        tiles = nsbas_tiles.get_row_tiles(11, 2, nsbas_tiles.CHECKPOINT_TILES_PER_WORKER)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'checkpoint')
+            checkpoint = nsbas_checkpoint.open_checkpoint(directory, run_hash, tiles)
+            nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries',
+                                        checkpoint=checkpoint)
+            self.assertEqual(sorted(checkpoint.completed), tiles)
+
+            # Interrupted after the first 5 tiles; a saved tile is marked so we can tell it was loaded, not computed
+            marked = nsbas_checkpoint.load_tile(checkpoint, tiles[2])
+            marked["ts"][:] = 0
+            nsbas_checkpoint.save_tile(checkpoint._replace(completed=[]), tiles[2], marked)
+            nsbas_checkpoint.write_manifest(checkpoint._replace(completed=tiles[0:5]))
+            checkpoint = nsbas_checkpoint.open_checkpoint(directory, run_hash, tiles, resume=True)
+            self.assertEqual(len(checkpoint.completed), 5)
+            outputs = nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'timeseries',
+                                                  checkpoint=checkpoint)
+            ts_expected = outputs_ref["ts"].copy()
+            ts_expected[:, tiles[2][0]:tiles[2][1]] = 0
+            np.testing.assert_allclose(outputs["ts"], ts_expected, atol=1e-4, equal_nan=True)
+            for key in outputs_ref.keys():
+                if key != "ts":
+                    np.testing.assert_array_equal(outputs[key], outputs_ref[key])
+
+            # Refuses to resume when the inputs changed
+            other_hash = nsbas_checkpoint.get_run_hash(dict(param_dict, nsbas_good_perc=90), [], 'timeseries')
+            self.assertRaises(ValueError, nsbas_checkpoint.open_checkpoint, directory, other_hash, tiles, True)
+            self.assertEqual(run_hash, nsbas_checkpoint.get_run_hash(dict(param_dict, n_workers=4), [], 'timeseries'))
+
+    def test_resume_with_signal_spread_made_by_the_run(self):
+        intf_tuple, _ = make_synthetic_intf_tuple(ny=11, nx=7)
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            param_dict = make_param_dict()
+            param_dict.update({"nsbas_engine": 'batched', "n_workers": 2, "ts_output_dir": tmpdir,
+                               "signal_spread_filename": os.path.join(tmpdir, 'signalspread.nc'),
+                               "baseline_file": '', "aoi_polygon": '', "make_signal_spread": 1,
+                               "checkpoint": 1})
+            intf_files = [os.path.join(tmpdir, 'intf_%d.grd' % i) for i in range(3)]
+            for filename in intf_files:
+                open(filename, 'w').write(filename)
+
+            def run_stage_3(run_number, resume):
+                # stage 3 writes the signal spread again before the inversion, so the file gets a new time
+                signal_spread.tofile(param_dict["signal_spread_filename"])
+                os.utime(param_dict["signal_spread_filename"], (1000 * run_number, 1000 * run_number))
+                checkpoint = nsbas_accessing.open_run_checkpoint(dict(param_dict, resume=resume), intf_tuple, None,
+                                                                 intf_files, 'velocity')
+                n_done = len(checkpoint.completed)
+                nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, signal_spread, None, None, 'velocity',
+                                            checkpoint=checkpoint)
+                return n_done
+
+            # Only written when the config asks for it, or to resume
+            self.assertIsNone(nsbas_accessing.open_run_checkpoint(dict(param_dict, checkpoint=0), intf_tuple, None,
+                                                                  intf_files, 'velocity'))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'checkpoint_velocity')))
+            self.assertEqual(run_stage_3(1, False), 0)
+            self.assertGreater(run_stage_3(2, True), 0)   # picks up the finished tiles of the first run
+
+            # A signal spread from somewhere else is an input like the interferograms
+            param_dict["make_signal_spread"] = 0
+            run_stage_3(3, False)
+            self.assertRaises(ValueError, run_stage_3, 4, True)
+
+            # Changed interferograms still stop a resume
+            param_dict["make_signal_spread"] = 1
+            run_stage_3(5, False)
+            os.utime(intf_files[0], (6000, 6000))
+            self.assertRaises(ValueError, run_stage_3, 6, True)
+
+
+if __name__ == "__main__":
+    unittest.main()
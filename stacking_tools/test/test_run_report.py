@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+
+# Does the run report record stages, sub-phases, and NSBAS phase timings, and write them as JSON?
+
+from .. import run_report, nsbas_tiles, synthetic_stack
+
+
+class RunReportTests(unittest.TestCase):
+
+    def test_stages_and_phases(self):
+        run_report.pop_phase_totals()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with run_report.stage("outer"):
+                with run_report.stage("inner", parent="outer"):
+                    np.save(os.path.join(tmpdir, 'junk.npy'), np.zeros(1000))
+                with run_report.phase("solve", n_pixels=10):
+                    pass
+            run_report.merge_phase_totals({"solve": {"seconds": 1.0, "pixels": 90, "calls": 2}})
+            outfile = run_report.write_report(tmpdir)
+            report = json.load(open(outfile))
+        inner, outer = report["stages"][-2], report["stages"][-1]
+        self.assertEqual((inner["name"], inner["parent"]), ("inner", "outer"))
+        self.assertEqual(outer["name"], "outer")
+        self.assertGreaterEqual(outer["wall_s"], inner["wall_s"])
+        self.assertGreaterEqual(inner["files_opened"], 1)
+        self.assertGreater(outer["peak_rss_so_far_mb"], 0)
+        if "rss_end_mb" in outer:   # current RSS is only read on Linux
+            self.assertGreater(outer["rss_end_mb"], 0)
+        self.assertEqual(report["nsbas_phases"]["solve"]["pixels"], 100)
+        self.assertEqual(report["nsbas_phases"]["solve"]["calls"], 3)
+        run_report.pop_phase_totals()
+
+    def test_tiled_nsbas_phases(self):
+        run_report.pop_phase_totals()
+        stack = synthetic_stack.make_synthetic_stack(ny=12, nx=10, n_dates=8)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        param_dict = {"nsbas_good_perc": 50, "sbas_smoothing": 1, "wavelength": 56, "rowref": 0, "colref": 0,
+                      "dem_error": 0, "ts_type": "NSBAS", "signal_coh_cutoff": 0.1, "nsbas_engine": "batched",
+                      "n_workers": 1}
+        nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, 100 * np.ones((12, 10)), None, None, 'timeseries')
+        phases = run_report.pop_phase_totals()
+        self.assertEqual(phases["pixel selection"]["pixels"], 120)
+        for name in ["G build", "solve", "smoothing"]:
+            self.assertIn(name, phases)
+
+    def test_pixel_engine_times_corrections_apart(self):
+        run_report.pop_phase_totals()
+        stack = synthetic_stack.make_synthetic_stack(ny=6, nx=5, n_dates=8)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        param_dict = {"nsbas_good_perc": 50, "sbas_smoothing": 1, "wavelength": 56, "rowref": 0, "colref": 0,
+                      "dem_error": 0, "ts_type": "NSBAS", "signal_coh_cutoff": 0.1, "nsbas_engine": "pixel",
+                      "n_workers": 1}
+        nsbas_tiles.run_tiled_nsbas(param_dict, intf_tuple, 100 * np.ones((6, 5)), None, None, 'timeseries')
+        phases = run_report.pop_phase_totals()
+        self.assertEqual(phases["smoothing"]["pixels"], 30)
+        self.assertEqual(phases["smoothing"]["calls"], phases["solve"]["calls"])   # once per tile, not per pixel
+        self.assertEqual(phases["solve"]["pixels"], 30)
+        self.assertGreaterEqual(phases["solve"]["seconds"], 0)
+
+    def test_phase_excludes_nested_phases(self):
+        run_report.pop_phase_totals()
+        with run_report.phase("outer", exclude=("inner",)):
+            run_report.add_phase_time("inner", 5.0)
+        phases = run_report.pop_phase_totals()
+        self.assertAlmostEqual(phases["outer"]["seconds"], -5.0, delta=1)   # the 5 s of inner came off outer
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+# Does the simple stack reject the same pixels as before, including pixels without a signal spread?
+
+import unittest
+import numpy as np
+from .. import Super_Simple_Stack as sss
+from .test_nsbas_batched import make_synthetic_intf_tuple
+
+
+class SimpleStackTests(unittest.TestCase):
+
+    def test_signal_threshold(self):
+        intf_tuple, _ = make_synthetic_intf_tuple()
+        signal_spread = 100 * np.ones(np.shape(intf_tuple.zvalues[0]))
+        signal_spread[1, 1], signal_spread[1, 2], signal_spread[1, 3] = 25, 26, np.nan
+        velocities, _, _ = sss.velocity_simple_stack(intf_tuple, 56, 0, 0, signal_spread, 25)
+        self.assertTrue(np.isnan(velocities[1, 1]))
+        self.assertFalse(np.isnan(velocities[1, 2]))
+        self.assertTrue(np.isnan(velocities[1, 3]))
+
+
+if __name__ == "__main__":
+    unittest.main()
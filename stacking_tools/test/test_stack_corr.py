@@ -0,0 +1,32 @@
+# Does the streaming signal spread agree with the whole-cube version?
+
+import unittest
+import numpy as np
+from .. import stack_corr
+from .test_nsbas_batched import make_synthetic_intf_tuple
+
+
+class SignalSpreadTests(unittest.TestCase):
+
+    def test_streaming_matches_cube(self):
+        intf_tuple, coh_tuple = make_synthetic_intf_tuple(ny=9, nx=4)
+        grids = {name: [intf_tuple.xvalues, intf_tuple.yvalues, coh_tuple.zvalues[k]]
+                 for k, name in enumerate(intf_tuple.filepaths)}
+        for cutoff in [np.nan, 0.6]:
+            ref = stack_corr.stack_corr(coh_tuple, cutoff)
+            _, _, a = stack_corr.stack_corr_streaming(intf_tuple.filepaths, cutoff, grids.get)
+            np.testing.assert_allclose(a, ref)
+
+        grids = {name: [intf_tuple.xvalues, intf_tuple.yvalues, intf_tuple.zvalues[k]]
+                 for k, name in enumerate(intf_tuple.filepaths)}
+        _, _, a = stack_corr.stack_corr_streaming(intf_tuple.filepaths, np.nan, grids.get)
+        np.testing.assert_allclose(a, stack_corr.stack_corr(intf_tuple, np.nan))
+        self.assertLess(a[2, 1], 100)   # this pixel is missing one interferogram
+
+    def test_threshold_to_mask(self):
+        mask = stack_corr.threshold_to_mask(np.array([[10, 50], [np.nan, 80]]), 50)
+        np.testing.assert_equal(mask, [[np.nan, 1], [np.nan, 1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
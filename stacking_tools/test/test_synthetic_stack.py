@@ -0,0 +1,45 @@
+# Does the synthetic stack carry the deformation signal we put into it, and land on disk in the right layout?
+
+import unittest
+import tempfile
+import os
+import re
+import datetime as dt
+import numpy as np
+from .. import synthetic_stack, nsbas_batched
+from s1_batches.read_write_insar_utilities import isce_read_write
+from .test_nsbas_batched import make_param_dict
+
+
+class SyntheticStackTests(unittest.TestCase):
+
+    def test_velocity_recovered(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=12, nx=10, n_dates=10, nan_fraction=0.1, noise=0.01)
+        intf_tuple = synthetic_stack.to_intf_tuple(stack)
+        self.assertEqual(np.shape(intf_tuple.zvalues), (len(stack.pairs), 12, 10))
+        self.assertTrue(np.any(np.isnan(intf_tuple.zvalues)))
+        param_dict = make_param_dict()
+        param_dict["rowref"], param_dict["colref"] = 0, 0
+        vel, _ = nsbas_batched.Velocities(param_dict, intf_tuple, 100 * np.ones((12, 10)), None, None)
+        expected = stack.velocity - stack.velocity[0, 0]
+        good = ~np.isnan(vel)
+        self.assertGreater(np.sum(good), 60)
+        np.testing.assert_allclose(vel[good], expected[good], atol=1.0)
+
+    def test_file_layouts(self):
+        stack = synthetic_stack.make_synthetic_stack(ny=6, nx=5, n_dates=4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            intf_files, corr_files = synthetic_stack.write_gmtsar_stack(stack, tmpdir)
+            self.assertEqual(len(intf_files), len(stack.pairs))
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, 'intf_record.in')))
+            datestr = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", intf_files[0])[0]
+            self.assertEqual(dt.datetime.strptime(str(int(datestr[0:7]) + 1), "%Y%j"), stack.dates[0])
+
+            intf_files, corr_files = synthetic_stack.write_isce_stack(stack, tmpdir)
+            phase = isce_read_write.read_binary_raster(intf_files[1], 5, 6, n_bands=2, scheme='BIL')[1]
+            np.testing.assert_array_equal(phase, stack.phase[1])
+            del phase
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+
+# Do the vectorized line fits agree with per-pixel polyfit, in memory and streamed from grid files?
+
+from .. import ts_velocity, synthetic_stack
+from .. import readmytupledata as rmd
+
+
+def make_ts_tuple(n_dates=20, ny=6, nx=5, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = [dt.datetime(2016, 1, 1) + dt.timedelta(days=12 * k + int(rng.integers(0, 3))) for k in range(n_dates)]
+    cube = rng.normal(size=(n_dates, ny, nx)).cumsum(axis=0)
+    cube[3, 1, 1] = np.nan   # a gap
+    cube[:, 0, 4] = np.nan   # an empty pixel
+    return rmd.data(filepaths=None, date_pairs_julian=None, date_deltas=None, xvalues=np.arange(nx),
+                    yvalues=np.arange(ny), zvalues=cube, date_pairs_dt=None, ts_dates=np.array(dates))
+
+
+class TsVelocityTests(unittest.TestCase):
+
+    def test_fit_matches_polyfit(self):
+        ts_tuple = make_ts_tuple()
+        days = np.array([(x - ts_tuple.ts_dates[0]).days for x in ts_tuple.ts_dates])
+        fit = ts_velocity.fit_ts_cube(ts_tuple, block_rows=4)
+        for i, j in [(0, 0), (2, 3), (1, 1)]:
+            good = ~np.isnan(ts_tuple.zvalues[:, i, j])
+            (slope, intercept), cov = np.polyfit(days[good], ts_tuple.zvalues[good, i, j], 1, cov='unscaled')
+            residual = ts_tuple.zvalues[good, i, j] - (intercept + slope * days[good])
+            self.assertAlmostEqual(fit.velocity[i, j], slope * 365.24, places=10)
+            self.assertAlmostEqual(fit.intercept[i, j], intercept, places=10)
+            self.assertAlmostEqual(fit.rms[i, j], np.sqrt(np.mean(residual ** 2)), places=10)
+            sigma = np.sqrt(cov[0, 0] * np.sum(residual ** 2) / (np.sum(good) - 2)) * 365.24
+            self.assertAlmostEqual(fit.velocity_sigma[i, j], sigma, places=10)
+        self.assertEqual(fit.n_valid[1, 1], 19)
+        self.assertTrue(np.isnan(fit.velocity[0, 4]))
+        self.assertTrue(np.all(fit.empirical_unc[~np.isnan(fit.empirical_unc)] >= 2))
+
+    def test_window_and_streaming(self):
+        ts_tuple = make_ts_tuple()
+        start, end = ts_tuple.ts_dates[5], ts_tuple.ts_dates[14]
+        in_memory = ts_velocity.fit_ts_cube(ts_tuple, start, end)
+        window = ts_tuple._replace(zvalues=ts_tuple.zvalues[5:15], ts_dates=ts_tuple.ts_dates[5:15])
+        np.testing.assert_allclose(in_memory.velocity, ts_velocity.fit_ts_cube(window).velocity)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for k in range(len(ts_tuple.ts_dates) - 1, -1, -1):   # out of order on purpose
+                files.append(os.path.join(tmpdir, dt.datetime.strftime(ts_tuple.ts_dates[k], "%Y%m%d") + ".grd"))
+                synthetic_stack.write_pixelnode_grd(ts_tuple.xvalues, ts_tuple.yvalues, ts_tuple.zvalues[k],
+                                                    files[-1])
+            _, _, streamed = ts_velocity.fit_ts_files(files, start, end, block_rows=2)
+        np.testing.assert_allclose(streamed.velocity, in_memory.velocity, rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(streamed.n_valid, in_memory.n_valid)
+
+
+if __name__ == "__main__":
+    unittest.main()
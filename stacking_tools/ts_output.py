@@ -0,0 +1,111 @@
+"""
+Output sinks for NSBAS time series.
+The tile scheduler hands each finished tile of rows, a (n_dates, n_rows, nx) float32 block, to a sink.
+The default sink writes the tiles straight into one chunked, compressed netcdf cube (time, y, x) on disk,
+so a full-frame time series never has to be in memory at once. The memory sink keeps a float32 cube in RAM instead.
+The legacy grids (one YYYYMMDD.grd per date) can still be written from either one, a date at a time.
+"""
+
+import numpy as np
+import collections
+import contextlib
+import datetime as dt
+import logging
+import os
+from netCDF4 import Dataset
+
+ts_sink = collections.namedtuple('ts_sink', ['write_tile', 'close'])   # close() returns the cube or its filename
+CHUNK_ROWS = 256   # rows in each chunk of the netcdf cube; the tile scheduler aligns its tiles to these
+logger = logging.getLogger(__name__)
+
+
+def make_memory_sink(n_dates, ny, nx):
+    cube = np.full((n_dates, ny, nx), np.nan, dtype=np.float32)
+
+    def write_tile(r0, r1, tile):
+        cube[:, r0:r1, :] = tile
+        return
+
+    return ts_sink(write_tile=write_tile, close=lambda: cube)
+
+
+def make_netcdf_sink(filename, xvalues, yvalues, ts_dates, zunits='mm', chunk_rows=CHUNK_ROWS, growable=False):
+    """
+    A netcdf cube with dimensions (time, y, x). Chunks hold one date and a block of rows, which suits both
+    the tiles we write and the per-date grids that are read back out of it.
+    growable: an unlimited time dimension, so that later dates can be appended in place (see append_cube_dates).
+    """
+    logger.info("Writing time series cube to %s " % filename)
+    ny, nx = len(yvalues), len(xvalues)
+    rootgrp = Dataset(filename, 'w', format='NETCDF4')
+    try:
+        rootgrp.createDimension('time', None if growable else len(ts_dates))
+        rootgrp.createDimension('y', ny)
+        rootgrp.createDimension('x', nx)
+        rootgrp.node_offset = 1   # pixel-node registration
+        timevar = rootgrp.createVariable('time', 'i4', ('time',))
+        timevar.units = "days since " + dt.datetime.strftime(ts_dates[0], "%Y-%m-%d")
+        timevar[:] = [(x - ts_dates[0]).days for x in ts_dates]
+        xvar = rootgrp.createVariable('x', 'f8', ('x',))
+        yvar = rootgrp.createVariable('y', 'f8', ('y',))
+        xvar[:], yvar[:] = xvalues, yvalues
+        zvar = rootgrp.createVariable('z', 'f4', ('time', 'y', 'x'), zlib=True, fill_value=np.nan,
+                                      chunksizes=(1, max(1, min(chunk_rows, ny)), max(1, nx)))
+        zvar.units = zunits
+    except Exception:
+        rootgrp.close()
+        raise
+
+    def write_tile(r0, r1, tile):
+        zvar[:, r0:r1, :] = tile
+        return
+
+    def close():
+        rootgrp.close()
+        return filename
+
+    return ts_sink(write_tile=write_tile, close=close)
+
+
+def make_ts_sink(param_dict, intf_tuple):
+    """ The sink chosen by ts_sink in the config: 'netcdf' (default) or 'memory' """
+    if param_dict.get("ts_sink", 'netcdf') == 'memory':
+        return make_memory_sink(len(intf_tuple.ts_dates), len(intf_tuple.yvalues), len(intf_tuple.xvalues))
+    return make_netcdf_sink(os.path.join(param_dict["ts_output_dir"], 'nsbas_ts_cube.nc'), intf_tuple.xvalues,
+                            intf_tuple.yvalues, intf_tuple.ts_dates)
+
+
+def get_cube_dates(filename):
+    """ The dates of a cube written by make_netcdf_sink """
+    with Dataset(filename, 'r') as rootgrp:
+        timevar = rootgrp.variables['time']
+        first = dt.datetime.strptime(timevar.units.split()[-1], "%Y-%m-%d")
+        return [first + dt.timedelta(days=int(x)) for x in timevar[:]]
+
+
+def append_cube_dates(rootgrp, ts_dates):
+    """
+    Add dates after the last one of a growable cube, open for appending. Their slices read as nan until written.
+    """
+    if len(ts_dates) == 0:
+        return
+    timevar = rootgrp.variables['time']
+    first = dt.datetime.strptime(timevar.units.split()[-1], "%Y-%m-%d")
+    n_old = len(timevar)
+    timevar[n_old:] = [(x - first).days for x in ts_dates]
+    return
+
+
+@contextlib.contextmanager
+def open_ts_cube(cube_or_filename):
+    """ Something to index like a (n_dates, ny, nx) array: the cube itself, or the z variable of a cube file """
+    if not isinstance(cube_or_filename, str):
+        yield cube_or_filename
+        return
+    rootgrp = Dataset(cube_or_filename, 'r')
+    rootgrp.set_auto_mask(False)
+    try:
+        yield rootgrp.variables['z']
+    finally:
+        rootgrp.close()
+    return
@@ -0,0 +1,143 @@
+"""
+Velocities and uncertainties from time series cubes, for every pixel at once.
+A line is fit to each pixel's time series from masked sums (n, sum t, sum t^2, sum y, sum ty),
+so nans are simply left out of the sums. The TS grids on disk can be streamed a tile of rows at a time.
+"""
+
+import numpy as np
+import collections
+import datetime as dt
+import logging
+import re
+from netCDF4 import Dataset
+from Tectonic_Utils.read_write import netcdf_read_write as rwr
+
+line_fit = collections.namedtuple('line_fit', ['velocity', 'intercept', 'rms', 'velocity_sigma', 'empirical_unc',
+                                               'n_valid'])
+logger = logging.getLogger(__name__)
+
+
+# ------------ COMPUTE ------------ #
+
+def fit_lines(ts_block, x_axis_days, max_nans=None, min_points=2):
+    """
+    Least squares line through every pixel's time series.
+    :param ts_block: (n_dates, ...) array of displacements in mm, nans allowed
+    :param x_axis_days: n_dates times, in days
+    :param max_nans: pixels with more nans than this are nan (like nsbas.compute_velocity_from_ts). None = no limit.
+    :param min_points: pixels with fewer real values than this are nan
+    :returns: line_fit of arrays shaped like ts_block[0]: velocity (mm/yr), intercept (mm at day 0),
+    rms of the residuals (mm), formal 1-sigma velocity uncertainty (mm/yr), empirical uncertainty (as in
+    velo_uncertainties: half the rms misfit of a line through the first value, at least 2), and number of values.
+    """
+    t = np.reshape(np.asarray(x_axis_days, dtype=float), (-1,) + (1,) * (np.ndim(ts_block) - 1))
+    good = ~np.isnan(ts_block)
+    y = np.where(good, ts_block, 0)
+    n = np.sum(good, axis=0)
+    sum_t, sum_tt = np.sum(good * t, axis=0), np.sum(good * t * t, axis=0)
+    sum_y, sum_ty = np.sum(y, axis=0), np.sum(y * t, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread = sum_tt - sum_t * sum_t / n   # n * variance of the sample times
+        slope = (sum_ty - sum_t * sum_y / n) / spread   # mm/day
+        intercept = (sum_y - slope * sum_t) / n
+        residual = np.where(good, ts_block - (intercept + slope * t), 0)
+        sum_sq = np.sum(residual * residual, axis=0)
+        rms = np.sqrt(sum_sq / n)
+        velocity_sigma = np.sqrt(sum_sq / (n - 2) / spread) * 365.24
+        velocity_sigma = np.where(n > 2, velocity_sigma, np.nan)
+
+        # The empirical uncertainty anchors the line at the first value of the time series
+        anchored = np.where(good, ts_block - (ts_block[0] + slope * (t - t[0])), 0)
+        empirical_unc = np.maximum(0.5 * np.sqrt(np.sum(anchored * anchored, axis=0) / n), 2)
+        empirical_unc = np.where(good[0], empirical_unc, np.nan)
+
+    bad = (n < min_points) | ~(spread > 0)
+    if max_nans is not None:
+        bad |= (len(t) - n) > max_nans
+    fields = [slope * 365.24, intercept, rms, velocity_sigma, empirical_unc]
+    fields = [np.where(bad, np.nan, x) for x in fields]
+    return line_fit(*fields, n_valid=n)
+
+
+def select_date_window(ts_dates, start_date=None, end_date=None):
+    """ Indices of the dates inside [start_date, end_date], and their times in days since the first of them """
+    keep = [k for k, x in enumerate(ts_dates) if (start_date is None or x >= start_date) and
+            (end_date is None or x <= end_date)]
+    if len(keep) == 0:
+        raise ValueError("No time series dates between %s and %s" % (start_date, end_date))
+    x_axis_days = [(ts_dates[k] - ts_dates[keep[0]]).days for k in keep]
+    return np.array(keep), x_axis_days
+
+
+def fit_ts_cube(ts_tuple, start_date=None, end_date=None, max_nans=None, block_rows=256):
+    """
+    Fit every pixel of a time series tuple (from readmytupledata.reader_from_ts), a block of rows at a time.
+    :returns: line_fit of (ny, nx) arrays
+    """
+    keep, x_axis_days = select_date_window(list(ts_tuple.ts_dates), start_date, end_date)
+    ny, nx = len(ts_tuple.yvalues), len(ts_tuple.xvalues)
+    fields = {key: np.full((ny, nx), np.nan) for key in line_fit._fields}
+    for r0 in range(0, ny, block_rows):
+        r1 = min(r0 + block_rows, ny)
+        block = np.asarray(ts_tuple.zvalues[keep, r0:r1, :], dtype=float)
+        store_block(fields, fit_lines(block, x_axis_days, max_nans), r0, r1)
+    return line_fit(**fields)
+
+
+def fit_ts_files(ts_slice_files, start_date=None, end_date=None, max_nans=None, block_rows=256):
+    """
+    Fit every pixel of a set of time series grids (YYYYMMDD.grd), reading only a tile of rows from each file at
+    a time. The full cube is never in memory.
+    :returns: xvalues, yvalues, line_fit of (ny, nx) arrays
+    """
+    ts_dates = [dt.datetime.strptime(re.findall(r"\d\d\d\d\d\d\d\d", x)[0], "%Y%m%d") for x in ts_slice_files]
+    order = np.argsort(ts_dates, kind='stable')
+    ts_slice_files, ts_dates = [ts_slice_files[k] for k in order], [ts_dates[k] for k in order]
+    keep, x_axis_days = select_date_window(ts_dates, start_date, end_date)
+    grids = [open_grid(ts_slice_files[k]) for k in keep]
+    xvalues, yvalues = grids[0][1], grids[0][2]
+    ny, nx = len(yvalues), len(xvalues)
+    fields = {key: np.full((ny, nx), np.nan) for key in line_fit._fields}
+    logger.info("Fitting velocities to %d time series grids in blocks of %d rows" % (len(grids), block_rows))
+    try:
+        for r0 in range(0, ny, block_rows):
+            r1 = min(r0 + block_rows, ny)
+            block = np.array([read_grid_rows(grid, r0, r1) for grid in grids], dtype=float)
+            store_block(fields, fit_lines(block, x_axis_days, max_nans), r0, r1)
+    finally:
+        for grid in grids:
+            if grid[0] is not None:
+                grid[0].close()
+    return xvalues, yvalues, line_fit(**fields)
+
+
+def store_block(fields, fit, r0, r1):
+    for key in line_fit._fields:
+        fields[key][r0:r1, :] = getattr(fit, key)
+    return
+
+
+# ------------ READING ROWS OF GRIDS ------------ #
+
+def open_grid(filename):
+    """
+    Open a netcdf grid for reading rows. For the usual x/y/z layout, we keep the open dataset and read slices.
+    Other layouts (like GDAL's 1D z array) are read whole.
+    :returns: (dataset or None, xvalues, yvalues, zkey or full z array)
+    """
+    rootgrp = Dataset(filename, 'r')
+    if len(rootgrp.variables.keys()) == 3:
+        [xkey, ykey, zkey] = rwr.properly_parse_three_variables(*rootgrp.variables.keys())
+        rootgrp.set_auto_mask(False)
+        return rootgrp, np.array(rootgrp.variables[xkey][:]), np.array(rootgrp.variables[ykey][:]), zkey
+    rootgrp.close()
+    xvalues, yvalues, zvalues = rwr.read_netcdf4(filename)
+    return None, np.array(xvalues), np.array(yvalues), np.array(zvalues)
+
+
+def read_grid_rows(grid, r0, r1):
+    rootgrp, _, _, z = grid
+    if rootgrp is None:
+        return z[r0:r1, :]
+    return rootgrp.variables[z][r0:r1, :]
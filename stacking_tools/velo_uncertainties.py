@@ -1,5 +1,5 @@
 import numpy as np
-from . import nsbas
+from . import nsbas, ts_velocity
 
 
 def compute_empirical_uncertainties(i, j, ts_tuple, x_axis_days):
@@ -22,15 +22,5 @@ def compute_empirical_uncertainties(i, j, ts_tuple, x_axis_days):
 
 
 def empirical_uncertainty(ts_tuple):
-    """Find empirical uncertainties from a 2D grid of time series"""
-    retval_main = np.zeros([len(ts_tuple.yvalues), len(ts_tuple.xvalues)])
-    retval_metrics = [[{} for _i in range(len(ts_tuple.xvalues))] for _j in range(len(ts_tuple.yvalues))]
-    x_axis_days = [(i - ts_tuple.ts_dates[0]).days for i in ts_tuple.ts_dates]
-
-    def packager_function(i, j, ts_tuple):
-        # Giving access to all these variables.
-        return compute_empirical_uncertainties(i, j, ts_tuple, x_axis_days)
-
-    retval_main, retval_metrics = nsbas.iterator_func(ts_tuple, packager_function, retval_main, retval_metrics)
-
-    return retval_main
+    """Find empirical uncertainties from a 2D grid of time series. All pixels are fit at once."""
+    return ts_velocity.fit_ts_cube(ts_tuple, max_nans=30).empirical_unc
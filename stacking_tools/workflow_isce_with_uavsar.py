@@ -11,9 +11,14 @@ def custom_isce_unwrapping(config_params):
     unwrapping_isce_custom.main_function(custom_params.rlks, custom_params.alks, custom_params.filt,
                                          custom_params.xbounds, custom_params.ybounds,
                                          custom_params.cor_cutoff_mask)
+    return
+
+
+def make_signal_spread_isce(config_params, region=None):
+    """ Signal spread of the custom-unwrapped interferograms, on the area of interest if there's a region """
     intf_file_tuples = stacking_utilities.get_list_of_intf_all(config_params)
     corr_files = [x[3] for x in intf_file_tuples]
-    stack_corr.drive_signal_spread_isce(corr_files, 0.5, config_params.ts_output_dir, "signalspread_full.nc")
+    stack_corr.drive_signal_spread_isce(corr_files, 0.5, config_params.ts_output_dir, "signalspread_full.nc", region)
     return
 
 
@@ -37,13 +42,14 @@ def stack_corr_for_ref_unwrapped_isce(intf_files, rowref, colref, ts_output_dir,
     return
 
 
-def geocode_isce_uavsar(config_params):
+def geocode_isce_uavsar(config_params, region=None):
+    """ With a region (see aoi.py), TS.nc is on the area of interest, and the lon/lat grids are cropped to match """
     geocode_directory = config_params.ts_output_dir + "/isce_geocode"
     # Deleting the contents of this folder would be a good automatic step in the future.
     isce_geocode_tools.gmtsar_nc_stack_2_isce_stack(config_params.ts_output_dir + "/TS.nc", geocode_directory,
                                                     bands=2)  # write the TS data into isce binaries
-    W, E, S, N = isce_geocode_tools.geocode_UAVSAR_stack(config_params,
-                                                         geocode_directory)  # do this once or more than once
+    W, E, S, N = isce_geocode_tools.geocode_UAVSAR_stack(config_params, geocode_directory,
+                                                         region)  # do this once or more than once
     isce_geocode_tools.create_isce_stack_unw_geo(geocode_directory, W, E, S, N)
     isce_geocode_tools.create_isce_stack_rdr_geo(geocode_directory, W, E, S, N)
     isce_geocode_tools.inspect_isce(geocode_directory)